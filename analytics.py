@@ -0,0 +1,161 @@
+"""
+資産推移の分析
+
+asset_history の行を列ごとの NumPy 配列(HistoryColumns)に読み込み、時間加重リターン・
+ドローダウン・ボラティリティ・資産クラス別の寄与を行ループなしで計算する。
+
+入出金は記録していないため、日次リターンは総資産の前日比とし、それを連結したものを
+時間加重リターンとする(入出金のあった日はその額もリターンに含まれる)。資産クラス別の
+寄与は、各日の評価額の増減を前日の総資産で割り、その日までの累積成長率を掛けて合計する。
+寄与の合計は時間加重リターンに一致する。
+
+numpy は起動時間を増やさないよう、計算する関数の中で import する。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# asset_history の資産クラス別の列(<class>_value)
+CLASS_COLUMNS = ('jp_stock', 'us_stock', 'cash', 'gold', 'crypto', 'investment_trust', 'insurance')
+
+# 期間 → 日数(None は全期間)
+RANGES = {'1m': 31, '3m': 92, '6m': 183, '1y': 366, '3y': 1096, 'all': None}
+
+# スナップショットは休日も含めて毎日記録される
+PERIODS_PER_YEAR = 365
+
+
+class HistoryColumns:
+    """資産推移を列ごとに持つ(dates: datetime64[D], values: 日数 × 資産クラス, total: 日数)"""
+
+    __slots__ = ('dates', 'values', 'total')
+
+    def __init__(self, dates, values, total):
+        self.dates = dates
+        self.values = values
+        self.total = total
+
+    def __len__(self):
+        return len(self.total)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """(record_date, 各資産クラスの評価額..., total_value) の行(日付順)から作る"""
+        import numpy as np
+
+        rows = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in rows]
+        if not rows:
+            return cls(np.empty(0, dtype='datetime64[D]'), np.empty((0, len(CLASS_COLUMNS))), np.empty(0))
+        dates = np.array([str(row[0])[:10] for row in rows], dtype='datetime64[D]')
+        data = np.array([row[1:] for row in rows], dtype=float)
+        np.nan_to_num(data, copy=False)
+        return cls(dates, data[:, :len(CLASS_COLUMNS)], data[:, len(CLASS_COLUMNS)])
+
+
+def compute_metrics(history):
+    """HistoryColumns から指標と系列(累積リターン・ドローダウン)を計算"""
+    import numpy as np
+
+    n = len(history)
+    result = {
+        'points': n,
+        'start': str(history.dates[0]) if n else None,
+        'end': str(history.dates[-1]) if n else None,
+        'start_value': float(history.total[0]) if n else 0.0,
+        'end_value': float(history.total[-1]) if n else 0.0,
+        'time_weighted_return': 0.0,
+        'annualized_return': None,
+        'volatility': None,
+        'max_drawdown': 0.0,
+        'max_drawdown_peak': None,
+        'max_drawdown_trough': None,
+        'current_drawdown': 0.0,
+        'contribution': dict.fromkeys(CLASS_COLUMNS, 0.0),
+        'series': {'dates': [str(d) for d in history.dates], 'cumulative_return': [0.0] * n, 'drawdown': [0.0] * n},
+    }
+    if n < 2:
+        return result
+
+    total = history.total
+    previous = total[:-1]
+    valid = previous > 0
+    safe_previous = np.where(valid, previous, 1.0)
+
+    # 日次リターン(前日の総資産が0の日は0とする)と累積成長率
+    daily = np.where(valid, total[1:] / safe_previous - 1, 0.0)
+    growth = np.cumprod(1 + daily)
+    growth_before = np.concatenate(([1.0], growth[:-1]))
+    twr = float(growth[-1] - 1)
+
+    days = int((history.dates[-1] - history.dates[0]).astype(int))
+    if days > 0 and twr > -1:
+        result['annualized_return'] = float((1 + twr) ** (PERIODS_PER_YEAR / days) - 1)
+    if len(daily) > 1:
+        result['volatility'] = float(daily.std(ddof=1) * np.sqrt(PERIODS_PER_YEAR))
+
+    running_max = np.maximum.accumulate(total)
+    drawdown = np.where(running_max > 0, total / np.where(running_max > 0, running_max, 1.0) - 1, 0.0)
+    trough = int(np.argmin(drawdown))
+    peak = int(np.argmax(total[:trough + 1]))
+
+    # 資産クラス別の寄与: Σ 累積成長率(前日まで) × 評価額の増減 / 前日の総資産
+    changes = np.diff(history.values, axis=0)
+    weights = np.where(valid, growth_before / safe_previous, 0.0)
+    contribution = weights @ changes
+
+    result.update({
+        'time_weighted_return': twr,
+        'max_drawdown': float(drawdown[trough]),
+        'max_drawdown_peak': str(history.dates[peak]),
+        'max_drawdown_trough': str(history.dates[trough]),
+        'current_drawdown': float(drawdown[-1]),
+        'contribution': {name: float(value) for name, value in zip(CLASS_COLUMNS, contribution)},
+        'series': {
+            'dates': result['series']['dates'],
+            'cumulative_return': np.concatenate(([0.0], growth - 1)).tolist(),
+            'drawdown': drawdown.tolist(),
+        },
+    })
+    return result
+
+
+class AnalyticsCache:
+    """(user_id, 期間) → 計算結果
+
+    invalidate はこのプロセスの分しか捨てられないので、他のワーカーが書き込んだ
+    スナップショットに追従できるよう、get / put に資産推移の version(history_version)を
+    渡す。version が変わった結果はキャッシュにないものとして扱う。
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl or entry[1] != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self, key, value, version=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """user_id の結果を捨てる(None なら全ユーザー)"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == user_id]:
+                    del self._entries[key]
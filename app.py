@@ -1,19 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-import requests
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, jsonify
+from flask import has_request_context
+from flask import Response, stream_with_context
+from flask import before_render_template, template_rendered
 import json
 import os
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
-from bs4 import BeautifulSoup
 import time
+from urllib.parse import urlsplit
 from decimal import Decimal, InvalidOperation
 import concurrent.futures
+import functools
+import hmac
+import importlib.util
+import atexit
 import threading
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
+import queue
+from leader import LeaderElection, PostgresLeaderLock, FileLeaderLock
+from market_calendar import MARKET_SCHEDULES, is_refresh_due
+import metrics
+import profiling
+import fetch_log
+import http_cache
+import symbol_registry
+import ticker_index
+import price_stream
+import quote_store
+import hedging
+import analytics
+import simulation
+from holdings import ASSET_CLASSES, ASSET_TYPES, Holding, Portfolio, currencies_of, grouped_valuation
+import fx
+
+# requests / BeautifulSoup / APScheduler / psycopg2 は起動時間短縮のため使用時に import する
 
 # ログ設定
 logging.basicConfig(
@@ -22,27 +44,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# PostgreSQLサポート
-try:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor, execute_values
-    POSTGRES_AVAILABLE = True
-except ImportError:
-    POSTGRES_AVAILABLE = False
-
-# 暗号通貨銘柄(固定)
-CRYPTO_SYMBOLS = ['BTC', 'ETH', 'XRP', 'DOGE']
-
-# 投資信託銘柄(固定)
-INVESTMENT_TRUST_INFO = {
-    'S&P500': 'https://www.rakuten-sec.co.jp/web/fund/detail/?ID=JP90C000GKC6',
-    'オルカン': 'https://www.rakuten-sec.co.jp/web/fund/detail/?ID=JP90C000H1T1',
-    'FANG+': 'https://www.rakuten-sec.co.jp/web/fund/detail/?ID=JP90C000FZD4'
+# メトリクス(/metrics で公開)
+UPSTREAM_FETCH_SECONDS = metrics.histogram(
+    'portfolio_upstream_fetch_seconds', 'Upstream HTTP fetch latency by source', ['source'])
+UPSTREAM_RESPONSES = metrics.counter(
+    'portfolio_upstream_responses_total', 'Upstream HTTP responses by source and status', ['source', 'status'])
+SCRAPER_RESULTS = metrics.counter(
+    'portfolio_scraper_results_total', 'Scraper outcomes (success / parse_failure)', ['scraper', 'outcome'])
+FETCH_QUEUE_DEPTH = metrics.gauge(
+    'portfolio_fetch_queue_depth', 'Price fetch tasks waiting for a ThreadPoolExecutor worker')
+FETCH_QUEUE_DEPTH.set(0)
+DB_QUERY_SECONDS = metrics.histogram(
+    'portfolio_db_query_seconds', 'Database statement execution time', ['statement'])
+SNAPSHOT_SECONDS = metrics.histogram(
+    'portfolio_snapshot_seconds', 'Asset snapshot duration (scope: user / all)', ['scope'])
+REQUEST_SECONDS = metrics.histogram(
+    'portfolio_request_seconds', 'HTTP request latency by endpoint', ['endpoint', 'method'])
+PAGE_CACHE_RESULTS = metrics.counter(
+    'portfolio_page_cache_total', 'Scraped page cache outcomes (not_modified / unchanged / parsed)',
+    ['source', 'outcome'])
+HEDGE_RESULTS = metrics.counter(
+    'portfolio_hedge_total', 'Hedged request outcomes (hedged / mirror_won / budget_exhausted)', ['source', 'outcome'])
+SSE_STREAMS = metrics.counter(
+    'portfolio_sse_streams_total', 'Price stream connections (accepted / rejected at SSE_MAX_STREAMS)', ['outcome'])
+SHARED_QUOTE_RESULTS = metrics.counter(
+    'portfolio_shared_quote_total', 'Shared quote store outcomes (hit / waited / fetched / bypass)', ['outcome'])
+DB_CONNECTIONS = metrics.counter(
+    'portfolio_db_connections_total', 'Database connections by target (primary / replica)', ['target'])
+
+# PostgreSQLサポート(psycopg2 は接続時に import)
+POSTGRES_AVAILABLE = importlib.util.find_spec('psycopg2') is not None
+
+# 価格取得先(ベンチマークやテストではローカルのスタブに向けられる)
+YAHOO_CHART_URL = os.environ.get('YAHOO_CHART_URL', 'https://query1.finance.yahoo.com/v8/finance/chart')
+MINKABU_URL = os.environ.get('MINKABU_URL', 'https://cc.minkabu.jp')
+TANAKA_GOLD_URL = os.environ.get('TANAKA_GOLD_URL', 'https://gold.tanaka.co.jp/commodity/souba/english/index.php')
+RAKUTEN_FUND_URL = os.environ.get('RAKUTEN_FUND_URL', 'https://www.rakuten-sec.co.jp/web/fund/detail/')
+# チャートAPIの同等なホスト(ヘッジ先)。カンマ区切り、空なら YAHOO_CHART_URL だけを使う
+YAHOO_CHART_MIRRORS = [url for url in os.environ.get(
+    'YAHOO_CHART_MIRRORS',
+    'https://query2.finance.yahoo.com/v8/finance/chart' if 'YAHOO_CHART_URL' not in os.environ else '').split(',')
+    if url]
+
+# 銘柄レジストリの URL テンプレートで使う取得元のベースURL
+SOURCE_BASE_URLS = {
+    'yahoo': YAHOO_CHART_URL,
+    'minkabu': MINKABU_URL,
+    'tanaka': TANAKA_GOLD_URL,
+    'rakuten': RAKUTEN_FUND_URL,
 }
-INVESTMENT_TRUST_SYMBOLS = list(INVESTMENT_TRUST_INFO.keys())
 
-# 保険種類(参照用)
-INSURANCE_TYPES = ['生命保険', '医療保険', '学資保険', '個人年金保険', 'がん保険', 'その他']
+# 銘柄レジストリの URL が向いてよいホスト(取得元のホストと SYMBOL_URL_HOSTS に並べたもの)
+SYMBOL_URL_HOSTS = frozenset(
+    [urlsplit(url).hostname for url in SOURCE_BASE_URLS.values()]
+    + [host.strip().lower() for host in os.environ.get('SYMBOL_URL_HOSTS', '').split(',') if host.strip()])
+
+# 価格を自動取得する資産タイプ
+PRICED_ASSET_TYPES = ['jp_stock', 'us_stock', 'gold', 'crypto', 'investment_trust']
+
+# 銘柄レジストリに登録された銘柄だけを扱う資産タイプ(株式は任意の銘柄を受け付ける)
+REGISTERED_ASSET_TYPES = ('gold', 'crypto', 'investment_trust', 'insurance')
 
 # デバッグフラグ(環境変数で有効化可能)
 DEBUG_CRYPTO = os.environ.get('CRYPTO_DEBUG', '0') == '1'
@@ -56,24 +117,190 @@ if DATABASE_URL and DATABASE_URL.startswith('postgres://'):
 
 USE_POSTGRES = DATABASE_URL is not None and POSTGRES_AVAILABLE
 
+# 読み取り専用のリードレプリカ(任意)。get_db(readonly=True) の接続はこちらに向ける
+DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+if DATABASE_READ_URL and DATABASE_READ_URL.startswith('postgres://'):
+    DATABASE_READ_URL = DATABASE_READ_URL.replace('postgres://', 'postgresql://', 1)
+USE_READ_REPLICA = USE_POSTGRES and bool(DATABASE_READ_URL) and DATABASE_READ_URL != DATABASE_URL
+# 書き込んだセッションは、レプリカの遅延を見込んでこの秒数だけ読み取りもプライマリに向ける
+READ_AFTER_WRITE_SECONDS = float(os.environ.get('READ_AFTER_WRITE_SECONDS', '10'))
+# レプリカに繋がらないときは、この秒数で諦めてプライマリから読む
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', '3'))
+# レプリカに繋がらなかったら、この秒数は試さずにプライマリから読む(毎回タイムアウトを待たない)
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', '30'))
+
+# スキーマ初期化用のアドバイザリーロックのキー
+SCHEMA_LOCK_KEY = 725359
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE(?: IF NOT EXISTS)?)\s+(\w+)', re.IGNORECASE)
+
+
+def statement_label(sql):
+    """メトリクス用にSQLを「種類 テーブル」にまとめる(例: SELECT assets)"""
+    verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+    m = _STATEMENT_TABLE.search(sql)
+    return f"{verb} {m.group(1)}" if m else verb
+
+
+class MetricsCursor(sqlite3.Cursor):
+    """実行時間を計測する SQLite カーソル"""
+
+    def execute(self, sql, parameters=()):
+        with DB_QUERY_SECONDS.time(statement=statement_label(sql)), profiling.span('db'):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        with DB_QUERY_SECONDS.time(statement=statement_label(sql)), profiling.span('db'):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class MetricsConnection(sqlite3.Connection):
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
+
+
+_pg_cursor_factory = None
+
+
+def pg_cursor_factory():
+    """実行時間を計測する RealDictCursor(psycopg2 は使用時に import)"""
+    global _pg_cursor_factory
+    if _pg_cursor_factory is None:
+        from psycopg2.extras import RealDictCursor
+
+        class MetricsDictCursor(RealDictCursor):
+            def execute(self, query, vars=None):
+                with DB_QUERY_SECONDS.time(statement=statement_label(query)), profiling.span('db'):
+                    return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                with DB_QUERY_SECONDS.time(statement=statement_label(query)), profiling.span('db'):
+                    return super().executemany(query, vars_list)
+
+        _pg_cursor_factory = MetricsDictCursor
+    return _pg_cursor_factory
 
-def get_db():
-    """データベース接続を取得"""
+
+def use_primary_for_reads():
+    """このリクエスト(またはセッションの直前のリクエスト)で書き込んでいれば True"""
+    if not has_request_context():
+        return False
+    return g.get('db_wrote', False) or session.get('db_primary_until', 0) > time.time()
+
+
+def _mark_primary_write():
+    """このリクエストと、セッションの以降の読み取りをプライマリに固定する(read-after-write)"""
+    if USE_READ_REPLICA and has_request_context():
+        g.db_wrote = True
+        session['db_primary_until'] = time.time() + READ_AFTER_WRITE_SECONDS
+
+
+def writes_user_data(func):
+    """ユーザーのデータ(資産・ユーザー・資産推移)を書き換えるルートに付ける
+
+    書き込み用の接続を開くだけでは固定しない(価格の共有キャッシュへの書き込みや、
+    読み取りにしか使わない接続で、セッションがレプリカから外れないように)。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _mark_primary_write()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+# レプリカを次に試してよい時刻(time.monotonic())
+_replica_down_until = 0.0
+_replica_lock = threading.Lock()
+
+
+def replica_available():
+    """レプリカに繋がらなかった直後(REPLICA_RETRY_SECONDS 以内)なら False"""
+    return time.monotonic() >= _replica_down_until
+
+
+def _mark_replica_down(error):
+    """レプリカを REPLICA_RETRY_SECONDS のあいだ使わない(ログは障害ごとに1回)"""
+    global _replica_down_until
+    with _replica_lock:
+        already_down = not replica_available()
+        _replica_down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+    if not already_down:
+        logger.warning(f"Read replica unavailable, using primary for {REPLICA_RETRY_SECONDS:g}s: {error}")
+
+
+def get_db(readonly=False):
+    """データベース接続を取得
+
+    readonly=True は読み取りだけの接続で、DATABASE_READ_URL があればリードレプリカに向ける。
+    ただし同じリクエスト・セッションでユーザーのデータを書き換えた直後(writes_user_data)と、
+    レプリカに繋がらなかった直後はプライマリから読む。
+    """
     if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        import psycopg2
+        if readonly and USE_READ_REPLICA and not use_primary_for_reads():
+            if replica_available():
+                try:
+                    conn = psycopg2.connect(DATABASE_READ_URL, cursor_factory=pg_cursor_factory(),
+                                            connect_timeout=REPLICA_CONNECT_TIMEOUT)
+                    DB_CONNECTIONS.inc(target='replica')
+                    return conn
+                except psycopg2.OperationalError as e:
+                    _mark_replica_down(e)
+        conn = psycopg2.connect(DATABASE_URL, cursor_factory=pg_cursor_factory())
+        DB_CONNECTIONS.inc(target='primary')
         return conn
     else:
-        conn = sqlite3.connect('portfolio.db')
+        conn = sqlite3.connect('portfolio.db', factory=MetricsConnection)
         conn.row_factory = sqlite3.Row
         return conn
 
 
+# 相場(quotes)のキーとなる銘柄。金は銘柄名によらず1件にまとめる
+QUOTE_SYMBOL_SQL = "(CASE WHEN {t}.asset_type = 'gold' THEN '' ELSE {t}.symbol END)"
+
+# 保有資産に相場を結合した行(自動取得する資産は quotes の価格、現金・保険は assets の値)
+HOLDINGS_SQL = f'''SELECT a.id, a.user_id, a.asset_type, a.symbol, COALESCE(a.name, q.name) AS name, a.quantity,
+                          COALESCE(q.price, a.price) AS price, a.avg_cost, q.as_of
+                   FROM assets a
+                   LEFT JOIN quotes q ON q.asset_type = a.asset_type AND q.symbol = {QUOTE_SYMBOL_SQL.format(t='a')}'''
+
+
+# スキーマを変更したら上げる(ワーカー起動時はこの値と比較するだけで済ませる)
+SCHEMA_VERSION = 6
+
+
+def get_schema_version():
+    """DBに記録されたスキーマバージョンを取得(未初期化なら0)"""
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        c.execute('SELECT version FROM schema_version')
+        row = c.fetchone()
+        return row['version'] if row else 0
+    except Exception:
+        return 0
+    finally:
+        conn.close()
+
+
+def ensure_db_initialized():
+    """スキーマが古い場合のみ初期化する(デプロイごとに1回)"""
+    if get_schema_version() >= SCHEMA_VERSION:
+        return False
+    init_db()
+    return True
+
+
 def init_db():
     """データベースの初期化"""
     conn = get_db()
     c = conn.cursor()
     
     if USE_POSTGRES:
+        # 複数ワーカーが同時に初期化しないようにトランザクション単位でロック
+        c.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_KEY,))
+
         # PostgreSQL用のテーブル作成
         c.execute('''CREATE TABLE IF NOT EXISTS users (
             id SERIAL PRIMARY KEY,
@@ -113,6 +340,102 @@ def init_db():
             UNIQUE(user_id, record_date)
         )''')
         
+        # 銘柄ごとの取得ログ
+        c.execute('''CREATE TABLE IF NOT EXISTS fetch_log (
+            id BIGSERIAL PRIMARY KEY,
+            fetched_at TIMESTAMP NOT NULL,
+            scraper VARCHAR(50) NOT NULL,
+            symbol VARCHAR(50),
+            source VARCHAR(50),
+            http_status VARCHAR(10),
+            bytes INTEGER,
+            latency_ms REAL,
+            strategy VARCHAR(100),
+            price REAL
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_fetch_log_fetched_at ON fetch_log (fetched_at)')
+
+        # 銘柄レジストリ
+        c.execute('''CREATE TABLE IF NOT EXISTS symbols (
+            asset_type VARCHAR(50) NOT NULL,
+            symbol VARCHAR(50) NOT NULL,
+            name VARCHAR(255),
+            source VARCHAR(50),
+            url_template TEXT,
+            parser VARCHAR(50),
+            cadence_minutes INTEGER,
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            PRIMARY KEY (asset_type, symbol)
+        )''')
+        from psycopg2.extras import execute_values
+        execute_values(c, '''INSERT INTO symbols (asset_type, symbol, name, source, url_template, parser,
+                                                 cadence_minutes, enabled)
+                             VALUES %s ON CONFLICT (asset_type, symbol) DO NOTHING''',
+                       symbol_registry.DEFAULT_INSTRUMENTS)
+
+        # 日本株・米国株の銘柄索引(既存の保有銘柄から作り始める)
+        c.execute('''CREATE TABLE IF NOT EXISTS tickers (
+            asset_type VARCHAR(50) NOT NULL,
+            symbol VARCHAR(50) NOT NULL,
+            name VARCHAR(255),
+            exchange VARCHAR(50),
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (asset_type, symbol)
+        )''')
+        c.execute('''INSERT INTO tickers (asset_type, symbol, name)
+                    SELECT asset_type, symbol, MAX(name) FROM assets
+                    WHERE asset_type IN ('jp_stock', 'us_stock') GROUP BY asset_type, symbol
+                    ON CONFLICT (asset_type, symbol) DO NOTHING''')
+
+        # 銘柄ごとの相場(全ユーザーで共有)と日ごとの履歴
+        c.execute('''CREATE TABLE IF NOT EXISTS quotes (
+            asset_type VARCHAR(50) NOT NULL,
+            symbol VARCHAR(50) NOT NULL,
+            price REAL NOT NULL,
+            name VARCHAR(255),
+            source VARCHAR(50),
+            as_of TIMESTAMP NOT NULL,
+            PRIMARY KEY (asset_type, symbol)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS quote_history (
+            asset_type VARCHAR(50) NOT NULL,
+            symbol VARCHAR(50) NOT NULL,
+            quote_date DATE NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (asset_type, symbol, quote_date)
+        )''')
+        c.execute(f'''INSERT INTO quotes (asset_type, symbol, price, as_of)
+                     SELECT asset_type, {QUOTE_SYMBOL_SQL.format(t='assets')}, MAX(price), CURRENT_TIMESTAMP FROM assets
+                     WHERE asset_type IN ('jp_stock', 'us_stock', 'gold', 'crypto', 'investment_trust') AND price > 0
+                     GROUP BY asset_type, {QUOTE_SYMBOL_SQL.format(t='assets')}
+                     ON CONFLICT (asset_type, symbol) DO NOTHING''')
+
+        # 夜間ジョブの実行記録とチェックポイント(再起動後は未完了の分だけ再開する)
+        c.execute('''CREATE TABLE IF NOT EXISTS job_runs (
+            id SERIAL PRIMARY KEY,
+            job_name VARCHAR(50) NOT NULL,
+            run_date DATE NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            last_heartbeat TIMESTAMP,
+            duration_seconds REAL NOT NULL DEFAULT 0,
+            total_items INTEGER NOT NULL DEFAULT 0,
+            done_items INTEGER NOT NULL DEFAULT 0,
+            error_count INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (job_name, run_date)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS job_checkpoints (
+            run_id INTEGER NOT NULL,
+            item_key VARCHAR(255) NOT NULL,
+            status VARCHAR(20) NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (run_id, item_key),
+            FOREIGN KEY (run_id) REFERENCES job_runs (id)
+        )''')
+
         # デフォルトユーザー作成
         c.execute("SELECT id FROM users WHERE username = 'demo'")
         if not c.fetchone():
@@ -159,6 +482,98 @@ def init_db():
             UNIQUE(user_id, record_date)
         )''')
         
+        # 銘柄ごとの取得ログ
+        c.execute('''CREATE TABLE IF NOT EXISTS fetch_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fetched_at TIMESTAMP NOT NULL,
+            scraper TEXT NOT NULL,
+            symbol TEXT,
+            source TEXT,
+            http_status TEXT,
+            bytes INTEGER,
+            latency_ms REAL,
+            strategy TEXT,
+            price REAL
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_fetch_log_fetched_at ON fetch_log (fetched_at)')
+
+        # 銘柄レジストリ
+        c.execute('''CREATE TABLE IF NOT EXISTS symbols (
+            asset_type TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            name TEXT,
+            source TEXT,
+            url_template TEXT,
+            parser TEXT,
+            cadence_minutes INTEGER,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (asset_type, symbol)
+        )''')
+        c.executemany('''INSERT OR IGNORE INTO symbols (asset_type, symbol, name, source, url_template, parser,
+                                                     cadence_minutes, enabled)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', symbol_registry.DEFAULT_INSTRUMENTS)
+
+        # 日本株・米国株の銘柄索引(既存の保有銘柄から作り始める)
+        c.execute('''CREATE TABLE IF NOT EXISTS tickers (
+            asset_type TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            name TEXT,
+            exchange TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (asset_type, symbol)
+        )''')
+        c.execute('''INSERT OR IGNORE INTO tickers (asset_type, symbol, name)
+                    SELECT asset_type, symbol, MAX(name) FROM assets
+                    WHERE asset_type IN ('jp_stock', 'us_stock') GROUP BY asset_type, symbol''')
+
+        # 銘柄ごとの相場(全ユーザーで共有)と日ごとの履歴
+        c.execute('''CREATE TABLE IF NOT EXISTS quotes (
+            asset_type TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            price REAL NOT NULL,
+            name TEXT,
+            source TEXT,
+            as_of TIMESTAMP NOT NULL,
+            PRIMARY KEY (asset_type, symbol)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS quote_history (
+            asset_type TEXT NOT NULL,
+            symbol TEXT NOT NULL,
+            quote_date DATE NOT NULL,
+            price REAL NOT NULL,
+            PRIMARY KEY (asset_type, symbol, quote_date)
+        ) WITHOUT ROWID''')
+        c.execute(f'''INSERT OR IGNORE INTO quotes (asset_type, symbol, price, as_of)
+                     SELECT asset_type, {QUOTE_SYMBOL_SQL.format(t='assets')}, MAX(price), CURRENT_TIMESTAMP FROM assets
+                     WHERE asset_type IN ('jp_stock', 'us_stock', 'gold', 'crypto', 'investment_trust') AND price > 0
+                     GROUP BY asset_type, {QUOTE_SYMBOL_SQL.format(t='assets')}''')
+
+        # 夜間ジョブの実行記録とチェックポイント(再起動後は未完了の分だけ再開する)
+        c.execute('''CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_name TEXT NOT NULL,
+            run_date DATE NOT NULL,
+            status TEXT NOT NULL,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            last_heartbeat TIMESTAMP,
+            duration_seconds REAL NOT NULL DEFAULT 0,
+            total_items INTEGER NOT NULL DEFAULT 0,
+            done_items INTEGER NOT NULL DEFAULT 0,
+            error_count INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (job_name, run_date)
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS job_checkpoints (
+            run_id INTEGER NOT NULL,
+            item_key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (run_id, item_key),
+            FOREIGN KEY (run_id) REFERENCES job_runs (id)
+        ) WITHOUT ROWID''')
+
         # デフォルトユーザー作成
         c.execute("SELECT id FROM users WHERE username = 'demo'")
         if not c.fetchone():
@@ -166,9 +581,98 @@ def init_db():
             c.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", 
                      ('demo', demo_hash))
 
+    # スキーマバージョンを記録
+    c.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    c.execute('DELETE FROM schema_version')
+    if USE_POSTGRES:
+        c.execute('INSERT INTO schema_version (version) VALUES (%s)', (SCHEMA_VERSION,))
+    else:
+        c.execute('INSERT INTO schema_version (version) VALUES (?)', (SCHEMA_VERSION,))
+
+    conn.commit()
+    conn.close()
+
+
+def load_symbol_rows():
+    """symbols テーブルの全行(SymbolRegistry のローダー)"""
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    c.execute('''SELECT asset_type, symbol, name, source, url_template, parser, cadence_minutes, enabled
+                 FROM symbols ORDER BY asset_type, symbol''')
+    rows = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+
+instrument_registry = symbol_registry.SymbolRegistry(
+    load_symbol_rows, ttl=int(os.environ.get('SYMBOL_REGISTRY_TTL', '60')))
+
+
+def load_ticker_rows():
+    """tickers テーブルの全行(TickerIndex のローダー)"""
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    c.execute('SELECT asset_type, symbol, name, exchange FROM tickers')
+    rows = [(row['asset_type'], row['symbol'], row['name'], row['exchange']) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+
+stock_index = ticker_index.TickerIndex(load_ticker_rows, ttl=int(os.environ.get('TICKER_INDEX_TTL', '300')))
+
+
+def remember_ticker(asset_type, symbol, name, exchange=None):
+    """価格取得で分かった銘柄名を索引に登録(変化があったときだけ書き込む)"""
+    ticker = ticker_index.Ticker(asset_type, symbol, name, exchange)
+    if not name or not stock_index.add(ticker):
+        return
+    try:
+        conn = get_db()
+        c = conn.cursor()
+        if USE_POSTGRES:
+            c.execute('''INSERT INTO tickers (asset_type, symbol, name, exchange, updated_at)
+                        VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+                        ON CONFLICT (asset_type, symbol) DO UPDATE SET
+                            name = EXCLUDED.name, exchange = EXCLUDED.exchange, updated_at = EXCLUDED.updated_at''',
+                      ticker)
+        else:
+            c.execute('''INSERT OR REPLACE INTO tickers (asset_type, symbol, name, exchange, updated_at)
+                        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)''', ticker)
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        logger.error(f"Failed to store ticker {asset_type}:{symbol}: {e}")
+
+
+FETCH_LOG_ENABLED = os.environ.get('FETCH_LOG', '1') == '1'
+FETCH_LOG_RETENTION_DAYS = int(os.environ.get('FETCH_LOG_RETENTION_DAYS', '14'))
+_fetch_log_pruned_at = 0.0
+
+
+def write_fetch_log(entries):
+    """取得ログをまとめて書き込み、1時間に1回は保持期間を過ぎた行を削除"""
+    global _fetch_log_pruned_at
+    rows = [(e['fetched_at'], e['scraper'], e['symbol'], e['source'], e['http_status'],
+             e['bytes'], e['latency_ms'], e['strategy'], e['price']) for e in entries]
+    conn = get_db()
+    c = conn.cursor()
+    placeholder = '%s' if USE_POSTGRES else '?'
+    values = ', '.join([placeholder] * 9)
+    c.executemany(f'''INSERT INTO fetch_log (fetched_at, scraper, symbol, source, http_status,
+                     bytes, latency_ms, strategy, price) VALUES ({values})''', rows)
+    if time.monotonic() - _fetch_log_pruned_at > 3600:
+        _fetch_log_pruned_at = time.monotonic()
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=FETCH_LOG_RETENTION_DAYS)
+        c.execute(f'DELETE FROM fetch_log WHERE fetched_at < {placeholder}', (cutoff,))
     conn.commit()
     conn.close()
 
+
+if FETCH_LOG_ENABLED:
+    fetch_log.configure(write_fetch_log)
+    atexit.register(fetch_log.writer.flush)
+
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this-in-production')
 
@@ -178,50 +682,241 @@ def ping():
     """スリープ防止用のエンドポイント"""
     return "pong", 200
 
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    profiling.begin(request.method, request.path, request.endpoint)
+
+
+@app.teardown_request
+def observe_request_latency(exc=None):
+    profiling.finish()
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                endpoint=request.endpoint or 'unknown', method=request.method)
+
+
+def _template_render_started(sender, template, context, **extra):
+    trace = profiling.current_trace()
+    if trace is not None:
+        trace.render_started = time.perf_counter()
+
+
+def _template_render_finished(sender, template, context, **extra):
+    trace = profiling.current_trace()
+    started = getattr(trace, 'render_started', None)
+    if started is not None:
+        trace.add('render', time.perf_counter() - started)
+
+
+if profiling.ENABLED:
+    before_render_template.connect(_template_render_started, app)
+    template_rendered.connect(_template_render_finished, app)
+
+
+def require_token(env_name):
+    """環境変数 env_name のトークンによる Bearer 認証
+
+    トークンを設定していなければ、エンドポイントごと無効にする(404)。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = os.environ.get(env_name)
+            if not token:
+                return ('Not Found', 404)
+            authorization = request.headers.get('Authorization', '').encode()
+            if not hmac.compare_digest(authorization, f'Bearer {token}'.encode()):
+                return ('Unauthorized', 401)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@app.route('/admin/profiles')
+@require_token('ADMIN_TOKEN')
+def admin_profiles():
+    """遅いリクエスト(遅い順)と直近のサンプル(新しい順)のスパン内訳"""
+    if not profiling.ENABLED:
+        return ('Profiling is disabled', 404)
+    return jsonify(profiling.snapshot())
+
+
+def query_fetch_log(hours=24, min_latency_ms=0, failing_only=False, limit=100):
+    """取得ログを銘柄ごと・パース手法ごとに集計"""
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=hours)
+    placeholder = '%s' if USE_POSTGRES else '?'
+    having = ['AVG(latency_ms) >= ' + placeholder]
+    if failing_only:
+        having.append('SUM(CASE WHEN price IS NULL THEN 1 ELSE 0 END) > 0')
+
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    c.execute(f'''SELECT scraper, symbol, source, COUNT(*) AS fetches,
+                        SUM(CASE WHEN price IS NULL THEN 1 ELSE 0 END) AS failures,
+                        AVG(latency_ms) AS avg_latency_ms, MAX(latency_ms) AS max_latency_ms,
+                        AVG(bytes) AS avg_bytes, MAX(fetched_at) AS last_fetched_at
+                 FROM fetch_log WHERE fetched_at >= {placeholder}
+                 GROUP BY scraper, symbol, source
+                 HAVING {' AND '.join(having)}
+                 ORDER BY failures DESC, avg_latency_ms DESC
+                 LIMIT {placeholder}''', (since, min_latency_ms, limit))
+    symbols = [dict(row) for row in c.fetchall()]
+
+    c.execute(f'''SELECT scraper, strategy, COUNT(*) AS hits
+                 FROM fetch_log WHERE fetched_at >= {placeholder}
+                 GROUP BY scraper, strategy
+                 ORDER BY scraper, hits DESC''', (since,))
+    strategies = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return {'symbols': symbols, 'strategies': strategies}
+
+
+@app.route('/admin/fetch_log')
+@require_token('ADMIN_TOKEN')
+def admin_fetch_log():
+    """遅い・失敗している銘柄とパース手法の利用状況(?hours=24&min_latency_ms=0&failing=1)"""
+    summary = query_fetch_log(
+        hours=request.args.get('hours', 24, type=float),
+        min_latency_ms=request.args.get('min_latency_ms', 0, type=float),
+        failing_only=request.args.get('failing') == '1',
+        limit=request.args.get('limit', 100, type=int)
+    )
+    return jsonify(summary)
+
+
+@app.route('/admin/symbols', methods=['GET', 'POST'])
+@require_token('ADMIN_TOKEN')
+def admin_symbols():
+    """銘柄レジストリの一覧(GET)と追加・更新(POST, JSON で Instrument の各項目)"""
+    if request.method == 'GET':
+        return jsonify([instrument._asdict() for instrument in instrument_registry.instruments()])
+
+    data = request.get_json(silent=True) or {}
+    if not data.get('asset_type') or data.get('symbol') is None:
+        return jsonify({'error': 'asset_type and symbol are required'}), 400
+    if data.get('parser') and data['parser'] not in PAGE_PARSERS:
+        return jsonify({'error': f"unknown parser: {data['parser']}"}), 400
+    cadence = data.get('cadence_minutes')
+    if cadence is not None and (isinstance(cadence, bool) or not isinstance(cadence, int) or cadence <= 0):
+        return jsonify({'error': 'cadence_minutes must be a positive integer'}), 400
+    row = symbol_registry.Instrument(
+        data['asset_type'], data['symbol'], data.get('name') or data['symbol'], data.get('source'),
+        data.get('url_template'), data.get('parser'), data.get('cadence_minutes'), bool(data.get('enabled', True)))
+    # 保存した URL はサーバーが定期的に取得するので、取得元のホスト以外は受け付けない
+    try:
+        symbol_registry.checked_instrument_url(row, SOURCE_BASE_URLS, SYMBOL_URL_HOSTS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    conn = get_db()
+    c = conn.cursor()
+    if USE_POSTGRES:
+        c.execute('''INSERT INTO symbols
+                    (asset_type, symbol, name, source, url_template, parser, cadence_minutes, enabled)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (asset_type, symbol) DO UPDATE SET
+                        name = EXCLUDED.name, source = EXCLUDED.source, url_template = EXCLUDED.url_template,
+                        parser = EXCLUDED.parser, cadence_minutes = EXCLUDED.cadence_minutes,
+                        enabled = EXCLUDED.enabled''', row)
+    else:
+        c.execute('''INSERT OR REPLACE INTO symbols
+                    (asset_type, symbol, name, source, url_template, parser, cadence_minutes, enabled)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', row)
+    conn.commit()
+    conn.close()
+
+    # 他のワーカーは SYMBOL_REGISTRY_TTL 以内に読み直す
+    instrument_registry.reload()
+    return jsonify(row._asdict())
+
+
+@app.route('/admin/symbols/reload', methods=['POST'])
+@require_token('ADMIN_TOKEN')
+def admin_symbols_reload():
+    """このワーカーの銘柄レジストリを即時に読み直す"""
+    instrument_registry.reload()
+    return jsonify({'instruments': len(instrument_registry.instruments())})
+
+
+@app.route('/metrics')
+@require_token('METRICS_TOKEN')
+def metrics_endpoint():
+    """Prometheus 形式のメトリクス(METRICS_TOKEN で Bearer 認証。未設定なら無効)"""
+    return metrics.REGISTRY.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 def keep_alive():
     """
-    アプリケーションがスリープしないように、定期的に自身にリクエストを送る関数。
+    アプリケーションがスリープしないように、自身にリクエストを送る(スケジューラーから定期実行)。
     """
+    import requests
+
     app_url = os.environ.get('RENDER_EXTERNAL_URL')
-    
     if not app_url:
-        logger.info("RENDER_EXTERNAL_URL is not set. Keep-alive thread will not run.")
         return
 
-    ping_url = f"{app_url}/ping"
-    
-    while True:
-        try:
-            logger.info("Sending keep-alive ping...")
-            requests.get(ping_url, timeout=10)
-            logger.info("Keep-alive ping successful.")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Keep-alive ping failed: {e}")
-        
-        time.sleep(840)
+    try:
+        logger.info("Sending keep-alive ping...")
+        requests.get(f"{app_url}/ping", timeout=10)
+        logger.info("Keep-alive ping successful.")
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Keep-alive ping failed: {e}")
 
-if os.environ.get('RENDER'):
-    logger.info("Starting keep-alive thread for Render...")
-    keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)
-    keep_alive_thread.start()
 
+# ユーザー情報のプロセス内キャッシュ(user_id -> (有効期限, ユーザー))
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '60'))
+_user_cache = {}
+_user_cache_lock = threading.Lock()
 
-def get_current_user():
-    """現在のユーザーを取得"""
-    if 'user_id' not in session:
-        return None
-    
-    conn = get_db()
+
+def cache_user(user):
+    """ユーザー行をキャッシュに載せる(パスワードハッシュは保持しない)"""
+    user = {k: user[k] for k in user.keys() if k != 'password_hash'}
+    with _user_cache_lock:
+        _user_cache[user['id']] = (time.monotonic() + USER_CACHE_TTL, user)
+    return user
+
+
+def invalidate_user_cache(user_id=None):
+    """ユーザー情報の変更時にキャッシュを破棄(引数なしなら全件)"""
+    with _user_cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+
+
+def load_user(user_id):
+    """キャッシュ → DB の順にユーザーを取得"""
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    conn = get_db(readonly=True)
     c = conn.cursor()
     
     if USE_POSTGRES:
-        c.execute('SELECT * FROM users WHERE id = %s', (session['user_id'],))
+        c.execute('SELECT * FROM users WHERE id = %s', (user_id,))
     else:
-        c.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],))
+        c.execute('SELECT * FROM users WHERE id = ?', (user_id,))
     
     user = c.fetchone()
     conn.close()
-    return user
+    return cache_user(user) if user else None
+
+
+def get_current_user():
+    """現在のユーザーを取得(リクエスト内では flask.g に保持)"""
+    if 'user_id' not in session:
+        return None
+
+    if 'current_user' not in g:
+        g.current_user = load_user(session['user_id'])
+    return g.current_user
 
 _FULLWIDTH_TRANS = {ord(f): ord(t) for f, t in zip('0123456789', '0123456789')}
 _FULLWIDTH_TRANS.update({ord(','): ord(','), ord('.'): ord('.'), ord('+'): ord('+'), ord('-'): ord('-'), ord(' '): ord(' '), ord('%'): ord('%')})
@@ -262,47 +957,218 @@ def extract_number_from_string(s):
             return None
 
 
+def _timed_get(source, url, headers, timeout):
+    """GET して (応答, 秒数) を返す(取得元ごとのレイテンシと応答ステータスを記録)"""
+    import requests
+    from urllib.parse import urlsplit
+
+    started = time.perf_counter()
+    try:
+        with profiling.span(f'http:{urlsplit(url).netloc}'):
+            response = requests.get(url, headers=headers, timeout=timeout)
+    except requests.exceptions.RequestException:
+        UPSTREAM_RESPONSES.inc(source=source, status='error')
+        fetch_log.note_http(source, 'error', 0, time.perf_counter() - started)
+        raise
+    finally:
+        UPSTREAM_FETCH_SECONDS.observe(time.perf_counter() - started, source=source)
+    UPSTREAM_RESPONSES.inc(source=source, status=response.status_code)
+    return response, time.perf_counter() - started
+
+
+def http_get(source, url, headers=None, timeout=10):
+    """価格取得先へのGET"""
+    response, elapsed = _timed_get(source, url, headers, timeout)
+    fetch_log.note_http(source, response.status_code, len(response.content), elapsed)
+    return response
+
+
+# ヘッジ: 観測した p95 を過ぎても応答がなければ同等なホストにも送る
+HEDGE_ENABLED = os.environ.get('HEDGE_REQUESTS', '1') == '1'
+hedge_latency = hedging.LatencyTracker(
+    quantile=float(os.environ.get('HEDGE_QUANTILE', '0.95')),
+    default_delay=float(os.environ.get('HEDGE_DEFAULT_DELAY', '1.0')))
+hedge_budget = hedging.HostBudget(
+    rate_per_second=float(os.environ.get('HEDGE_RATE_PER_SECOND', '1')),
+    burst=int(os.environ.get('HEDGE_BURST', '5')))
+# 負けた側のリクエストは timeout まで走り続けるので、呼び出し元とは別のプールで送る
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('HEDGE_WORKERS', '32')), thread_name_prefix='hedge')
+
+
+def _observed_get(source, url, headers, timeout):
+    response, elapsed = _timed_get(source, url, headers, timeout)
+    if response.status_code == 200:
+        hedge_latency.observe(source, elapsed)
+    return response, elapsed
+
+
+def http_get_hedged(source, urls, headers=None, timeout=10):
+    """urls[0] に送り、p95 を過ぎても有効な応答がなければ次の URL にも送って先に返った応答を使う"""
+    import requests
+    from urllib.parse import urlsplit
+
+    if not HEDGE_ENABLED or len(urls) < 2:
+        return http_get(source, urls[0], headers=headers, timeout=timeout)
+
+    started = time.perf_counter()
+    pending = {_hedge_executor.submit(profiling.bind(_observed_get), source, urls[0], headers, timeout): urls[0]}
+    backups = list(urls[1:])
+    fallback = None
+    error = None
+    while pending:
+        wait_for = hedge_latency.delay(source) if backups else None
+        done, _ = concurrent.futures.wait(pending, timeout=wait_for, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            url = pending.pop(future)
+            try:
+                response, _ = future.result()
+            except requests.exceptions.RequestException as e:
+                error = e
+                continue
+            # 5xx と 429 以外はどのホストでも同じ結果になるのでそのまま返す
+            if response.status_code < 500 and response.status_code != 429:
+                if url != urls[0]:
+                    HEDGE_RESULTS.inc(source=source, outcome='mirror_won')
+                fetch_log.note_http(source, response.status_code, len(response.content), time.perf_counter() - started)
+                return response
+            if fallback is None:
+                fallback = response
+        # 応答が遅い、または失敗したら次のホストへ(予算の範囲で)
+        if backups and (not done or not pending):
+            url = backups.pop(0)
+            if hedge_budget.try_acquire(urlsplit(url).netloc):
+                HEDGE_RESULTS.inc(source=source, outcome='hedged')
+                pending[_hedge_executor.submit(profiling.bind(_observed_get), source, url, headers, timeout)] = url
+            else:
+                HEDGE_RESULTS.inc(source=source, outcome='budget_exhausted')
+                backups = []
+
+    if fallback is None:
+        fetch_log.note_http(source, 'error', 0, time.perf_counter() - started)
+        raise error
+    fetch_log.note_http(source, fallback.status_code, len(fallback.content), time.perf_counter() - started)
+    return fallback
+
+
+def yahoo_chart_urls(path):
+    """チャートAPIの URL(先頭が本来の取得先、残りはヘッジ先)"""
+    return [f"{base}/{path}" for base in [YAHOO_CHART_URL] + YAHOO_CHART_MIRRORS]
+
+
+def instrument_scraper(func):
+    """価格が取れたか(success / parse_failure)をスクレイパーごとに数え、取得ログに残す"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        fetch_log.begin(func.__name__, str(args[0]) if args else '')
+        price = None
+        try:
+            result = func(*args, **kwargs)
+            price = result.get('price') if isinstance(result, dict) else result
+        finally:
+            fetch_log.end(price)
+        outcome = 'success' if price else 'parse_failure'
+        SCRAPER_RESULTS.inc(scraper=func.__name__, outcome=outcome)
+        return result
+    return wrapper
+
+
+HTTP_CACHE_ENABLED = os.environ.get('HTTP_CACHE', '1') == '1'
+page_cache = http_cache.PageCache(int(os.environ.get('HTTP_CACHE_SIZE', '2048')))
+
+
+def fetch_page(source, url, headers, parse, timeout=10):
+    """HTMLページを取得して parse(text) の結果を返す
+
+    前回の ETag / Last-Modified で条件付きリクエストを送り、304 か本文が前回と
+    同じなら前回のパース結果を返す。文字コードは価格を取れた 200 応答のものをホストごとに固定する。
+    """
+    from urllib.parse import urlsplit
+
+    cached = page_cache.get(url) if HTTP_CACHE_ENABLED else None
+    if cached is not None:
+        headers = dict(headers or {}, **page_cache.conditional_headers(url))
+    response = http_get(source, url, headers=headers, timeout=timeout)
+
+    if cached is not None and response.status_code == 304:
+        PAGE_CACHE_RESULTS.inc(source=source, outcome='not_modified')
+        fetch_log.note_strategy('not_modified')
+        return cached.result
+
+    digest = http_cache.body_hash(response.content)
+    if cached is not None and response.status_code == 200 and digest == cached.body_hash:
+        PAGE_CACHE_RESULTS.inc(source=source, outcome='unchanged')
+        fetch_log.note_strategy('unchanged_body')
+        return cached.result
+
+    host = urlsplit(url).netloc
+    with profiling.span('parse'):
+        encoding = page_cache.encoding_for(host)
+        if encoding is None:
+            # 宣言された文字コードを優先し、なければ本文から推定する
+            encoding = (http_cache.declared_encoding(response.headers.get('Content-Type'), response.content)
+                        or response.apparent_encoding or 'utf-8')
+        response.encoding = encoding
+        text = response.text
+    result = parse(text)
+    PAGE_CACHE_RESULTS.inc(source=source, outcome='parsed')
+
+    # エラーページや推定の誤りで固定しないよう、価格が取れた 200 応答の文字コードだけを固定する
+    if response.status_code == 200 and result:
+        page_cache.pin_encoding(host, encoding)
+
+    # 価格が取れた 200 応答だけを保持する(失敗時は次回も取り直して解析する)
+    if HTTP_CACHE_ENABLED:
+        if response.status_code == 200 and result:
+            page_cache.put(url, http_cache.CacheEntry(
+                response.headers.get('ETag'), response.headers.get('Last-Modified'), digest, result))
+        else:
+            page_cache.discard(url)
+    return result
+
+
+def chart_meta_price(meta):
+    """チャートAPIの meta から価格を取り出す(使った項目を取得ログに残す)"""
+    for field in ('regularMarketPrice', 'previousClose', 'chartPreviousClose'):
+        if meta.get(field):
+            fetch_log.note_strategy(f'meta.{field}')
+            return meta[field]
+    return 0
+
+
+@instrument_scraper
 def scrape_yahoo_finance_jp(code):
     try:
-        api_url = f"https://query1.finance.yahoo.com/v8/finance/chart/{code}.T"
+        api_urls = yahoo_chart_urls(f"{code}.T")
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
-        session_req = requests.Session()
-        api_response = session_req.get(api_url, headers=headers, timeout=10)
+        api_response = http_get_hedged('yahoo', api_urls, headers=headers, timeout=10)
         
         if api_response.status_code == 200:
             try:
-                data = api_response.json()
+                with profiling.span('parse'):
+                    data = api_response.json()
                 if 'chart' in data and 'result' in data['chart'] and data['chart']['result']:
                     result = data['chart']['result'][0]
                     
                     price = 0
                     if 'meta' in result:
                         meta = result['meta']
-                        price = (meta.get('regularMarketPrice') or 
-                                meta.get('previousClose') or 
-                                meta.get('chartPreviousClose') or 0)
+                        price = chart_meta_price(meta)
                     
                     name = ""
+                    exchange = None
                     if 'meta' in result:
                         meta = result['meta']
                         name = meta.get('shortName') or meta.get('longName') or f"Stock {code}"
+                        exchange = meta.get('exchangeName')
 
-                    if name:
-                        jp_suffixes = ['株式会社', '合同会社', '合名会社', '合資会社', '有限会社', '(株)', '(株)']
-                        for suffix in jp_suffixes:
-                            name = name.replace(suffix, '')
-                        
-                        en_suffixes = [' COMPANY, LIMITED', ' COMPANY LIMITED', ' CO., LTD.', ' CO.,LTD.', ' CO., LTD', ' CO.,LTD', ' Co., Ltd.', ' CO.LTD', ' LTD.', ' LTD', ' INC.', ' INC', ' CORP.', ' CORP']
-                        for suffix in en_suffixes:
-                            if name.upper().endswith(suffix):
-                                name = name[:-len(suffix)]
-                                break
-                        name = name.strip()
+                    name = ticker_index.normalize_company_name(name)
 
                     if price > 0:
+                        remember_ticker('jp_stock', code, name, exchange)
                         return {'name': name, 'price': round(float(price), 2)}
 
             except Exception as e:
@@ -314,35 +1180,38 @@ def scrape_yahoo_finance_jp(code):
         logger.error(f"Error getting JP stock {code}: {e}")
         return {'name': f'Stock {code}', 'price': 0}
 
+
+@instrument_scraper
 def scrape_yahoo_finance_us(symbol):
     try:
-        api_url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol.upper()}"
+        api_urls = yahoo_chart_urls(symbol.upper())
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
         
-        session_req = requests.Session()
-        api_response = session_req.get(api_url, headers=headers, timeout=10)
+        api_response = http_get_hedged('yahoo', api_urls, headers=headers, timeout=10)
         
         if api_response.status_code == 200:
             try:
-                data = api_response.json()
+                with profiling.span('parse'):
+                    data = api_response.json()
                 if 'chart' in data and 'result' in data['chart'] and data['chart']['result']:
                     result = data['chart']['result'][0]
                     
                     price = 0
                     if 'meta' in result:
                         meta = result['meta']
-                        price = (meta.get('regularMarketPrice') or 
-                                meta.get('previousClose') or 
-                                meta.get('chartPreviousClose') or 0)
+                        price = chart_meta_price(meta)
                     
                     name = symbol.upper()
+                    exchange = None
                     if 'meta' in result:
                         meta = result['meta']
                         name = meta.get('shortName') or meta.get('longName') or symbol.upper()
+                        exchange = meta.get('exchangeName')
                     
                     if price > 0:
+                        remember_ticker('us_stock', symbol.upper(), name, exchange)
                         return {'name': name, 'price': round(float(price), 2)}
             except Exception as e:
                 logger.error(f"API parsing error for {symbol}: {e}")
@@ -370,167 +1239,265 @@ def get_stock_name(symbol, is_jp=False):
         return get_jp_stock_info(symbol)['name']
     else:
         return get_us_stock_info(symbol)['name']
+
+
+def lookup_stock_info(asset_type, symbol):
+    """銘柄名が索引にあれば名前の取得を省く。価格は quotes が PREFETCH_MAX_AGE 以内なら使い、古ければ取得する"""
+    ticker = stock_index.get(asset_type, symbol)
+    if ticker is not None and ticker.name:
+        conn = get_db(readonly=True)
+        c = conn.cursor()
+        if USE_POSTGRES:
+            c.execute('SELECT price, as_of FROM quotes WHERE asset_type = %s AND symbol = %s AND price > 0',
+                      (asset_type, symbol))
+        else:
+            c.execute('SELECT price, as_of FROM quotes WHERE asset_type = ? AND symbol = ? AND price > 0',
+                      (asset_type, symbol))
+        row = c.fetchone()
+        conn.close()
+        as_of = _as_utc(row['as_of']) if row else None
+        if as_of is not None and (datetime.now(timezone.utc) - as_of).total_seconds() < PREFETCH_MAX_AGE:
+            return {'name': ticker.name, 'price': row['price']}
+        return {'name': ticker.name, 'price': fetch_asset_price(asset_type, symbol)}
+    if asset_type == 'jp_stock':
+        return get_jp_stock_info(symbol)
+    return get_us_stock_info(symbol)
+
         
+@instrument_scraper
 def get_crypto_price(symbol):
     try:
         symbol = (symbol or '').upper()
-        if symbol not in CRYPTO_SYMBOLS:
+        instrument = instrument_registry.get('crypto', symbol)
+        if instrument is None:
             logger.warning(f"Unsupported crypto symbol requested: {symbol}")
             return 0.0
+        return fetch_instrument_page(instrument)
+    except Exception as e:
+        logger.error(f"Error getting crypto price for {symbol}: {e}")
+        return 0.0
 
-        url = f"https://cc.minkabu.jp/pair/{symbol}_JPY"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        response.encoding = response.apparent_encoding
-        text = response.text
-        
-        json_matches = re.findall(r'"(?:last|price|lastPrice|close|current|ltp)"\s*:\s*"?([0-9\.,Ee+\-]+)"?', text)
-        if json_matches:
-            for jm in json_matches:
-                val = extract_number_from_string(jm)
-                if val is not None and val > 0:
-                    if DEBUG_CRYPTO:
-                        logger.debug(f"Found price in JSON-like field: {jm} -> {val}")
-                    return round(val, 2)
-
-        idx = text.find('現在値')
-        if idx != -1:
-            snippet = text[idx: idx + 700]
-            m = re.search(r'([0-9]{1,3}(?:,[0-9]{3})*(?:\.\d+)?)\s*円', snippet)
-            if m:
-                try:
-                    return float(m.group(1).replace(',', ''))
-                except:
-                    pass
 
-        m = re.search(r'data-price=["\']([0-9\.,Ee+\-]+)["\']', text)
-        if m:
-            val = extract_number_from_string(m.group(1))
-            if val is not None:
+def parse_crypto_page(symbol, text):
+    """みんかぶのページから価格を探す(見つからなければ 0.0)"""
+    json_matches = re.findall(r'"(?:last|price|lastPrice|close|current|ltp)"\s*:\s*"?([0-9\.,Ee+\-]+)"?', text)
+    if json_matches:
+        for jm in json_matches:
+            val = extract_number_from_string(jm)
+            if val is not None and val > 0:
+                if DEBUG_CRYPTO:
+                    logger.debug(f"Found price in JSON-like field: {jm} -> {val}")
+                fetch_log.note_strategy('json_field')
                 return round(val, 2)
 
-        soup = BeautifulSoup(text, 'html.parser')
-        selectors = ['div.pairPrice', '.pairPrice', '.pair_price', 'div.priceWrap', 'div.kv',
-                     'span.yen', 'div.stock_price span.yen', 'p.price', 'span.price', 'div.price',
-                     'span.value', 'div.value', 'strong', 'b']
-        for sel in selectors:
-            try:
-                tag = soup.select_one(sel)
-            except Exception:
-                tag = None
-            if tag:
-                txt = tag.get_text(' ', strip=True)
-                val = extract_number_from_string(txt)
-                if val is not None and val > 0:
-                    if DEBUG_CRYPTO:
-                        logger.debug(f"Found price by selector {sel}: {txt} -> {val}")
-                    return round(val, 2)
-
-        normalized = normalize_fullwidth(text)
-        matches = re.findall(r'([0-9]{1,3}(?:,[0-9]{3})*(?:\.\d+)?)\s*円', normalized)
-        for num in matches:
+    idx = text.find('現在値')
+    if idx != -1:
+        snippet = text[idx: idx + 700]
+        m = re.search(r'([0-9]{1,3}(?:,[0-9]{3})*(?:\.\d+)?)\s*円', snippet)
+        if m:
             try:
-                val = float(num.replace(',', ''))
-                if val > 0:
-                    return round(val, 2)
+                price = float(m.group(1).replace(',', ''))
+                fetch_log.note_strategy('current_price_label')
+                return price
             except:
-                continue
+                pass
 
-        m2 = re.search(r'([0-9\.,]+[eE][+-]?\d+)', text)
-        if m2:
-            val = extract_number_from_string(m2.group(1))
+    m = re.search(r'data-price=["\']([0-9\.,Ee+\-]+)["\']', text)
+    if m:
+        val = extract_number_from_string(m.group(1))
+        if val is not None:
+            fetch_log.note_strategy('data_price_attr')
+            return round(val, 2)
+
+    from bs4 import BeautifulSoup
+    with profiling.span('parse'):
+        soup = BeautifulSoup(text, 'html.parser')
+    selectors = ['div.pairPrice', '.pairPrice', '.pair_price', 'div.priceWrap', 'div.kv',
+                 'span.yen', 'div.stock_price span.yen', 'p.price', 'span.price', 'div.price',
+                 'span.value', 'div.value', 'strong', 'b']
+    for sel in selectors:
+        try:
+            tag = soup.select_one(sel)
+        except Exception:
+            tag = None
+        if tag:
+            txt = tag.get_text(' ', strip=True)
+            val = extract_number_from_string(txt)
             if val is not None and val > 0:
                 if DEBUG_CRYPTO:
-                    logger.debug(f"Found price by scientific notation: {m2.group(1)} -> {val}")
+                    logger.debug(f"Found price by selector {sel}: {txt} -> {val}")
+                fetch_log.note_strategy(f'selector:{sel}')
                 return round(val, 2)
 
-        if DEBUG_CRYPTO:
-            snippet = text[:1200].replace('\n', ' ')
-            logger.debug(f"Failed to parse crypto price for {symbol}. Dumping small snippet:\n{snippet}\n--- end snippet ---")
-        return 0.0
-    except Exception as e:
-        logger.error(f"Error getting crypto price for {symbol}: {e}")
-        return 0.0
-
+    normalized = normalize_fullwidth(text)
+    matches = re.findall(r'([0-9]{1,3}(?:,[0-9]{3})*(?:\.\d+)?)\s*円', normalized)
+    for num in matches:
+        try:
+            val = float(num.replace(',', ''))
+            if val > 0:
+                fetch_log.note_strategy('yen_suffix')
+                return round(val, 2)
+        except ValueError:
+            continue
+
+    m2 = re.search(r'([0-9\.,]+[eE][+-]?\d+)', text)
+    if m2:
+        val = extract_number_from_string(m2.group(1))
+        if val is not None and val > 0:
+            if DEBUG_CRYPTO:
+                logger.debug(f"Found price by scientific notation: {m2.group(1)} -> {val}")
+            fetch_log.note_strategy('scientific_notation')
+            return round(val, 2)
+
+    if DEBUG_CRYPTO:
+        snippet = text[:1200].replace('\n', ' ')
+        logger.debug(f"Failed to parse crypto price for {symbol}. "
+                     f"Dumping small snippet:\n{snippet}\n--- end snippet ---")
+    return 0.0
+
+
+@instrument_scraper
 def get_gold_price():
     try:
-        tanaka_url = "https://gold.tanaka.co.jp/commodity/souba/english/index.php"
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        res = requests.get(tanaka_url, headers=headers, timeout=10)
-        res.encoding = res.apparent_encoding
-        soup = BeautifulSoup(res.text, "html.parser")
-        
-        for tr in soup.find_all("tr"):
-            tds = tr.find_all("td")
-            if len(tds) > 1 and tds[0].get_text(strip=True).upper() == "GOLD":
-                price_text = tds[1].get_text(strip=True)
-                price_match = re.search(r"([0-9,]+) yen", price_text)
-                if price_match:
-                    return int(price_match.group(1).replace(",", ""))
-        return 0
+        instrument = instrument_registry.get('gold', '')
+        if instrument is None:
+            logger.warning("Gold is not registered in the symbol registry")
+            return 0
+        return fetch_instrument_page(instrument)
     except Exception as e:
         logger.error(f"Error getting gold price: {e}")
         return 0
 
-def get_investment_trust_price(symbol):
-    if symbol not in INVESTMENT_TRUST_INFO:
-        logger.warning(f"Unsupported investment trust symbol: {symbol}")
-        return 0.0
 
-    url = INVESTMENT_TRUST_INFO[symbol]
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
+def parse_gold_page(text):
+    """田中貴金属の相場表から GOLD の行を探す"""
+    from bs4 import BeautifulSoup
+    with profiling.span('parse'):
+        soup = BeautifulSoup(text, "html.parser")
 
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.encoding = response.apparent_encoding
-        soup = BeautifulSoup(response.text, 'html.parser')
+    for tr in soup.find_all("tr"):
+        tds = tr.find_all("td")
+        if len(tds) > 1 and tds[0].get_text(strip=True).upper() == "GOLD":
+            price_text = tds[1].get_text(strip=True)
+            price_match = re.search(r"([0-9,]+) yen", price_text)
+            if price_match:
+                fetch_log.note_strategy('gold_row')
+                return int(price_match.group(1).replace(",", ""))
+    return 0
 
-        th = soup.find('th', string=re.compile(r'\s*基準価額\s*'))
-        
-        if th:
-            td = th.find_next_sibling('td')
-            if td:
-                price_text = td.get_text(strip=True)
-                price = extract_number_from_string(price_text)
-                
-                if price is not None:
-                    return price
 
-        logger.warning(f"Could not find the price for {symbol} on the page. The website structure may have changed.")
+@instrument_scraper
+def get_investment_trust_price(symbol):
+    instrument = instrument_registry.get('investment_trust', symbol)
+    if instrument is None:
+        logger.warning(f"Unsupported investment trust symbol: {symbol}")
         return 0.0
 
+    try:
+        price = fetch_instrument_page(instrument)
+        if not price:
+            logger.warning(f"Could not find the price for {symbol} on the page. "
+                           f"The website structure may have changed.")
+        return price
+
     except Exception as e:
         logger.error(f"Error scraping investment trust price for {symbol}: {e}")
         return 0.0
 
 
-def get_usd_jpy_rate():
+def parse_investment_trust_page(text):
+    """楽天証券のファンド詳細ページから基準価額を探す"""
+    from bs4 import BeautifulSoup
+    with profiling.span('parse'):
+        soup = BeautifulSoup(text, 'html.parser')
+
+    th = soup.find('th', string=re.compile(r'\s*基準価額\s*'))
+
+    if th:
+        td = th.find_next_sibling('td')
+        if td:
+            price = extract_number_from_string(td.get_text(strip=True))
+            if price is not None:
+                fetch_log.note_strategy('nav_th')
+                return price
+    return 0.0
+
+
+# 銘柄レジストリの parser 列 → ページのパース関数
+PAGE_PARSERS = {
+    'minkabu_pair': lambda instrument, text: parse_crypto_page(instrument.symbol, text),
+    'tanaka_gold': lambda instrument, text: parse_gold_page(text),
+    'rakuten_fund': lambda instrument, text: parse_investment_trust_page(text),
+}
+
+SCRAPER_HEADERS = {
+    'User-Agent': ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                   'Chrome/91.0.4472.124 Safari/537.36')
+}
+
+
+def fetch_instrument_page(instrument):
+    """レジストリの URL テンプレートとパース方法で価格ページを取得・解析"""
+    parse = PAGE_PARSERS.get(instrument.parser)
+    try:
+        url = symbol_registry.checked_instrument_url(instrument, SOURCE_BASE_URLS, SYMBOL_URL_HOSTS)
+    except ValueError as e:
+        logger.error(f"Refusing to fetch {instrument.asset_type}:{instrument.symbol}: {e}")
+        return 0
+    if parse is None or url is None:
+        logger.warning(f"No parser or URL registered for {instrument.asset_type}:{instrument.symbol}")
+        return 0
+    return fetch_page(instrument.source, url, SCRAPER_HEADERS, lambda text: parse(instrument, text))
+
+
+def fetch_fx_rate(currency, base='JPY'):
+    """為替レートを取得(失敗時は None)"""
+    pair = f"{currency}{base}=X"
+    fetch_log.begin('fetch_fx_rate', pair)
+    rate = None
     try:
-        api_url = "https://query1.finance.yahoo.com/v8/finance/chart/USDJPY=X"
+        api_urls = yahoo_chart_urls(pair)
         headers = {'User-Agent': 'Mozilla/5.0'}
         
-        session_req = requests.Session()
-        api_response = session_req.get(api_url, headers=headers, timeout=10)
+        api_response = http_get_hedged('yahoo', api_urls, headers=headers, timeout=10)
         
         if api_response.status_code == 200:
-            data = api_response.json()
+            with profiling.span('parse'):
+                data = api_response.json()
             if 'chart' in data and 'result' in data['chart'] and data['chart']['result']:
                 result = data['chart']['result'][0]
                 if 'meta' in result and 'regularMarketPrice' in result['meta']:
-                    return float(result['meta']['regularMarketPrice'])
-        
-        return 150.0
+                    fetch_log.note_strategy('meta.regularMarketPrice')
+                    rate = float(result['meta']['regularMarketPrice'])
     except Exception as e:
-        logger.error(f"Error getting USD/JPY rate: {e}")
-        return 150.0
+        logger.error(f"Error getting {currency}/{base} rate: {e}")
+    finally:
+        fetch_log.end(rate)
+    return rate
+
+
+# 為替レートは FX_CACHE_TTL 秒の間使い回す(評価のたびに取得しない)
+fx_rates = fx.FxRates(fetch_fx_rate, ttl=int(os.environ.get('FX_CACHE_TTL', '300')))
+
+
+def get_usd_jpy_rate():
+    return fx_rates.rate('USD', 'JPY')
 
 
+def load_holdings(user_id):
+    """ユーザーの保有資産を Holding のリストで取得"""
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    if USE_POSTGRES:
+        c.execute(f'{HOLDINGS_SQL} WHERE a.user_id = %s ORDER BY a.id', (user_id,))
+    else:
+        c.execute(f'{HOLDINGS_SQL} WHERE a.user_id = ? ORDER BY a.id', (user_id,))
+    holdings = [Holding.from_row(row) for row in c.fetchall()]
+    conn.close()
+    return holdings
+
+
+@SNAPSHOT_SECONDS.time(scope='user')
 def record_asset_snapshot(user_id):
     """現在の資産状況を記録"""
     conn = get_db()
@@ -541,41 +1508,138 @@ def record_asset_snapshot(user_id):
     today = datetime.now(jst).date()
     
     # 各資産タイプの合計値を計算
-    asset_types = ['jp_stock', 'us_stock', 'cash', 'gold', 'crypto', 'investment_trust', 'insurance']
-    values = {}
-    
-    for asset_type in asset_types:
-        if USE_POSTGRES:
-            c.execute('SELECT * FROM assets WHERE user_id = %s AND asset_type = %s', 
-                     (user_id, asset_type))
-        else:
-            c.execute('SELECT * FROM assets WHERE user_id = ? AND asset_type = ?', 
-                     (user_id, asset_type))
-        assets = c.fetchall()
-        
-        total = 0
-        if asset_type == 'us_stock':
-            usd_jpy = get_usd_jpy_rate()
-            total = sum(a['quantity'] * a['price'] for a in assets) * usd_jpy
-        elif asset_type == 'investment_trust':
-            total = sum((a['quantity'] * a['price'] / 10000) for a in assets)
-        elif asset_type == 'insurance':
-            total = sum(a['price'] for a in assets)
-        elif asset_type == 'cash':
-            total = sum(a['quantity'] for a in assets)
-        else:
-            total = sum(a['quantity'] * a['price'] for a in assets)
-        
-        values[asset_type] = total
+    if USE_POSTGRES:
+        c.execute(f'{HOLDINGS_SQL} WHERE a.user_id = %s', (user_id,))
+    else:
+        c.execute(f'{HOLDINGS_SQL} WHERE a.user_id = ?', (user_id,))
+    portfolio = Portfolio.from_rows(c.fetchall())
+    totals = portfolio.totals(fx_rates.rates_for(portfolio.currencies()))
+    values = {asset_type: value for asset_type, (value, _) in totals.items()}
     
     total_value = sum(values.values())
     
     # データを挿入または更新
+    write_asset_history(c, [(user_id, today, values['jp_stock'], values['us_stock'], values['cash'],
+                             values['gold'], values['crypto'], values['investment_trust'],
+                             values['insurance'], total_value)])
+
+    conn.commit()
+    conn.close()
+    analytics_cache.invalidate(user_id)
+
+
+# 資産推移の分析結果を (user_id, 期間) ごとに保持(history_version が変わるか、
+# このプロセスでのスナップショットの書き込みで破棄)
+analytics_cache = analytics.AnalyticsCache(ttl=int(os.environ.get('ANALYTICS_CACHE_TTL', '3600')))
+
+
+def history_version(user_id):
+    """user_id の資産推移の version(行数・最新の記録日・総資産の合計)
+
+    他のワーカーやランナーが書き込んだスナップショットでも変わるので、キャッシュの
+    有効性をワーカー間でそろえられる。同じ日の upsert は行数も記録日も変えないため、
+    総資産の合計も含める。
+    """
+    placeholder = '%s' if USE_POSTGRES else '?'
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    c.execute(f'''SELECT COUNT(*) AS row_count, MAX(record_date) AS latest, SUM(total_value) AS total
+                 FROM asset_history WHERE user_id = {placeholder}''', (user_id,))
+    row = c.fetchone()
+    conn.close()
+    return (row['row_count'], str(row['latest']), row['total'])
+
+
+def load_history_columns(user_id, days=None):
+    """資産推移を列ごとの配列で取得(days 日前以降、None なら全期間)"""
+    placeholder = '%s' if USE_POSTGRES else '?'
+    columns = ', '.join(f'{name}_value' for name in analytics.CLASS_COLUMNS)
+    query = f'SELECT record_date, {columns}, total_value FROM asset_history WHERE user_id = {placeholder}'
+    params = [user_id]
+    if days is not None:
+        jst = timezone(timedelta(hours=9))
+        query += f' AND record_date >= {placeholder}'
+        params.append(datetime.now(jst).date() - timedelta(days=days))
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    c.execute(query + ' ORDER BY record_date', params)
+    rows = c.fetchall()
+    conn.close()
+    return analytics.HistoryColumns.from_rows(rows)
+
+
+def portfolio_analytics(user_id, range_key='1y', version=None):
+    """時間加重リターン・ドローダウン・ボラティリティ・資産クラス別寄与(キャッシュあり)
+
+    version は history_version(user_id) の値(None なら問い合わせる)。
+    """
+    if version is None:
+        version = history_version(user_id)
+    key = (user_id, range_key)
+    result = analytics_cache.get(key, version)
+    if result is None:
+        result = analytics.compute_metrics(load_history_columns(user_id, analytics.RANGES[range_key]))
+        result['range'] = range_key
+        analytics_cache.put(key, result, version)
+    return result
+
+
+# モンテカルロシミュレーション(パスはプロセスプールで計算する)
+SIMULATION_PATHS = int(os.environ.get('SIMULATION_PATHS', '20000'))
+# 受け付けるパス数(要求はこのどれかに切り上げる。キャッシュのキーと計算量をこの数通りに抑える)
+SIMULATION_PATH_SIZES = (5000, 20000, 50000, 100000)
+SIMULATION_MAX_PATHS = SIMULATION_PATH_SIZES[-1]
+# 配分の比率をこの刻みに丸めてキャッシュのキーにする(相場の小さな動きでは再計算しない)
+SIMULATION_WEIGHT_STEP = 0.005
+simulator = simulation.Simulator(
+    workers=int(os.environ.get('SIMULATION_WORKERS', str(min(4, max(1, (os.cpu_count() or 2) - 1))))),
+    timeout=float(os.environ.get('SIMULATION_TIMEOUT', '0.8')))
+atexit.register(simulator.shutdown)
+
+
+def current_allocation(user_id):
+    """資産クラス別の評価額(円、analytics.CLASS_COLUMNS の順。ダッシュボードの円グラフと同じ)"""
+    portfolio = Portfolio.from_rows(load_holdings(user_id))
+    totals = portfolio.totals(fx_rates.rates_for(portfolio.currencies()))
+    return [totals[name][0] for name in analytics.CLASS_COLUMNS]
+
+
+def portfolio_simulation(user_id, horizon_key='1y', paths=SIMULATION_PATHS):
+    """現在の配分を持ち続けた場合の総資産の分位点(キャッシュあり)
+
+    分布は総資産に比例するので、丸めた比率で開始額1として計算したものをキャッシュし、
+    現在の総資産を掛けて返す。
+    """
+    allocation = current_allocation(user_id)
+    total = sum(allocation)
+    step = SIMULATION_WEIGHT_STEP
+    weights = tuple(round(value / total / step) * step if total > 0 else 0.0 for value in allocation)
+    key = (user_id, 'simulation', weights, horizon_key, paths)
+    version = history_version(user_id)
+    result = analytics_cache.get(key, version)
+    if result is None:
+        returns = simulation.class_returns(load_history_columns(user_id))
+        result = simulator.run(returns, weights, simulation.HORIZONS[horizon_key], paths, seed=user_id)
+        # 期限までに一部のパスしか計算できなかった結果はキャッシュしない
+        if not result['partial']:
+            analytics_cache.put(key, result, version)
+    scale = total / result['start_value'] if result['start_value'] > 0 else 0.0
+    return dict(result,
+                horizon=horizon_key,
+                allocation=dict(zip(analytics.CLASS_COLUMNS, allocation)),
+                start_value=total,
+                mean=result['mean'] * scale,
+                bands={p: [v * scale for v in band] for p, band in result['bands'].items()})
+
+
+def write_asset_history(c, rows):
+    """asset_history に (user_id, record_date, 各資産タイプの評価額..., total_value) の行をまとめて upsert"""
     if USE_POSTGRES:
-        c.execute('''INSERT INTO asset_history 
+        from psycopg2.extras import execute_values
+        execute_values(c, '''INSERT INTO asset_history
                     (user_id, record_date, jp_stock_value, us_stock_value, cash_value, 
                      gold_value, crypto_value, investment_trust_value, insurance_value, total_value)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    VALUES %s
                     ON CONFLICT (user_id, record_date) 
                     DO UPDATE SET 
                         jp_stock_value = EXCLUDED.jp_stock_value,
@@ -586,95 +1650,603 @@ def record_asset_snapshot(user_id):
                         investment_trust_value = EXCLUDED.investment_trust_value,
                         insurance_value = EXCLUDED.insurance_value,
                         total_value = EXCLUDED.total_value''',
-                 (user_id, today, values['jp_stock'], values['us_stock'], values['cash'],
-                  values['gold'], values['crypto'], values['investment_trust'], values['insurance'], total_value))
+                       rows, page_size=1000)
     else:
-        c.execute('''INSERT OR REPLACE INTO asset_history 
+        c.executemany('''INSERT OR REPLACE INTO asset_history
                     (user_id, record_date, jp_stock_value, us_stock_value, cash_value, 
                      gold_value, crypto_value, investment_trust_value, insurance_value, total_value)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (user_id, today, values['jp_stock'], values['us_stock'], values['cash'],
-                  values['gold'], values['crypto'], values['investment_trust'], values['insurance'], total_value))
-    
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+
+
+@SNAPSHOT_SECONDS.time(scope='all')
+def record_all_snapshots(record_date=None):
+    """全ユーザーのスナップショットを、集計クエリ1回と upsert 1回で記録(record_date の既定は今日)"""
+    jst = timezone(timedelta(hours=9))
+    today = record_date or datetime.now(jst).date()
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id FROM users ORDER BY id')
+    values = {row['id']: dict.fromkeys(ASSET_TYPES, 0) for row in c.fetchall()}
+
+    # ユーザー × 資産タイプで集計し、評価方法(holdings.ASSET_CLASSES)に応じて組み合わせる
+    c.execute(f'''SELECT user_id, asset_type, SUM(quantity) AS sum_quantity, SUM(price) AS sum_price,
+                        SUM(quantity * price) AS sum_product
+                 FROM ({HOLDINGS_SQL}) h GROUP BY user_id, asset_type''')
+    rows = [row for row in c.fetchall() if row['user_id'] in values and row['asset_type'] in ASSET_TYPES]
+
+    # 為替レートは必要な通貨だけ1回ずつ引く
+    rates = fx_rates.rates_for(currencies_of({row['asset_type'] for row in rows}))
+    for row in rows:
+        currency = ASSET_CLASSES[row['asset_type']].currency
+        values[row['user_id']][row['asset_type']] = grouped_valuation(
+            row['asset_type'], row['sum_quantity'], row['sum_price'], row['sum_product']) * rates.get(currency, 1)
+
+    rows = [(user_id, today, v['jp_stock'], v['us_stock'], v['cash'], v['gold'], v['crypto'],
+             v['investment_trust'], v['insurance'], sum(v.values()))
+            for user_id, v in values.items()]
+    write_asset_history(c, rows)
     conn.commit()
     conn.close()
+    analytics_cache.invalidate()
+    logger.info(f"Asset snapshots recorded for {len(rows)} users")
+    return len(rows)
+
+
+# ワーカー間で共有する価格ストア(同じ銘柄を複数ワーカーが同時に取得しない)
+SHARED_QUOTES_ENABLED = os.environ.get('SHARED_QUOTES', '1') == '1'
+shared_quotes = quote_store.SharedQuoteStore(
+    os.environ.get('SHARED_QUOTES_PATH', 'portfolio.db.quotes'),
+    ttl=float(os.environ.get('SHARED_QUOTES_TTL', '30')),
+    lease_seconds=float(os.environ.get('SHARED_QUOTES_LEASE_SECONDS', '15')),
+    on_result=lambda outcome: SHARED_QUOTE_RESULTS.inc(outcome=outcome))
+
+
+def fetch_asset_price(asset_type, symbol):
+    """資産タイプに応じて価格を取得(失敗時は0)。共有ストアに新しい価格があればそれを使う"""
+    if asset_type == 'gold':
+        symbol = ''
+    if SHARED_QUOTES_ENABLED:
+        return shared_quotes.get_or_fetch(asset_type, symbol, lambda: fetch_upstream_price(asset_type, symbol))
+    return fetch_upstream_price(asset_type, symbol)
+
+
+def fetch_upstream_price(asset_type, symbol):
+    """取得元から価格を取得(失敗時は0)"""
+    try:
+        if asset_type == 'jp_stock':
+            return get_stock_price(symbol, is_jp=True)
+        elif asset_type == 'us_stock':
+            return get_stock_price(symbol, is_jp=False)
+        elif asset_type == 'gold':
+            return get_gold_price()
+        elif asset_type == 'crypto':
+            return get_crypto_price(symbol)
+        elif asset_type == 'investment_trust':
+            return get_investment_trust_price(symbol)
+        return 0
+    except Exception as e:
+        logger.error(f"Error in worker for {symbol} ({asset_type}): {e}")
+        return 0
+
+
+# 手動更新(/update_prices, /update_all_prices)の全体の期限。期限までに取得できた分だけ反映し、
+# 残りは古い相場のまま返す。夜間の一括更新には期限を設けない
+REFRESH_BUDGET_SECONDS = float(os.environ.get('REFRESH_BUDGET_SECONDS', '8'))
+# 期限切れで見捨てた取得が呼び出し元を待たせないよう、プールはリクエスト間で共有する
+_refresh_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('REFRESH_WORKERS', '20')), thread_name_prefix='refresh')
+
+
+def _fetch_quote(key):
+    FETCH_QUEUE_DEPTH.dec()
+    return key + (fetch_asset_price(*key),)
+
+
+def _store_late_quote(future):
+    """期限後に届いた相場も quotes に反映する(次の表示で使われる)"""
+    try:
+        quote = future.result()
+        if quote[2] is not None and quote[2] > 0:
+            conn = get_db()
+            update_prices_by_symbol(conn, [quote])
+            conn.close()
+    except Exception as e:
+        logger.error(f"Failed to store late quote: {e}")
+
 
+def refresh_quotes(keys, budget=None):
+    """(asset_type, symbol) の相場を取得し、届いた順に quotes へ書き込む
 
-def update_user_prices(user_id):
-    """特定ユーザーの全資産価格を更新"""
+    budget 秒を過ぎたら待つのをやめる(None なら全件を待つ)。戻り値は
+    (更新した (asset_type, symbol, price) のリスト, 更新できなかった key のリスト)。
+    期限に間に合わなかった取得は、未開始なら取り消し、実行中なら結果を後から反映する。
+    """
+    FETCH_QUEUE_DEPTH.inc(len(keys))
+    futures = {_refresh_executor.submit(profiling.bind(_fetch_quote), key): key for key in keys}
+    pending = set(futures)
+    prices = []
+    stale = []
+    conn = get_db()
+    c = conn.cursor()
+
+    def store(future):
+        pending.discard(future)
+        quote = future.result()
+        if quote[2] is not None and quote[2] > 0:
+            write_quotes(c, [quote])
+            conn.commit()
+            price_broker.publish([quote])
+            prices.append(quote)
+        else:
+            stale.append(futures[future])
+
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=budget):
+            store(future)
+    except concurrent.futures.TimeoutError:
+        # 期限の判定の後に終わったものは反映し、残りだけを見捨てる
+        late = 0
+        for future in list(pending):
+            if future.done():
+                store(future)
+                continue
+            if future.cancel():
+                FETCH_QUEUE_DEPTH.dec()
+            else:
+                future.add_done_callback(_store_late_quote)
+            stale.append(futures[future])
+            late += 1
+        logger.warning(f"Refresh budget {budget}s exceeded: {late}/{len(keys)} quotes left stale")
+    finally:
+        conn.close()
+    return prices, stale
+
+
+def update_user_prices(user_id, budget=None):
+    """特定ユーザーの保有銘柄の相場を更新(同じ銘柄は1回だけ取得、budget 秒を過ぎたら打ち切る)"""
     try:
         logger.info(f"Starting price update for user {user_id}")
         
         conn = get_db()
         c = conn.cursor()
-        asset_types_to_update = ['jp_stock', 'us_stock', 'gold', 'crypto', 'investment_trust']
+        asset_types_to_update = PRICED_ASSET_TYPES
         
         query_placeholder = ', '.join(['%s'] * len(asset_types_to_update)) if USE_POSTGRES else ', '.join(['?'] * len(asset_types_to_update))
         
         if USE_POSTGRES:
-            c.execute(f'SELECT id, symbol, asset_type FROM assets WHERE user_id = %s AND asset_type IN ({query_placeholder})',
+            c.execute(f'''SELECT DISTINCT asset_type, {QUOTE_SYMBOL_SQL.format(t='assets')} AS symbol FROM assets
+                          WHERE user_id = %s AND asset_type IN ({query_placeholder})''',
                       [user_id] + asset_types_to_update)
         else:
-            c.execute(f'SELECT id, symbol, asset_type FROM assets WHERE user_id = ? AND asset_type IN ({query_placeholder})',
+            c.execute(f'''SELECT DISTINCT asset_type, {QUOTE_SYMBOL_SQL.format(t='assets')} AS symbol FROM assets
+                          WHERE user_id = ? AND asset_type IN ({query_placeholder})''',
                       [user_id] + asset_types_to_update)
         
-        all_assets = c.fetchall()
+        instruments = [(row['asset_type'], row['symbol']) for row in c.fetchall()]
+        conn.close()
         
-        if not all_assets:
+        if not instruments:
             logger.info(f"No assets to update for user {user_id}")
-            conn.close()
             return 0
 
-        def fetch_price(asset):
-            asset_type, symbol = asset['asset_type'], asset['symbol']
-            price = 0
-            try:
-                if asset_type == 'jp_stock': 
-                    price = get_stock_price(symbol, is_jp=True)
-                elif asset_type == 'us_stock': 
-                    price = get_stock_price(symbol, is_jp=False)
-                elif asset_type == 'gold': 
-                    price = get_gold_price()
-                elif asset_type == 'crypto': 
-                    price = get_crypto_price(symbol)
-                elif asset_type == 'investment_trust': 
-                    price = get_investment_trust_price(symbol)
-                return (asset['id'], price)
-            except Exception as e:
-                logger.error(f"Error in worker for {symbol} ({asset_type}): {e}")
-                return (asset['id'], 0)
-
-        updated_prices = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-            results = executor.map(fetch_price, all_assets)
-            updated_prices = [
-                (res[1], res[0]) for res in results if res and res[1] is not None and res[1] > 0
-            ]
-
-        if updated_prices:
-            logger.info(f"Updating {len(updated_prices)} assets in the database for user {user_id}...")
-            if USE_POSTGRES:
-                update_query = "UPDATE assets SET price = data.price FROM (VALUES %s) AS data(price, id) WHERE assets.id = data.id"
-                execute_values(c, update_query, updated_prices)
-            else:
-                c.executemany('UPDATE assets SET price = ? WHERE id = ?', updated_prices)
-
-        conn.commit()
-        conn.close()
+        prices, stale = refresh_quotes(instruments, budget)
         
-        logger.info(f"Price update completed for user {user_id}: {len(updated_prices)}/{len(all_assets)} assets updated")
-        return len(updated_prices)
+        logger.info(f"Price update completed for user {user_id}: {len(prices)}/{len(instruments)} instruments updated"
+                    f"{f' ({len(stale)} stale)' if stale else ''}")
+        return len(prices)
         
     except Exception as e:
         logger.error(f"Error updating prices for user {user_id}: {e}")
         return 0
 
 
-def scheduled_update_all_prices():
-    """スケジュール実行: 全ユーザーの資産価格を更新し、スナップショットを記録"""
+def quote_source(asset_type, symbol):
+    """相場の取得元(株は Yahoo、それ以外はレジストリの source)"""
+    if asset_type in ('jp_stock', 'us_stock'):
+        return 'yahoo'
+    instrument = instrument_registry.get(asset_type, symbol)
+    return instrument.source if instrument else None
+
+
+def write_quotes(c, prices):
+    """(asset_type, symbol, price[, name]) のリストを quotes に upsert し、当日の quote_history も更新"""
+    jst = timezone(timedelta(hours=9))
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    today = datetime.now(jst).date()
+    latest = {}
+    for quote in prices:
+        asset_type, symbol, price = quote[:3]
+        name = quote[3] if len(quote) > 3 else None
+        # 金は銘柄名によらず1件
+        if asset_type == 'gold':
+            symbol = ''
+        # 株の銘柄名は取得時に索引へ登録されている
+        if name is None and asset_type in ('jp_stock', 'us_stock'):
+            ticker = stock_index.get(asset_type, symbol)
+            name = ticker.name if ticker else None
+        latest[(asset_type, symbol)] = (price, name)
+
+    quote_rows = [(asset_type, symbol, price, name, quote_source(asset_type, symbol), now)
+                  for (asset_type, symbol), (price, name) in latest.items()]
+    history_rows = [(asset_type, symbol, today, price) for (asset_type, symbol), (price, _) in latest.items()]
+    if USE_POSTGRES:
+        from psycopg2.extras import execute_values
+        execute_values(c, '''INSERT INTO quotes (asset_type, symbol, price, name, source, as_of) VALUES %s
+                             ON CONFLICT (asset_type, symbol) DO UPDATE SET
+                                 price = EXCLUDED.price,
+                                 name = COALESCE(EXCLUDED.name, quotes.name),
+                                 source = COALESCE(EXCLUDED.source, quotes.source),
+                                 as_of = EXCLUDED.as_of''', quote_rows)
+        execute_values(c, '''INSERT INTO quote_history (asset_type, symbol, quote_date, price) VALUES %s
+                             ON CONFLICT (asset_type, symbol, quote_date) DO UPDATE SET price = EXCLUDED.price''',
+                       history_rows)
+    else:
+        c.executemany('''INSERT INTO quotes (asset_type, symbol, price, name, source, as_of) VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (asset_type, symbol) DO UPDATE SET
+                             price = excluded.price,
+                             name = COALESCE(excluded.name, quotes.name),
+                             source = COALESCE(excluded.source, quotes.source),
+                             as_of = excluded.as_of''', quote_rows)
+        c.executemany('''INSERT OR REPLACE INTO quote_history (asset_type, symbol, quote_date, price)
+                         VALUES (?, ?, ?, ?)''', history_rows)
+
+
+def load_distinct_symbols(asset_types=None):
+    """全ユーザーの保有銘柄を (asset_type, symbol) で重複排除して取得"""
+    asset_types = asset_types or PRICED_ASSET_TYPES
+    conn = get_db()
+    c = conn.cursor()
+    placeholder = '%s' if USE_POSTGRES else '?'
+    types_placeholder = ', '.join([placeholder] * len(asset_types))
+    c.execute(f'SELECT DISTINCT asset_type, symbol FROM assets WHERE asset_type IN ({types_placeholder})',
+              list(asset_types))
+    rows = c.fetchall()
+    conn.close()
+
+    keys = set()
+    for row in rows:
+        # 金の価格は銘柄名に依存しないため1件にまとめる
+        symbol = '' if row['asset_type'] == 'gold' else row['symbol']
+        keys.add((row['asset_type'], symbol))
+    return sorted(keys)
+
+
+def update_prices_by_symbol(conn, prices):
+    """(asset_type, symbol, price) のリストで銘柄ごとの相場を更新(保有者数によらず1銘柄1行)"""
+    c = conn.cursor()
+    if prices:
+        write_quotes(c, prices)
+    conn.commit()
+    price_broker.publish(prices)
+
+
+# 銘柄ごとの最終取得時刻(UTC)。市場が閉じたままなら再取得しない
+_last_fetched = {}
+_last_fetched_lock = threading.Lock()
+
+
+def is_symbol_due(asset_type, symbol, last_fetched, now):
+    """市場が開いていて、レジストリで銘柄ごとの更新間隔が指定されていればそれも過ぎているか"""
+    if not is_refresh_due(asset_type, last_fetched, now):
+        return False
+    if asset_type not in REGISTERED_ASSET_TYPES:
+        return True
+    instrument = instrument_registry.get(asset_type, symbol)
+    if instrument is None:
+        return False
+    if instrument.cadence_minutes and last_fetched is not None:
+        return now - last_fetched >= timedelta(minutes=instrument.cadence_minutes)
+    return True
+
+
+def refresh_asset_class(asset_type, force=False, run=None):
+    """資産クラス単位で、前回取得以降に市場が開いた銘柄だけ価格を更新
+
+    run(夜間ジョブの実行記録)を渡すと、チェックポイント済みの銘柄を飛ばし、
+    JOB_CHECKPOINT_BATCH 件ごとに結果を書き込んでチェックポイントを残す。
+    """
+    now = datetime.now(timezone.utc)
+    keys = load_distinct_symbols([asset_type])
+    if run is not None:
+        keys = [k for k in keys if job_item_key('symbol', *k) not in run['done']]
+    with _last_fetched_lock:
+        due = [k for k in keys if force or is_symbol_due(k[0], k[1], _last_fetched.get(k), now)]
+
+    if run is not None and len(due) < len(keys):
+        # 市場が閉じたままの銘柄は取得済みと同じ扱い
+        due_set = set(due)
+        checkpoint_job(run, [job_item_key('symbol', *k) for k in keys if k not in due_set])
+
+    if not due:
+        if keys:
+            logger.info(f"Skipping {asset_type} refresh: market closed since last fetch ({len(keys)} symbols)")
+        return 0
+
+    def fetch(key):
+        FETCH_QUEUE_DEPTH.dec()
+        return key[0], key[1], fetch_asset_price(key[0], key[1])
+
+    batch_size = JOB_CHECKPOINT_BATCH if run is not None else len(due)
+    updated = 0
+    for start in range(0, len(due), batch_size):
+        batch = due[start:start + batch_size]
+        FETCH_QUEUE_DEPTH.inc(len(batch))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(fetch, batch))
+        prices = [r for r in results if r[2] is not None and r[2] > 0]
+
+        if prices:
+            conn = get_db()
+            update_prices_by_symbol(conn, prices)
+            conn.close()
+
+        with _last_fetched_lock:
+            for asset_type_, symbol, _ in prices:
+                _last_fetched[(asset_type_, symbol)] = now
+
+        if run is not None:
+            checkpoint_job(run, [job_item_key('symbol', r[0], r[1]) for r in prices],
+                           [job_item_key('symbol', r[0], r[1]) for r in results if not (r[2] and r[2] > 0)])
+        updated += len(prices)
+
+    logger.info(f"Tiered refresh for {asset_type}: {updated}/{len(due)} symbols updated "
+                f"({len(keys) - len(due)} skipped)")
+    return updated
+
+
+# ログイン時の先読み(保有銘柄の相場と為替を裏で取得しておく)
+PREFETCH_ON_LOGIN = os.environ.get('PREFETCH_ON_LOGIN', '1') == '1'
+PREFETCH_MAX_AGE = float(os.environ.get('PREFETCH_MAX_AGE', '300'))
+_prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('PREFETCH_WORKERS', '2')), thread_name_prefix='prefetch')
+_prefetch_pending = set()
+_prefetch_lock = threading.Lock()
+
+
+def _as_utc(value):
+    """quotes.as_of(UTC の naive な日時、SQLite では文字列)を aware な datetime に"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.replace(tzinfo=timezone.utc)
+
+
+def stale_user_quotes(user_id, now):
+    """ユーザーの保有銘柄のうち、相場が古く市場も開いていたもの"""
+    conn = get_db(readonly=True)
+    c = conn.cursor()
+    placeholder = '%s' if USE_POSTGRES else '?'
+    types_placeholder = ', '.join([placeholder] * len(PRICED_ASSET_TYPES))
+    c.execute(f'''SELECT DISTINCT a.asset_type, {QUOTE_SYMBOL_SQL.format(t='a')} AS symbol, q.as_of
+                  FROM assets a
+                  LEFT JOIN quotes q ON q.asset_type = a.asset_type AND q.symbol = {QUOTE_SYMBOL_SQL.format(t='a')}
+                  WHERE a.user_id = {placeholder} AND a.asset_type IN ({types_placeholder})''',
+              [user_id] + PRICED_ASSET_TYPES)
+    rows = c.fetchall()
+    conn.close()
+
+    stale = []
+    with _last_fetched_lock:
+        for row in rows:
+            key = (row['asset_type'], row['symbol'])
+            as_of = _as_utc(row['as_of'])
+            if as_of is not None and (now - as_of).total_seconds() < PREFETCH_MAX_AGE:
+                continue
+            if is_symbol_due(key[0], key[1], _last_fetched.get(key) or as_of, now):
+                stale.append(key)
+    return stale
+
+
+def prefetch_user_quotes(user_id):
+    """保有銘柄の相場と必要な為替レートを取得して quotes に書き込む"""
+    now = datetime.now(timezone.utc)
+    try:
+        keys = stale_user_quotes(user_id, now)
+        # 他のログインの先読みで取得中の銘柄は除く(ワーカー間の重複は共有ストアが防ぐ)
+        with _prefetch_lock:
+            keys = [k for k in keys if k not in _prefetch_pending]
+            _prefetch_pending.update(keys)
+        try:
+            fx_rates.rates_for(currencies_of({asset_type for asset_type, _ in keys}))
+            prices = [(asset_type, symbol, fetch_asset_price(asset_type, symbol)) for asset_type, symbol in keys]
+            prices = [p for p in prices if p[2] is not None and p[2] > 0]
+            if prices:
+                conn = get_db()
+                update_prices_by_symbol(conn, prices)
+                conn.close()
+                with _last_fetched_lock:
+                    for asset_type, symbol, _ in prices:
+                        _last_fetched[(asset_type, symbol)] = now
+        finally:
+            with _prefetch_lock:
+                _prefetch_pending.difference_update(keys)
+        logger.info(f"Prefetched {len(prices)}/{len(keys)} quotes for user {user_id}")
+        return len(prices)
+    except Exception as e:
+        logger.error(f"Quote prefetch failed for user {user_id}: {e}")
+        return 0
+
+
+def schedule_prefetch(user_id):
+    """ログイン処理を待たせずに先読みを始める"""
+    if PREFETCH_ON_LOGIN:
+        _prefetch_executor.submit(prefetch_user_quotes, user_id)
+
+
+# 夜間ジョブ
+NIGHTLY_JOB = 'nightly_prices'
+# この秒数ハートビートが途絶えた実行中の記録は、落ちたものとみなして引き継ぐ
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', '600'))
+# 失敗した項目が残った実行を再試行するまでの秒数と、試行回数の上限
+JOB_RETRY_SECONDS = float(os.environ.get('JOB_RETRY_SECONDS', '1800'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_CHECKPOINT_BATCH = int(os.environ.get('JOB_CHECKPOINT_BATCH', '100'))
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def job_item_key(kind, *parts):
+    """チェックポイントの項目キー(例: symbol:jp_stock:7203 / user:12 / snapshots)"""
+    return ':'.join((kind,) + tuple(str(p) for p in parts))
+
+
+def begin_job_run(job_name, run_date):
+    """run_date の実行を開始(途中で止まっていれば再開)。完了済み、または他のプロセスが実行中なら None
+
+    戻り値の run は id / run_date / done(チェックポイント済みの項目キー)などを持つ dict。
+    """
+    placeholder = '%s' if USE_POSTGRES else '?'
+    now = _utcnow()
+    conn = get_db()
+    c = conn.cursor()
+    if USE_POSTGRES:
+        c.execute('''INSERT INTO job_runs (job_name, run_date, status) VALUES (%s, %s, 'pending')
+                     ON CONFLICT (job_name, run_date) DO NOTHING''', (job_name, run_date))
+    else:
+        c.execute("INSERT OR IGNORE INTO job_runs (job_name, run_date, status) VALUES (?, ?, 'pending')",
+                  (job_name, run_date))
+    c.execute(f'''UPDATE job_runs SET status = 'running', started_at = COALESCE(started_at, {placeholder}),
+                      last_heartbeat = {placeholder}, attempts = attempts + 1
+                  WHERE job_name = {placeholder} AND run_date = {placeholder}
+                    AND (status IN ('pending', 'partial', 'failed')
+                         OR (status = 'running' AND last_heartbeat < {placeholder}))''',
+              (now, now, job_name, run_date, now - timedelta(seconds=JOB_STALE_SECONDS)))
+    claimed = c.rowcount == 1
+    c.execute(f'''SELECT id, status, duration_seconds, attempts FROM job_runs
+                  WHERE job_name = {placeholder} AND run_date = {placeholder}''', (job_name, run_date))
+    row = c.fetchone()
+    done = set()
+    if claimed:
+        c.execute(f"SELECT item_key FROM job_checkpoints WHERE run_id = {placeholder} AND status = 'done'",
+                  (row['id'],))
+        done = {r['item_key'] for r in c.fetchall()}
+    conn.commit()
+    conn.close()
+
+    if not claimed:
+        logger.info(f"Skipping {job_name} for {run_date}: {row['status']}")
+        return None
+    if row['attempts'] > 1:
+        logger.info(f"Resuming {job_name} for {run_date} (attempt {row['attempts']}, {len(done)} items already done)")
+    return {'id': row['id'], 'job_name': job_name, 'run_date': run_date, 'done': done, 'failed': set(),
+            'attempts': row['attempts'], 'duration': row['duration_seconds'] or 0, 'resumed_at': time.monotonic()}
+
+
+def _job_duration(run):
+    """これまでの試行を合わせた実行時間"""
+    return run['duration'] + (time.monotonic() - run['resumed_at'])
+
+
+def checkpoint_job(run, done_keys=(), failed_keys=(), total_items=None):
+    """項目の結果を記録し、実行記録の進捗とハートビートを更新"""
+    placeholder = '%s' if USE_POSTGRES else '?'
+    now = _utcnow()
+    rows = ([(run['id'], key, 'done', now) for key in done_keys] +
+            [(run['id'], key, 'failed', now) for key in failed_keys])
+    conn = get_db()
+    c = conn.cursor()
+    if rows:
+        if USE_POSTGRES:
+            from psycopg2.extras import execute_values
+            execute_values(c, '''INSERT INTO job_checkpoints (run_id, item_key, status, updated_at) VALUES %s
+                                 ON CONFLICT (run_id, item_key) DO UPDATE SET
+                                     status = EXCLUDED.status, updated_at = EXCLUDED.updated_at,
+                                     attempts = job_checkpoints.attempts + 1''', rows)
+        else:
+            c.executemany('''INSERT INTO job_checkpoints (run_id, item_key, status, updated_at) VALUES (?, ?, ?, ?)
+                             ON CONFLICT (run_id, item_key) DO UPDATE SET
+                                 status = excluded.status, updated_at = excluded.updated_at,
+                                 attempts = job_checkpoints.attempts + 1''', rows)
+    c.execute(f'''UPDATE job_runs SET last_heartbeat = {placeholder}, duration_seconds = {placeholder},
+                      total_items = COALESCE({placeholder}, total_items),
+                      done_items = (SELECT COUNT(*) FROM job_checkpoints
+                                    WHERE run_id = {placeholder} AND status = 'done'),
+                      error_count = (SELECT COUNT(*) FROM job_checkpoints
+                                     WHERE run_id = {placeholder} AND status = 'failed')
+                  WHERE id = {placeholder}''',
+              (now, _job_duration(run), total_items, run['id'], run['id'], run['id']))
+    conn.commit()
+    conn.close()
+    run['done'].update(done_keys)
+    run['failed'].difference_update(done_keys)
+    run['failed'].update(failed_keys)
+
+
+def finish_job_run(run, status=None):
+    """実行を終える。status を省略すると、この試行で失敗した項目があれば partial
+    (スナップショットの記録に失敗していれば failed)、なければ completed にする。戻り値は status
+    """
+    if status is None:
+        if 'snapshots' in run['failed']:
+            status = 'failed'
+        elif run['failed']:
+            status = 'partial'
+        else:
+            status = 'completed'
+    placeholder = '%s' if USE_POSTGRES else '?'
+    now = _utcnow()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(f'''UPDATE job_runs SET status = {placeholder}, finished_at = {placeholder},
+                      last_heartbeat = {placeholder}, duration_seconds = {placeholder}
+                  WHERE id = {placeholder}''', (status, now, now, _job_duration(run), run['id']))
+    conn.commit()
+    conn.close()
+    if status != 'completed':
+        logger.warning(f"{run['job_name']} for {run['run_date']} finished as {status} "
+                       f"({len(run['failed'])} items failed, attempt {run['attempts']})")
+    return status
+
+
+def _as_date(value):
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _as_naive_utc(value):
+    """job_runs の日時(UTC の naive な日時、SQLite では文字列)"""
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def find_unfinished_runs(job_name, since, run_date=None):
+    """since 以降(run_date を指定するとその日だけ)で完了していない実行
+
+    各要素は run_date / status / last_heartbeat / attempts を持つ dict。
+    """
+    placeholder = '%s' if USE_POSTGRES else '?'
+    query = f'''SELECT run_date, status, last_heartbeat, attempts FROM job_runs
+                 WHERE job_name = {placeholder} AND run_date >= {placeholder} AND status != 'completed' '''
+    params = [job_name, since]
+    if run_date is not None:
+        query += f' AND run_date = {placeholder}'
+        params.append(run_date)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute(query + ' ORDER BY run_date', params)
+    runs = [{'run_date': _as_date(row['run_date']), 'status': row['status'],
+             'last_heartbeat': _as_naive_utc(row['last_heartbeat']), 'attempts': row['attempts']}
+            for row in c.fetchall()]
+    conn.close()
+    return runs
+
+
+def scheduled_update_all_prices(run_date=None):
+    """スケジュール実行: 全ユーザーの資産価格を更新し、スナップショットを記録
+
+    実行は job_runs に記録し、銘柄(ユーザー)ごとにチェックポイントを残す。
+    同じ run_date で再実行すると、チェックポイントのない分だけを処理する。
+    """
+    jst = timezone(timedelta(hours=9))
+    run_date = run_date or datetime.now(jst).date()
+    run = begin_job_run(NIGHTLY_JOB, run_date)
+    if run is None:
+        return
     try:
         logger.info("=" * 50)
-        logger.info("Starting scheduled price update for all users")
+        logger.info(f"Starting scheduled price update for all users ({run_date})")
         logger.info("=" * 50)
         
         conn = get_db()
@@ -687,60 +2259,276 @@ def scheduled_update_all_prices():
         
         if not users:
             logger.warning("No users found in database")
+            finish_job_run(run)
             return
         
         logger.info(f"Found {len(users)} users to update")
         
         total_updated = 0
-        for user in users:
-            user_id = user['id']
-            username = user['username']
-            
-            logger.info(f"Processing user: {username} (ID: {user_id})")
-            
-            # 価格を更新
-            updated_count = update_user_prices(user_id)
-            total_updated += updated_count
-            
-            # スナップショットを記録
+        if TIERED_REFRESH:
+            checkpoint_job(run, total_items=len(load_distinct_symbols()) + 1)
+            # 銘柄単位でまとめて更新(前回取得以降に市場が閉じたままの銘柄は取得しない)
+            for asset_type in PRICED_ASSET_TYPES:
+                total_updated += refresh_asset_class(asset_type, run=run)
+        else:
+            checkpoint_job(run, total_items=len(users) + 1)
+            for user in users:
+                key = job_item_key('user', user['id'])
+                if key in run['done']:
+                    continue
+                logger.info(f"Processing user: {user['username']} (ID: {user['id']})")
+                total_updated += update_user_prices(user['id'])
+                checkpoint_job(run, [key])
+                # レート制限を避けるため、ユーザー間で少し待機
+                time.sleep(2)
+
+        # スナップショットを全ユーザー分まとめて記録(日付は実行日のまま)。
+        # 再試行で価格を更新できた場合は、記録済みでも取り直す
+        if 'snapshots' not in run['done'] or (run['attempts'] > 1 and total_updated):
             try:
-                record_asset_snapshot(user_id)
-                logger.info(f"Asset snapshot recorded for user {username}")
+                record_all_snapshots(run_date)
+                checkpoint_job(run, ['snapshots'])
             except Exception as e:
-                logger.error(f"Failed to record snapshot for user {username}: {e}")
-            
-            # レート制限を避けるため、ユーザー間で少し待機
-            time.sleep(2)
+                logger.error(f"Failed to record asset snapshots: {e}")
+                checkpoint_job(run, failed_keys=['snapshots'])
         
+        status = finish_job_run(run)
         logger.info("=" * 50)
-        logger.info(f"Scheduled update completed: {total_updated} assets updated across {len(users)} users")
+        logger.info(f"Scheduled update {status}: {total_updated} assets updated across {len(users)} users "
+                    f"in {_job_duration(run):.1f}s")
         logger.info("=" * 50)
+        if status != 'completed':
+            retry_unfinished_run(run_date)
         
     except Exception as e:
         logger.error(f"Critical error in scheduled_update_all_prices: {e}", exc_info=True)
+        finish_job_run(run, 'failed')
+        retry_unfinished_run(run_date)
+
 
+def schedule_job_resume(run_date, when=None):
+    """run_date の夜間ジョブの再開を when(UTC の aware な日時、None なら今すぐ)に予約する"""
+    if scheduler is None:
+        logger.info(f"No scheduler in this process; {NIGHTLY_JOB} for {run_date} resumes on the next leader start")
+        return
+    logger.info(f"Scheduling resume of {NIGHTLY_JOB} for {run_date}" + (f" at {when.isoformat()}" if when else ""))
+    scheduler.add_job(
+        func=resume_job_run,
+        args=[run_date],
+        trigger='date',
+        run_date=when,
+        id=f'resume_{NIGHTLY_JOB}_{run_date}',
+        name=f'Resume {NIGHTLY_JOB} for {run_date}',
+        replace_existing=True
+    )
 
-# スケジューラーの初期化
-scheduler = BackgroundScheduler(timezone='Asia/Tokyo')
 
-# 毎日23:58に実行
-scheduler.add_job(
-    func=scheduled_update_all_prices,
-    trigger=CronTrigger(hour=23, minute=58, timezone='Asia/Tokyo'),
-    id='daily_price_update',
-    name='Daily Price Update at 23:58 JST',
-    replace_existing=True
-)
+def retry_unfinished_run(run_date):
+    """run_date の夜間ジョブが完了していなければ、再開を予約する(JOB_MAX_ATTEMPTS 回まで)
+
+    partial / failed で終わった実行は JOB_RETRY_SECONDS 後に再試行する。running のまま
+    (実行していたプロセスが落ちた)ならすぐに予約し、resume_job_run がハートビートを見て待つ。
+    """
+    runs = find_unfinished_runs(NIGHTLY_JOB, run_date, run_date)
+    if not runs:
+        return
+    run = runs[0]
+    if run['attempts'] >= JOB_MAX_ATTEMPTS:
+        logger.warning(f"Giving up on {NIGHTLY_JOB} for {run_date}: {run['status']} after {run['attempts']} attempts")
+        return
+    if run['status'] == 'running':
+        schedule_job_resume(run_date)
+    else:
+        schedule_job_resume(run_date, datetime.now(timezone.utc) + timedelta(seconds=JOB_RETRY_SECONDS))
+
+
+def resume_job_run(run_date):
+    """止まった夜間ジョブを再開する
+
+    記録が running のままでもハートビートが新しいうちは引き継げないので(落ちた直後の再起動など)、
+    ハートビートが JOB_STALE_SECONDS を過ぎる時刻に改めて予約する。
+    """
+    runs = find_unfinished_runs(NIGHTLY_JOB, run_date, run_date)
+    if not runs:
+        return
+    run = runs[0]
+    if run['attempts'] >= JOB_MAX_ATTEMPTS and run['status'] in ('partial', 'failed'):
+        logger.warning(f"Giving up on {NIGHTLY_JOB} for {run_date}: {run['status']} after {run['attempts']} attempts")
+        return
+    heartbeat = run['last_heartbeat']
+    if run['status'] == 'running' and heartbeat is not None:
+        stale_at = heartbeat + timedelta(seconds=JOB_STALE_SECONDS)
+        if stale_at > _utcnow():
+            schedule_job_resume(run_date, (stale_at + timedelta(seconds=5)).replace(tzinfo=timezone.utc))
+            return
+    daily_price_update(run_date)
+
+
+def resume_unfinished_runs():
+    """前日以降の夜間ジョブが途中で止まっていれば、未完了の分の再開を予約する"""
+    jst = timezone(timedelta(hours=9))
+    since = datetime.now(jst).date() - timedelta(days=1)
+    try:
+        runs = find_unfinished_runs(NIGHTLY_JOB, since)
+    except Exception as e:
+        logger.error(f"Failed to look up unfinished runs: {e}")
+        return
+    for run in runs:
+        schedule_job_resume(run['run_date'])
+
+
+# 夜間更新を別プロセスのランナーに任せる場合のプロセス数(0ならWebプロセス内で実行)
+REFRESH_PROCESSES = int(os.environ.get('REFRESH_PROCESSES', '0'))
+
+# 資産クラスごとの定期更新(market_calendar.MARKET_SCHEDULES の間隔で実行)
+TIERED_REFRESH = os.environ.get('TIERED_REFRESH', '1') == '1'
+
+# create_app() でスケジューラー(リーダー選出)を起動しない
+SCHEDULER_DISABLED = os.environ.get('DISABLE_SCHEDULER', '0') == '1'
+
+
+def daily_price_update(run_date=None):
+    """日次ジョブ: 設定に応じてランナーを起動するか、プロセス内で更新する"""
+    if REFRESH_PROCESSES > 0:
+        import subprocess
+        import sys
+        run_date = run_date or datetime.now(timezone(timedelta(hours=9))).date()
+        runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'refresh_runner.py')
+        logger.info(f"Launching refresh runner with {REFRESH_PROCESSES} processes")
+        command = [sys.executable, runner, '--processes', str(REFRESH_PROCESSES), '--run-date', run_date.isoformat()]
+        # ランナーの終了を待ち、完了していなければプロセス内で実行した場合と同じく再試行を予約する
+        returncode = subprocess.Popen(command).wait()
+        if returncode != 0:
+            logger.error(f"Refresh runner for {run_date} exited with status {returncode}")
+        retry_unfinished_run(run_date)
+        return
+    scheduled_update_all_prices(run_date)
+
+
+# スケジューラー(リーダーに選ばれたプロセスで初めて作成する)
+scheduler = None
+
+
+def build_scheduler():
+    """定期ジョブを登録したスケジューラーを作成"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.triggers.cron import CronTrigger
+    from apscheduler.triggers.interval import IntervalTrigger
+
+    sched = BackgroundScheduler(timezone='Asia/Tokyo')
+
+    # 毎日23:58に実行
+    sched.add_job(
+        func=daily_price_update,
+        trigger=CronTrigger(hour=23, minute=58, timezone='Asia/Tokyo'),
+        id='daily_price_update',
+        name='Daily Price Update at 23:58 JST',
+        replace_existing=True
+    )
+
+    # 資産クラスごとの定期更新(市場が閉じている間は銘柄単位でスキップされる)
+    if TIERED_REFRESH:
+        for asset_type, schedule in MARKET_SCHEDULES.items():
+            sched.add_job(
+                func=refresh_asset_class,
+                args=[asset_type],
+                trigger=IntervalTrigger(minutes=schedule.cadence_minutes, timezone='Asia/Tokyo'),
+                id=f'refresh_{asset_type}',
+                name=f'Tiered refresh for {asset_type} every {schedule.cadence_minutes} min',
+                replace_existing=True,
+                coalesce=True,
+                max_instances=1
+            )
+
+    # Render のスリープ防止(デプロイ全体で1プロセスだけが送ればよい)
+    if os.environ.get('RENDER') and os.environ.get('RENDER_EXTERNAL_URL'):
+        sched.add_job(
+            func=keep_alive,
+            trigger=IntervalTrigger(seconds=840),
+            id='keep_alive',
+            name='Keep-alive ping for Render',
+            replace_existing=True
+        )
+
+    return sched
+
+
+def start_scheduler():
+    """リーダーに選ばれたプロセスでスケジューラーを開始(再開)"""
+    global scheduler
+    try:
+        if scheduler is None:
+            scheduler = build_scheduler()
+        if scheduler.running:
+            scheduler.resume()
+        else:
+            scheduler.start()
+        logger.info("Scheduler started successfully. Daily updates scheduled for 23:58 JST")
+        resume_unfinished_runs()
+    except Exception as e:
+        logger.error(f"Failed to start scheduler: {e}")
+
+
+def pause_scheduler():
+    """リーダーでなくなったプロセスのジョブを止める"""
+    if scheduler is not None and scheduler.running:
+        scheduler.pause()
+        logger.info("Scheduler paused: leadership lost")
+
+
+def shutdown_scheduler():
+    """終了時にリーダーロックとスケジューラーを解放"""
+    if leader_election is not None:
+        leader_election.stop()
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown()
+
+
+def start_leader_election():
+    """複数ワーカーのうちロックを取得した1プロセスだけがスケジューラーを動かす"""
+    global leader_election
+    if USE_POSTGRES:
+        leader_lock = PostgresLeaderLock(DATABASE_URL)
+    else:
+        leader_lock = FileLeaderLock(os.environ.get('SCHEDULER_LOCK_FILE', 'portfolio.db.scheduler.lock'))
+    leader_election = LeaderElection(
+        leader_lock,
+        on_elected=start_scheduler,
+        on_demoted=pause_scheduler,
+        interval=int(os.environ.get('SCHEDULER_LEADER_INTERVAL', '30'))
+    )
+    leader_election.start()
+
+
+leader_election = None
+_app_initialized = False
 
-# スケジューラー開始
-try:
-    scheduler.start()
-    logger.info("Scheduler started successfully. Daily updates scheduled for 23:58 JST")
-except Exception as e:
-    logger.error(f"Failed to start scheduler: {e}")
 
+def create_app():
+    """
+    アプリケーションファクトリ。
+    スキーマ確認・リーダー選出などの副作用は import 時ではなくここで1回だけ行う。
+    """
+    global _app_initialized
+    if _app_initialized:
+        return app
+    _app_initialized = True
+
+    ensure_db_initialized()
+
+    if not SCHEDULER_DISABLED:
+        start_leader_election()
+        atexit.register(shutdown_scheduler)
+
+    return app
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """デプロイ時にスキーマを初期化する(flask --app app init-db)"""
+    init_db()
+    logger.info(f"Database initialized (schema version {SCHEMA_VERSION})")
 
-init_db()
 
 @app.route('/')
 def index():
@@ -750,6 +2538,7 @@ def index():
     return redirect(url_for('dashboard'))
 
 @app.route('/register', methods=['GET', 'POST'])
+@writes_user_data
 def register():
     if request.method == 'POST':
         username = request.form['username'].strip()
@@ -790,6 +2579,7 @@ def register():
                 
                 conn.commit()
                 conn.close()
+                invalidate_user_cache()
                 
                 flash('アカウントを作成しました。ログインしてください。', 'success')
                 return redirect(url_for('login'))
@@ -802,7 +2592,7 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = get_db()
+        conn = get_db(readonly=True)
         c = conn.cursor()
         
         if USE_POSTGRES:
@@ -814,8 +2604,10 @@ def login():
         conn.close()
         
         if user and check_password_hash(user['password_hash'], password):
+            cache_user(user)
             session['user_id'] = user['id']
             session['username'] = user['username']
+            schedule_prefetch(user['id'])
             flash('ログインしました', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -835,20 +2627,17 @@ def dashboard():
     if not user:
         return redirect(url_for('login'))
     
-    conn = get_db()
-    c = conn.cursor()
-    
-    asset_types = ['jp_stock', 'us_stock', 'cash', 'gold', 'crypto', 'investment_trust', 'insurance']
-    assets = {}
+    holdings = load_holdings(user['id'])
+    assets = {asset_type: [] for asset_type in ASSET_TYPES}
+    for h in holdings:
+        if h.asset_type in assets:
+            assets[h.asset_type].append(h)
+    portfolio = Portfolio.from_rows(holdings)
+    totals = portfolio.totals(fx_rates.rates_for(portfolio.currencies()))
+    profits = {asset_type: value - cost for asset_type, (value, cost) in totals.items()}
 
-    for asset_type in asset_types:
-        if USE_POSTGRES:
-            c.execute('''SELECT * FROM assets WHERE user_id = %s AND asset_type = %s''', 
-                      (user['id'], asset_type))
-        else:
-            c.execute('''SELECT * FROM assets WHERE user_id = ? AND asset_type = ?''', 
-                      (user['id'], asset_type))
-        assets[asset_type] = c.fetchall()
+    conn = get_db(readonly=True)
+    c = conn.cursor()
     
     # 資産履歴を取得(過去30日分)
     if USE_POSTGRES:
@@ -866,43 +2655,30 @@ def dashboard():
     conn.close()
     
     jp_stocks = assets['jp_stock']
-    jp_total = sum(s['quantity'] * s['price'] for s in jp_stocks)
-    jp_cost = sum(s['quantity'] * s['avg_cost'] for s in jp_stocks)
-    jp_profit = jp_total - jp_cost
+    jp_total, jp_profit = totals['jp_stock'][0], profits['jp_stock']
 
+    # 米国株はドル建ての合計も表示する
     us_stocks = assets['us_stock']
-    usd_jpy = get_usd_jpy_rate()
-    us_total_usd = sum(s['quantity'] * s['price'] for s in us_stocks)
-    us_cost_usd = sum(s['quantity'] * s['avg_cost'] for s in us_stocks)
-    us_profit_usd = us_total_usd - us_cost_usd
-    us_total_jpy = us_total_usd * usd_jpy
-    us_profit_jpy = us_profit_usd * usd_jpy
+    us_total_usd = sum(h.value for h in us_stocks)
+    us_total_jpy, us_profit_jpy = totals['us_stock'][0], profits['us_stock']
 
     cash_items = assets['cash']
-    cash_total = sum(i['quantity'] for i in cash_items)
+    cash_total = totals['cash'][0]
     
     gold_items = assets['gold']
-    gold_total = sum(i['quantity'] * i['price'] for i in gold_items)
-    gold_cost = sum(i['quantity'] * i['avg_cost'] for i in gold_items)
-    gold_profit = gold_total - gold_cost
+    gold_total, gold_profit = totals['gold'][0], profits['gold']
 
     crypto_items = assets['crypto']
-    crypto_total = sum(i['quantity'] * i['price'] for i in crypto_items)
-    crypto_cost = sum(i['quantity'] * i['avg_cost'] for i in crypto_items)
-    crypto_profit = crypto_total - crypto_cost
+    crypto_total, crypto_profit = totals['crypto'][0], profits['crypto']
 
     investment_trust_items = assets['investment_trust']
-    it_total = sum((i['quantity'] * i['price'] / 10000) for i in investment_trust_items)
-    it_cost = sum((i['quantity'] * i['avg_cost'] / 10000) for i in investment_trust_items)
-    it_profit = it_total - it_cost
+    it_total, it_profit = totals['investment_trust'][0], profits['investment_trust']
 
     insurance_items = assets['insurance']
-    insurance_total = sum(i['price'] for i in insurance_items)
-    insurance_cost = sum(i['avg_cost'] for i in insurance_items)
-    insurance_profit = insurance_total - insurance_cost
+    insurance_total, insurance_profit = totals['insurance'][0], profits['insurance']
 
-    total_assets = jp_total + us_total_jpy + cash_total + gold_total + crypto_total + it_total + insurance_total
-    total_profit = jp_profit + us_profit_jpy + gold_profit + crypto_profit + it_profit + insurance_profit
+    total_assets = sum(value for value, _ in totals.values())
+    total_profit = sum(profits.values())
 
     # グラフ用データの作成
     chart_data = {
@@ -960,15 +2736,15 @@ def manage_assets(asset_type):
     if not user:
         return redirect(url_for('login'))
     
-    conn = get_db()
+    conn = get_db(readonly=True)
     c = conn.cursor()
     
     if USE_POSTGRES:
-        c.execute('''SELECT * FROM assets WHERE user_id = %s AND asset_type = %s
-                    ORDER BY symbol''', (user['id'], asset_type))
+        c.execute(f'''{HOLDINGS_SQL} WHERE a.user_id = %s AND a.asset_type = %s
+                    ORDER BY a.symbol''', (user['id'], asset_type))
     else:
-        c.execute('''SELECT * FROM assets WHERE user_id = ? AND asset_type = ?
-                    ORDER BY symbol''', (user['id'], asset_type))
+        c.execute(f'''{HOLDINGS_SQL} WHERE a.user_id = ? AND a.asset_type = ?
+                    ORDER BY a.symbol''', (user['id'], asset_type))
     
     assets = c.fetchall()
     conn.close()
@@ -990,12 +2766,13 @@ def manage_assets(asset_type):
         assets=assets, 
         asset_type=asset_type, 
         info=info, 
-        crypto_symbols=CRYPTO_SYMBOLS,
-        investment_trust_symbols=INVESTMENT_TRUST_SYMBOLS,
-        insurance_types=INSURANCE_TYPES
+        crypto_symbols=instrument_registry.symbols('crypto'),
+        investment_trust_symbols=instrument_registry.symbols('investment_trust'),
+        insurance_types=instrument_registry.symbols('insurance')
     )
 
 @app.route('/add_asset', methods=['POST'])
+@writes_user_data
 def add_asset():
     user = get_current_user()
     if not user:
@@ -1017,21 +2794,20 @@ def add_asset():
         price = get_gold_price()
         if not name: name = "金 (Gold)"
     elif asset_type == 'crypto':
-        if symbol not in CRYPTO_SYMBOLS:
+        if instrument_registry.get('crypto', symbol) is None:
             flash('対応していない暗号資産です', 'error')
             return redirect(url_for('manage_assets', asset_type='crypto'))
         price = get_crypto_price(symbol)
         name = name or symbol
     elif asset_type == 'investment_trust':
-        if symbol not in INVESTMENT_TRUST_SYMBOLS:
+        if instrument_registry.get('investment_trust', symbol) is None:
             flash('対応していない投資信託です', 'error')
             return redirect(url_for('manage_assets', asset_type='investment_trust'))
         price = get_investment_trust_price(symbol)
         name = name or symbol
     elif asset_type != 'cash':
-        is_jp = (asset_type == 'jp_stock')
         try:
-            stock_info = get_jp_stock_info(symbol) if is_jp else get_us_stock_info(symbol)
+            stock_info = lookup_stock_info(asset_type, symbol)
             price = stock_info['price']
             if not name: name = stock_info['name']
         except Exception as e:
@@ -1101,6 +2877,9 @@ def add_asset():
                      (user['id'], asset_type, symbol, name, quantity, price, avg_cost))
         flash(f'{symbol} を追加しました', 'success')
     
+    if asset_type in PRICED_ASSET_TYPES and price and price > 0:
+        write_quotes(c, [(asset_type, symbol, price)])
+
     conn.commit()
     conn.close()
     
@@ -1116,13 +2895,13 @@ def edit_asset(asset_id):
     if not user:
         return redirect(url_for('login'))
     
-    conn = get_db()
+    conn = get_db(readonly=True)
     c = conn.cursor()
     
     if USE_POSTGRES:
-        c.execute('SELECT * FROM assets WHERE id = %s AND user_id = %s', (asset_id, user['id']))
+        c.execute(f'{HOLDINGS_SQL} WHERE a.id = %s AND a.user_id = %s', (asset_id, user['id']))
     else:
-        c.execute('SELECT * FROM assets WHERE id = ? AND user_id = ?', (asset_id, user['id']))
+        c.execute(f'{HOLDINGS_SQL} WHERE a.id = ? AND a.user_id = ?', (asset_id, user['id']))
     
     asset = c.fetchone()
     conn.close()
@@ -1143,9 +2922,11 @@ def edit_asset(asset_id):
     
     info = type_info.get(asset['asset_type'], type_info['jp_stock'])
     
-    return render_template('edit_asset.html', asset=asset, info=info, insurance_types=INSURANCE_TYPES)
+    return render_template('edit_asset.html', asset=asset, info=info,
+                           insurance_types=instrument_registry.symbols('insurance'))
 
 @app.route('/update_asset', methods=['POST'])
+@writes_user_data
 def update_asset():
     user = get_current_user()
     if not user:
@@ -1185,23 +2966,22 @@ def update_asset():
         price = get_gold_price()
         if not name: name = "金 (Gold)"
     elif asset_type == 'crypto':
-        if symbol not in CRYPTO_SYMBOLS:
+        if instrument_registry.get('crypto', symbol) is None:
             flash('対応していない暗号資産です', 'error')
             conn.close()
             return redirect(url_for('manage_assets', asset_type='crypto'))
         price = get_crypto_price(symbol)
         if not name: name = symbol
     elif asset_type == 'investment_trust':
-        if symbol not in INVESTMENT_TRUST_SYMBOLS:
+        if instrument_registry.get('investment_trust', symbol) is None:
             flash('対応していない投資信託です', 'error')
             conn.close()
             return redirect(url_for('manage_assets', asset_type='investment_trust'))
         price = get_investment_trust_price(symbol)
         if not name: name = symbol
     elif asset_type != 'cash':
-        is_jp = (asset_type == 'jp_stock')
         try:
-            stock_info = get_jp_stock_info(symbol) if is_jp else get_us_stock_info(symbol)
+            stock_info = lookup_stock_info(asset_type, symbol)
             price = stock_info['price']
             if not name: name = stock_info['name']
         except Exception as e:
@@ -1218,6 +2998,9 @@ def update_asset():
                     WHERE id = ? AND user_id = ?''',
                  (symbol, name, quantity, price, avg_cost, asset_id, user['id']))
     
+    if asset_type in PRICED_ASSET_TYPES and price and price > 0:
+        write_quotes(c, [(asset_type, symbol, price)])
+
     conn.commit()
     conn.close()
     
@@ -1228,6 +3011,7 @@ def update_asset():
     return redirect(url_for('manage_assets', asset_type=asset_type))
 
 @app.route('/delete_asset', methods=['POST'])
+@writes_user_data
 def delete_asset():
     user = get_current_user()
     if not user:
@@ -1268,6 +3052,7 @@ def delete_asset():
     return redirect(url_for('manage_assets', asset_type=asset_type))
 
 @app.route('/update_prices', methods=['POST'])
+@writes_user_data
 def update_prices():
     user = get_current_user()
     if not user:
@@ -1279,70 +3064,182 @@ def update_prices():
 
     if asset_type in ['cash', 'insurance']:
         return 'OK'
+    if asset_type not in PRICED_ASSET_TYPES:
+        return ('Invalid asset type', 400)
     
     conn = get_db()
     c = conn.cursor()
     
+    # 同じ銘柄を複数行で持っていても取得・更新は1回
     if USE_POSTGRES:
-        c.execute('SELECT id, symbol FROM assets WHERE user_id = %s AND asset_type = %s',
-                 (user['id'], asset_type))
+        c.execute(f'''SELECT DISTINCT {QUOTE_SYMBOL_SQL.format(t='assets')} AS symbol FROM assets
+                      WHERE user_id = %s AND asset_type = %s''', (user['id'], asset_type))
     else:
-        c.execute('SELECT id, symbol FROM assets WHERE user_id = ? AND asset_type = ?',
-                 (user['id'], asset_type))
+        c.execute(f'''SELECT DISTINCT {QUOTE_SYMBOL_SQL.format(t='assets')} AS symbol FROM assets
+                      WHERE user_id = ? AND asset_type = ?''', (user['id'], asset_type))
     
-    assets_to_update = c.fetchall()
+    symbols_to_update = [row['symbol'] for row in c.fetchall()]
+    conn.close()
     
-    if asset_type in ['jp_stock', 'us_stock']:
-        info_func = get_jp_stock_info if asset_type == 'jp_stock' else get_us_stock_info
-        for asset in assets_to_update:
-            try:
-                info = info_func(asset['symbol'])
-                price = info.get('price')
-                name = info.get('name')
-                if price is not None and price > 0:
-                    if USE_POSTGRES:
-                        c.execute('UPDATE assets SET price = %s, name = %s WHERE id = %s', (price, name, asset['id']))
-                    else:
-                        c.execute('UPDATE assets SET price = ?, name = ? WHERE id = ?', (price, name, asset['id']))
-                time.sleep(0.5)
-            except Exception as e:
-                 logger.error(f"Failed to update info for {asset['symbol']} ({asset_type}): {e}")
-    else:
-        update_funcs = {
-            'gold': get_gold_price,
-            'crypto': get_crypto_price,
-            'investment_trust': get_investment_trust_price
-        }
-        price_func = update_funcs.get(asset_type)
-        if not price_func:
-            conn.close()
-            return ('Invalid asset type', 400)
+    prices, stale = refresh_quotes([(asset_type, symbol) for symbol in symbols_to_update],
+                                   budget=REFRESH_BUDGET_SECONDS)
+    if stale:
+        flash(f'時間内に取得できなかった銘柄があります(前回の価格を表示): {", ".join(symbol or asset_type for _, symbol in stale)}',
+              'warning')
+
+    return jsonify({'updated': [symbol for _, symbol, _ in prices],
+                    'stale': [symbol for _, symbol in stale]})
+
+
+# 価格更新を購読中のダッシュボードへ配信する(プロセス内)
+price_broker = price_stream.PriceBroker(max_queue=int(os.environ.get('SSE_MAX_QUEUE', '100')))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_MAX_SECONDS = float(os.environ.get('SSE_MAX_SECONDS', '600'))
+# 配信中の接続はそれぞれ WSGI のスレッドを1本占有する(gunicorn の gthread ワーカーのスレッド、
+# hypercorn ではイベントループの既定の executor = min(32, CPU数 + 4) 本)。ほかのリクエストの
+# 分を残すよう、同時に配信する接続数をプロセスごとにこの数までに抑える(既定は executor の半分)
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', str(max(1, min(32, (os.cpu_count() or 1) + 4) // 2))))
+_stream_slots = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+
+def stream_totals(holdings):
+    """SSE で送る資産タイプ別の評価額・損益と総資産(円建て)"""
+    portfolio = Portfolio.from_rows(holdings)
+    totals = portfolio.totals(fx_rates.rates_for(portfolio.currencies()))
+    return {
+        'by_type': {asset_type: {'value': value, 'profit': value - cost}
+                    for asset_type, (value, cost) in totals.items()},
+        'total': sum(value for value, _ in totals.values()),
+        'profit': sum(value - cost for value, cost in totals.values()),
+    }
+
 
-        for asset in assets_to_update:
+@app.route('/stream/prices')
+def stream_prices():
+    """ログインユーザーの保有銘柄の価格変化と合計を Server-Sent Events で配信"""
+    user = get_current_user()
+    if not user:
+        return ('Unauthorized', 401)
+    user_id = user['id']
+    if not _stream_slots.acquire(blocking=False):
+        # 204 を返すと EventSource は再接続しない(ダッシュボードは自動更新なしで使える)
+        SSE_STREAMS.inc(outcome='rejected')
+        return Response(status=204)
+    SSE_STREAMS.inc(outcome='accepted')
+    subscription = price_broker.subscribe()
+
+    def close():
+        # ジェネレーターが始まらずに切れた場合も、応答を閉じたときに必ず枠を返す
+        price_broker.unsubscribe(subscription)
+        _stream_slots.release()
+
+    def generate():
+        # 購読開始時に1回だけ保有資産を読み、以降は届いた価格をメモリ上で反映する
+        holdings = load_holdings(user_id)
+        started = time.monotonic()
+        yield 'retry: 5000\n\n'
+        yield price_stream.format_event('totals', stream_totals(holdings))
+        # 接続は SSE_MAX_SECONDS で切り、ブラウザの自動再接続で張り直させる
+        while True:
+            remaining = SSE_MAX_SECONDS - (time.monotonic() - started)
+            if remaining <= 0:
+                break
             try:
-                price = price_func() if asset_type == 'gold' else price_func(asset['symbol'])
-                if price is not None and price > 0:
-                    if USE_POSTGRES:
-                        c.execute('UPDATE assets SET price = %s WHERE id = %s', (price, asset['id']))
-                    else:
-                        c.execute('UPDATE assets SET price = ? WHERE id = ?', (price, asset['id']))
-                time.sleep(0.5)
-            except Exception as e:
-                logger.error(f"Failed to update price for {asset['symbol']} ({asset_type}): {e}")
-            
-    conn.commit()
-    conn.close()
-    
-    return 'OK'
+                updates = subscription.get(timeout=min(SSE_HEARTBEAT_SECONDS, remaining))
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if updates is None:
+                holdings = load_holdings(user_id)
+                yield price_stream.format_event('totals', stream_totals(holdings))
+                continue
+
+            # 金は銘柄名によらず同じ価格
+            prices = {(asset_type, '' if asset_type == 'gold' else symbol): price
+                      for asset_type, symbol, price in updates}
+            deltas = []
+            for h in holdings:
+                price = prices.get((h.asset_type, '' if h.asset_type == 'gold' else h.symbol))
+                if price is None or price == h.price:
+                    continue
+                deltas.append({'id': h.id, 'asset_type': h.asset_type, 'symbol': h.symbol,
+                               'old_price': h.price, 'price': price})
+                h.price = price
+            if deltas:
+                yield price_stream.format_event('prices', {'deltas': deltas, 'totals': stream_totals(holdings)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(close)
+    return response
+
+
+@app.route('/api/symbols/search')
+def search_symbols():
+    """銘柄の候補(?q=トヨタ&type=jp_stock&limit=10)。証券コード・銘柄名の前方一致を優先"""
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': 'login required'}), 401
+    asset_type = request.args.get('type') or None
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+    if asset_type in REGISTERED_ASSET_TYPES:
+        query = ticker_index.search_key(request.args.get('q', ''))
+        results = [{'asset_type': i.asset_type, 'symbol': i.symbol, 'name': i.name, 'exchange': None}
+                   for i in instrument_registry.instruments(asset_type)
+                   if query in ticker_index.search_key(i.symbol) or query in ticker_index.search_key(i.name)]
+        return jsonify(results[:limit])
+    tickers = stock_index.search(request.args.get('q', ''), asset_type=asset_type, limit=limit)
+    return jsonify([t._asdict() for t in tickers])
+
+
+@app.route('/api/analytics')
+def api_analytics():
+    """資産推移の分析(?range=1m / 3m / 6m / 1y / 3y / all)"""
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': 'login required'}), 401
+    range_key = request.args.get('range', '1y')
+    if range_key not in analytics.RANGES:
+        return jsonify({'error': f'unknown range: {range_key}'}), 400
+    # 系列を含むので、シリアライズ済みの本文もキャッシュする
+    key = (user['id'], range_key, 'json')
+    version = history_version(user['id'])
+    body = analytics_cache.get(key, version)
+    if body is None:
+        body = json.dumps(portfolio_analytics(user['id'], range_key, version), ensure_ascii=False)
+        analytics_cache.put(key, body, version)
+    return Response(body, mimetype='application/json')
+
+
+@app.route('/api/simulation')
+def api_simulation():
+    """現在の配分のモンテカルロシミュレーション(?horizon=1m ... 10y&paths=)"""
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': 'login required'}), 401
+    horizon_key = request.args.get('horizon', '1y')
+    if horizon_key not in simulation.HORIZONS:
+        return jsonify({'error': f'unknown horizon: {horizon_key}'}), 400
+    paths = request.args.get('paths', SIMULATION_PATHS, type=int)
+    if not paths or not 0 < paths <= SIMULATION_MAX_PATHS:
+        return jsonify({'error': f'paths must be between 1 and {SIMULATION_MAX_PATHS}'}), 400
+    paths = next(size for size in SIMULATION_PATH_SIZES if size >= paths)
+    try:
+        return jsonify(portfolio_simulation(user['id'], horizon_key, paths))
+    except concurrent.futures.TimeoutError:
+        logger.error(f"Simulation timed out for user {user['id']} ({horizon_key}, {paths} paths)")
+        return jsonify({'error': 'simulation timed out'}), 503
+
 
 @app.route('/update_all_prices', methods=['POST'])
+@writes_user_data
 def update_all_prices():
     user = get_current_user()
     if not user:
         return redirect(url_for('login'))
 
     # 現在のユーザーの価格を更新
-    updated_count = update_user_prices(user['id'])
+    updated_count = update_user_prices(user['id'], budget=REFRESH_BUDGET_SECONDS)
     
     # 資産スナップショットを記録
     record_asset_snapshot(user['id'])
@@ -1351,11 +3248,6 @@ def update_all_prices():
     return redirect(url_for('dashboard'))
 
 
-# アプリケーション終了時にスケジューラーをシャットダウン
-import atexit
-atexit.register(lambda: scheduler.shutdown())
-
-
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    create_app().run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,146 @@
+"""
+資産推移分析のベンチマーク
+
+一時ディレクトリの SQLite に合成の asset_history(既定: 200ユーザー × 3年分の日次)を
+投入し、以下を計測する。
+
+    python_loop: 行ごとのループで同じ指標を求める素朴な実装(比較用)
+    numpy: analytics.compute_metrics(列の配列への読み込みは含まない)
+    load_and_compute: load_history_columns + compute_metrics(キャッシュなし)
+    api_cached: /api/analytics の2回目以降(シリアライズ済みの本文がキャッシュにヒット)
+
+numpy 版と素朴な実装の結果が一致することも確認する。
+
+使い方:
+    python benchmarks/bench_analytics.py --users 200 --years 3
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_refresh import summarize, timed  # noqa: E402
+
+
+def populate(portfolio, users, days, rng):
+    """ランダムウォークの資産推移を投入し、ユーザーIDのリストを返す"""
+    conn = portfolio.get_db()
+    c = conn.cursor()
+    c.executemany('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                  [(f'analytics{i:05d}', 'x') for i in range(users)])
+    c.execute("SELECT id FROM users WHERE username LIKE 'analytics%' ORDER BY id")
+    user_ids = [row['id'] for row in c.fetchall()]
+
+    start = date.today() - timedelta(days=days - 1)
+    rows = []
+    for user_id in user_ids:
+        values = [rng.uniform(1e5, 5e6) for _ in range(7)]
+        for day in range(days):
+            values = [max(0.0, v * (1 + rng.gauss(0.0003, 0.01))) for v in values]
+            if rng.random() < 0.01:
+                values[2] += rng.uniform(1e4, 5e5)  # 現金の入金
+            rows.append((user_id, start + timedelta(days=day), *values, sum(values)))
+    portfolio.write_asset_history(c, rows)
+    conn.commit()
+    conn.close()
+    return user_ids
+
+
+def python_metrics(rows):
+    """行ごとのループによる実装(numpy 版との比較用)"""
+    totals = [row[-1] for row in rows]
+    growth = 1.0
+    returns = []
+    contribution = [0.0] * 7
+    for i in range(1, len(rows)):
+        previous = totals[i - 1]
+        daily = totals[i] / previous - 1 if previous > 0 else 0.0
+        if previous > 0:
+            for k in range(7):
+                contribution[k] += growth * (rows[i][1 + k] - rows[i - 1][1 + k]) / previous
+        growth *= 1 + daily
+        returns.append(daily)
+    mean = sum(returns) / len(returns)
+    volatility = math.sqrt(sum((r - mean) ** 2 for r in returns) / (len(returns) - 1)) * math.sqrt(365)
+    peak = 0.0
+    max_drawdown = 0.0
+    for total in totals:
+        peak = max(peak, total)
+        if peak > 0:
+            max_drawdown = min(max_drawdown, total / peak - 1)
+    return {'time_weighted_return': growth - 1, 'volatility': volatility, 'max_drawdown': max_drawdown,
+            'contribution': contribution}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='資産推移分析のベンチマーク')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--samples', type=int, default=50, help='計測に使う人数')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    os.chdir(tempfile.mkdtemp(prefix='portfolio-analytics-'))
+    os.environ['DISABLE_SCHEDULER'] = '1'
+    os.environ.pop('DATABASE_URL', None)
+
+    import app as portfolio
+    import analytics
+
+    portfolio.init_db()
+    days = int(args.years * 365)
+    user_ids = populate(portfolio, args.users, days, rng)
+    sample = rng.sample(user_ids, min(args.samples, len(user_ids)))
+    print(f"{len(user_ids)} users x {days} days, sampling {len(sample)} users")
+
+    histories = {user_id: portfolio.load_history_columns(user_id) for user_id in sample}
+    row_lists = {user_id: [(str(d), *v, t) for d, v, t in zip(h.dates, h.values.tolist(), h.total.tolist())]
+                 for user_id, h in histories.items()}
+
+    # 結果の一致を確認
+    for user_id in sample:
+        expected = python_metrics(row_lists[user_id])
+        actual = analytics.compute_metrics(histories[user_id])
+        for field in ('time_weighted_return', 'volatility', 'max_drawdown'):
+            assert math.isclose(expected[field], actual[field], rel_tol=1e-9, abs_tol=1e-12), field
+        for k, name in enumerate(analytics.CLASS_COLUMNS):
+            assert math.isclose(expected['contribution'][k], actual['contribution'][name], rel_tol=1e-9, abs_tol=1e-12)
+        assert math.isclose(sum(actual['contribution'].values()), actual['time_weighted_return'], rel_tol=1e-9)
+
+    results = []
+    timings, wall = timed(lambda user_id: python_metrics(row_lists[user_id]), sample)
+    results.append(summarize('python_loop', timings, wall))
+    timings, wall = timed(lambda user_id: analytics.compute_metrics(histories[user_id]), sample)
+    results.append(summarize('numpy', timings, wall))
+    timings, wall = timed(lambda user_id: analytics.compute_metrics(portfolio.load_history_columns(user_id)), sample)
+    results.append(summarize('load_and_compute', timings, wall))
+
+    client = portfolio.create_app().test_client()
+
+    def get_analytics(user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        response = client.get('/api/analytics?range=all')
+        assert response.status_code == 200, response.status_code
+
+    timed(get_analytics, sample)
+    timings, wall = timed(get_analytics, sample)
+    results.append(summarize('api_cached', timings, wall))
+
+    print(f"\n{'benchmark':<24} {'n':>6} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for r in results:
+        print(f"{r['name']:<24} {r['count']:>6} {r['throughput']:>10.2f} "
+              f"{r['p50']:>10.2f} {r['p95']:>10.2f} {r['p99']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+価格更新・ダッシュボードのオフラインベンチマーク
+
+fake_upstream のローカルスタブに取得先を向け、一時ディレクトリの SQLite に
+合成データ(既定: 1000ユーザー × 50銘柄)を投入して、以下を計測する。
+
+    yahoo_chart_fetch / update_user_prices / record_asset_snapshot / record_all_snapshots /
+    dashboard / scheduled_update_all_prices
+
+結果はスループットと p50/p95/p99 レイテンシで表示する。--output で JSON に保存し、
+--compare で保存済みの結果と比べて p95 が許容幅を超えて悪化していれば終了コード1を返す。
+
+使い方:
+    python benchmarks/bench_refresh.py --users 1000 --holdings 50 --latency-ms 20 --error-rate 0.01
+    python benchmarks/bench_refresh.py --output baseline.json
+    python benchmarks/bench_refresh.py --compare baseline.json --tolerance 0.2
+    python benchmarks/bench_refresh.py --slow-rate 0.05 --slow-ms 2000 --mirror   # ヘッジの効果
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_upstream import FakeUpstream  # noqa: E402
+
+JP_CODES = [str(code) for code in range(1300, 1700)]
+US_SYMBOLS = [f'US{i:03d}' for i in range(200)]
+CRYPTO = ['BTC', 'ETH', 'XRP', 'DOGE']
+FUNDS = ['S&P500', 'オルカン', 'FANG+']
+
+
+def percentile(sorted_values, pct):
+    """最近傍法によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name, timings_ms, wall_seconds):
+    values = sorted(timings_ms)
+    return {
+        'name': name,
+        'count': len(values),
+        'throughput': len(values) / wall_seconds if wall_seconds > 0 else 0.0,
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+    }
+
+
+def timed(fn, items):
+    """items の各要素で fn を呼び、(各呼び出しのms, 全体の秒数) を返す"""
+    timings = []
+    started = time.perf_counter()
+    for item in items:
+        t0 = time.perf_counter()
+        fn(item)
+        timings.append((time.perf_counter() - t0) * 1000)
+    return timings, time.perf_counter() - started
+
+
+def populate(portfolio, users, holdings, rng):
+    """合成ユーザーと保有資産を投入し、ユーザーIDのリストを返す"""
+    universe = ([('jp_stock', s) for s in JP_CODES] + [('us_stock', s) for s in US_SYMBOLS] +
+                [('crypto', s) for s in CRYPTO] + [('investment_trust', s) for s in FUNDS] +
+                [('gold', '金'), ('cash', '普通預金'), ('cash', '定期預金'), ('insurance', '生命保険')])
+    holdings = min(holdings, len(universe))
+
+    conn = portfolio.get_db()
+    c = conn.cursor()
+    placeholder = '%s' if portfolio.USE_POSTGRES else '?'
+    user_rows = [(f'bench{i:06d}', 'x') for i in range(users)]
+    c.executemany(f'INSERT INTO users (username, password_hash) VALUES ({placeholder}, {placeholder})', user_rows)
+    c.execute("SELECT id FROM users WHERE username LIKE 'bench%' ORDER BY id")
+    user_ids = [row['id'] for row in c.fetchall()]
+
+    asset_rows = []
+    for user_id in user_ids:
+        for asset_type, symbol in rng.sample(universe, holdings):
+            quantity = rng.randint(1, 500) if asset_type != 'cash' else rng.randint(10000, 5000000)
+            price = rng.randint(1000, 2000000) if asset_type == 'insurance' else 0
+            asset_rows.append((user_id, asset_type, symbol, symbol, quantity, price, 0))
+    values = ', '.join([placeholder] * 7)
+    c.executemany(f'''INSERT INTO assets (user_id, asset_type, symbol, name, quantity, price, avg_cost)
+                     VALUES ({values})''', asset_rows)
+    conn.commit()
+    conn.close()
+    return user_ids
+
+
+def compare(results, baseline_path, tolerance):
+    """p95 が基準値より tolerance 以上悪化した項目を返す"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        base = baseline.get(result['name'])
+        if base and base['p95'] > 0 and result['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append((result['name'], base['p95'], result['p95']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='価格更新のオフラインベンチマーク')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--holdings', type=int, default=50)
+    parser.add_argument('--samples', type=int, default=100, help='ユーザー単位の計測に使う人数')
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--page-kb', type=int, default=64, help='HTMLページを水増しするサイズ')
+    parser.add_argument('--etag', action='store_true', help='取得先が ETag を返し、条件付きリクエストに 304 で応える')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='取得先が slow-ms 遅れて応答する割合')
+    parser.add_argument('--slow-ms', type=float, default=2000.0)
+    parser.add_argument('--mirror', action='store_true', help='同等な2台目の取得先を立て、チャートAPIのヘッジ先にする')
+    parser.add_argument('--skip-full-run', action='store_true', help='scheduled_update_all_prices を計測しない')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='結果をJSONで保存するパス')
+    parser.add_argument('--compare', help='比較する基準結果のJSON')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.compare) if args.compare else None
+
+    rng = random.Random(args.seed)
+    upstream = FakeUpstream(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                            error_rate=args.error_rate, page_kb=args.page_kb, etag=args.etag,
+                            slow_rate=args.slow_rate, slow_ms=args.slow_ms).start()
+    mirror = None
+    if args.mirror:
+        mirror = FakeUpstream(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                              slow_rate=args.slow_rate, slow_ms=args.slow_ms, seed=43).start()
+
+    workdir = tempfile.mkdtemp(prefix='portfolio-bench-')
+    os.chdir(workdir)
+    os.environ.update(upstream.env())
+    os.environ['YAHOO_CHART_MIRRORS'] = mirror.env()['YAHOO_CHART_URL'] if mirror else ''
+    os.environ['DISABLE_SCHEDULER'] = '1'
+    os.environ.pop('DATABASE_URL', None)
+
+    import app as portfolio
+    logging.getLogger('app').setLevel(logging.WARNING)
+
+    portfolio.init_db()
+    user_ids = populate(portfolio, args.users, args.holdings, rng)
+    sample = rng.sample(user_ids, min(args.samples, len(user_ids)))
+    print(f"{len(user_ids)} users x {args.holdings} holdings, sampling {len(sample)} users "
+          f"(upstream {args.latency_ms}±{args.jitter_ms}ms, error rate {args.error_rate})")
+
+    results = []
+
+    # チャートAPIの単発取得(共有ストアを通さない)。ヘッジの効果はここの p99 に出る
+    chart_keys = [('jp_stock', rng.choice(JP_CODES)) if i % 2 else ('us_stock', rng.choice(US_SYMBOLS))
+                  for i in range(args.samples * 2)]
+    timings, wall = timed(lambda key: portfolio.fetch_upstream_price(*key), chart_keys)
+    results.append(summarize('yahoo_chart_fetch', timings, wall))
+
+    timings, wall = timed(portfolio.update_user_prices, sample)
+    results.append(summarize('update_user_prices', timings, wall))
+
+    timings, wall = timed(portfolio.record_asset_snapshot, sample)
+    results.append(summarize('record_asset_snapshot', timings, wall))
+
+    timings, wall = timed(lambda _: portfolio.record_all_snapshots(), [None])
+    results.append(summarize('record_all_snapshots', timings, wall))
+
+    client = portfolio.create_app().test_client()
+
+    def get_dashboard(user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+            sess['username'] = f'user{user_id}'
+        response = client.get('/dashboard')
+        assert response.status_code == 200, response.status_code
+
+    timings, wall = timed(get_dashboard, sample)
+    results.append(summarize('dashboard', timings, wall))
+
+    if not args.skip_full_run:
+        timings, wall = timed(lambda _: portfolio.scheduled_update_all_prices(), [None])
+        results.append(summarize('scheduled_update_all_prices', timings, wall))
+        results.append({'name': 'scheduled_update_all_prices (users/s)', 'count': len(user_ids),
+                        'throughput': len(user_ids) / wall, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0})
+
+    upstream.stop()
+    if mirror:
+        mirror.stop()
+
+    print(f"\n{'benchmark':<40} {'n':>6} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for r in results:
+        print(f"{r['name']:<40} {r['count']:>6} {r['throughput']:>10.2f} "
+              f"{r['p50']:>10.1f} {r['p95']:>10.1f} {r['p99']:>10.1f}")
+    print(f"\nupstream requests: {upstream.requests} ({upstream.errors} injected errors, "
+          f"{upstream.not_modified} not modified)")
+    if mirror:
+        print(f"mirror requests: {mirror.requests}")
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, base, current in regressions:
+            print(f"REGRESSION {name}: p95 {base:.1f}ms -> {current:.1f}ms")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
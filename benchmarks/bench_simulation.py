@@ -0,0 +1,107 @@
+"""
+モンテカルロシミュレーションのベンチマーク
+
+bench_analytics と同じ合成の asset_history(既定: 20ユーザー × 3年分の日次)と、
+現金・金の保有を一時ディレクトリの SQLite に投入し、以下を計測する。
+
+    inline: Simulator(workers=0) で呼び出し元だけで計算
+    pool: Simulator(workers=N) でチャンクをプロセスプールに分けて計算
+    api_cold: /api/simulation(キャッシュなし)
+    api_cached: /api/simulation の2回目以降(キャッシュヒット)
+
+inline と pool の結果が一致する(同じシードなら同じ分位点になる)ことも確認する。
+
+使い方:
+    python benchmarks/bench_simulation.py --users 20 --paths 20000 --horizon 1y
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_analytics import populate  # noqa: E402
+from bench_refresh import summarize, timed  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='モンテカルロシミュレーションのベンチマーク')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--years', type=float, default=3)
+    parser.add_argument('--paths', type=int, default=20000)
+    parser.add_argument('--horizon', default='1y')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    os.chdir(tempfile.mkdtemp(prefix='portfolio-simulation-'))
+    os.environ['DISABLE_SCHEDULER'] = '1'
+    os.environ.pop('DATABASE_URL', None)
+
+    import app as portfolio
+    import simulation
+
+    portfolio.init_db()
+    user_ids = populate(portfolio, args.users, int(args.years * 365), rng)
+    conn = portfolio.get_db()
+    conn.cursor().executemany(
+        'INSERT INTO assets (user_id, asset_type, symbol, name, quantity, price) VALUES (?, ?, ?, ?, ?, ?)',
+        [row for user_id in user_ids
+         for row in ((user_id, 'cash', 'JPY', '現金', rng.uniform(1e5, 5e6), 1),
+                     (user_id, 'gold', '', '金', rng.uniform(10, 500), 10000))])
+    conn.commit()
+    conn.close()
+    horizon = simulation.HORIZONS[args.horizon]
+    print(f"{len(user_ids)} users, {args.paths} paths x {horizon} days, {args.workers} workers")
+
+    returns = {user_id: simulation.class_returns(portfolio.load_history_columns(user_id)) for user_id in user_ids}
+    allocation = [0.3, 0.3, 0.1, 0.1, 0.05, 0.1, 0.05]
+    inline = simulation.Simulator(workers=0)
+    # inline と比べるので、期限で打ち切らずに全パスを計算する
+    pool = simulation.Simulator(workers=args.workers, timeout=60)
+
+    # プロセスの起動は計測に含めない
+    pool.run(returns[user_ids[0]], allocation, horizon, args.paths)
+    for user_id in user_ids[:3]:
+        expected = inline.run(returns[user_id], allocation, horizon, args.paths, seed=user_id)
+        actual = pool.run(returns[user_id], allocation, horizon, args.paths, seed=user_id)
+        for p in simulation.PERCENTILES:
+            assert all(math.isclose(a, b, rel_tol=1e-12)
+                       for a, b in zip(expected['bands'][str(p)], actual['bands'][str(p)]))
+
+    results = []
+    timings, wall = timed(lambda user_id: inline.run(returns[user_id], allocation, horizon, args.paths), user_ids)
+    results.append(summarize('inline', timings, wall))
+    timings, wall = timed(lambda user_id: pool.run(returns[user_id], allocation, horizon, args.paths), user_ids)
+    results.append(summarize('pool', timings, wall))
+    pool.shutdown()
+
+    client = portfolio.create_app().test_client()
+
+    def get_simulation(user_id):
+        with client.session_transaction() as sess:
+            sess['user_id'] = user_id
+        response = client.get(f'/api/simulation?horizon={args.horizon}&paths={args.paths}')
+        assert response.status_code == 200, response.status_code
+
+    timings, wall = timed(get_simulation, user_ids)
+    results.append(summarize('api_cold', timings, wall))
+    timings, wall = timed(get_simulation, user_ids)
+    results.append(summarize('api_cached', timings, wall))
+    portfolio.simulator.shutdown()
+
+    print(f"\n{'benchmark':<24} {'n':>6} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for r in results:
+        print(f"{r['name']:<24} {r['count']:>6} {r['throughput']:>10.2f} "
+              f"{r['p50']:>10.2f} {r['p95']:>10.2f} {r['p99']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+起動時間のベンチマーク
+
+新しいインタプリタで `import app` と `create_app()` を繰り返し実行し、
+コールドスタートにかかる時間を計測する。一時ディレクトリの SQLite を使うため
+既存の portfolio.db には触れない。1回目はスキーマ初期化が走り、2回目以降は
+スキーマバージョンの確認だけになる。
+
+使い方:
+    python benchmarks/bench_startup.py --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'import': 'import app',
+    'create_app': 'import app; app.create_app()',
+}
+
+
+def measure(code, runs, workdir):
+    env = dict(os.environ, PYTHONPATH=ROOT, DISABLE_SCHEDULER='1')
+    env.pop('DATABASE_URL', None)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='アプリの起動時間を計測する')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    baseline = measure('pass', args.runs, ROOT)
+    print(f"{'scenario':<12} {'min':>8} {'median':>8} {'max':>8}  "
+          f"(ms, interpreter {statistics.median(baseline):.0f}ms)")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, code in SCENARIOS.items():
+            timings = measure(code, args.runs, workdir)
+            print(f"{name:<12} {min(timings):8.1f} {statistics.median(timings):8.1f} {max(timings):8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+ベンチマーク用のローカル価格取得先スタブ
+
+Yahoo Finance のチャートAPI・みんかぶ・田中貴金属・楽天証券の代わりに、
+fixtures/ のJSON/HTMLに価格を埋め込んで返す。応答の遅延とエラー率を指定できる。
+価格は銘柄ごとに固定(シンボルのハッシュから生成)なので、結果は再現可能。
+etag=True なら本文のハッシュを ETag として返し、If-None-Match が一致すれば 304 を返す。
+
+単体でも起動できる:
+    python benchmarks/fake_upstream.py --port 8765 --latency-ms 50 --error-rate 0.02
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+PADDING_ROW = '<div class="news-item"><a href="/news/{i}">マーケットニュース {i}</a><span class="date">2026/10/17</span></div>\n'
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def symbol_price(symbol, low, high):
+    """シンボルから決まった価格を生成"""
+    digest = hashlib.md5(symbol.encode('utf-8')).hexdigest()
+    return round(low + (int(digest[:8], 16) / 0xFFFFFFFF) * (high - low), 2)
+
+
+def render(template, **values):
+    for key, value in values.items():
+        template = template.replace('{{' + key + '}}', str(value))
+    return template
+
+
+class FakeUpstream:
+    """遅延・エラー率を設定できるローカルHTTPサーバー"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, page_kb=0, etag=False,
+                 slow_rate=0.0, slow_ms=0.0, seed=42):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        # slow_rate の割合のリクエストだけ slow_ms 遅らせる(テールレイテンシの再現)
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.etag = etag
+        self.padding = ''.join(PADDING_ROW.format(i=i) for i in range(page_kb * 1024 // len(PADDING_ROW)))
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._templates = {
+            'yahoo': load_fixture('yahoo_chart.json'),
+            'minkabu': load_fixture('minkabu_pair.html'),
+            'tanaka': load_fixture('tanaka_gold.html'),
+            'rakuten': load_fixture('rakuten_fund.html'),
+        }
+
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                upstream.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def env(self):
+        """app の取得先をこのサーバーに向ける環境変数"""
+        return {
+            'YAHOO_CHART_URL': f'{self.base_url}/yahoo/v8/finance/chart',
+            'MINKABU_URL': f'{self.base_url}/minkabu',
+            'TANAKA_GOLD_URL': f'{self.base_url}/tanaka/commodity/souba/english/index.php',
+            'RAKUTEN_FUND_URL': f'{self.base_url}/rakuten/web/fund/detail/',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, handler):
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms))
+            if self._random.random() < self.slow_rate:
+                delay += self.slow_ms
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay:
+            time.sleep(delay / 1000)
+
+        if fail:
+            self._send(handler, 500, 'text/plain', 'Internal Server Error')
+            return
+
+        parsed = urlparse(handler.path)
+        path = unquote(parsed.path)
+        if path.startswith('/yahoo/v8/finance/chart/'):
+            self._send(handler, 200, 'application/json', self._chart(path.rsplit('/', 1)[1]))
+        elif path.startswith('/minkabu/pair/'):
+            symbol = path.rsplit('/', 1)[1].split('_')[0]
+            price = symbol_price(symbol, 10, 15000000)
+            self._send(handler, 200, 'text/html; charset=utf-8', render(
+                self._templates['minkabu'], symbol=symbol, price_formatted=f'{price:,.2f}', padding=self.padding))
+        elif path.startswith('/tanaka/'):
+            price = symbol_price('GOLD', 15000, 25000)
+            self._send(handler, 200, 'text/html; charset=utf-8', render(
+                self._templates['tanaka'], price_formatted=f'{int(price):,}', padding=self.padding))
+        elif path.startswith('/rakuten/'):
+            fund_id = parse_qs(parsed.query).get('ID', [''])[0]
+            price = symbol_price(fund_id, 10000, 40000)
+            self._send(handler, 200, 'text/html; charset=utf-8', render(
+                self._templates['rakuten'], name=fund_id, price_formatted=f'{int(price):,}', padding=self.padding))
+        else:
+            self._send(handler, 404, 'text/plain', 'Not Found')
+
+    def _chart(self, symbol):
+        if symbol == 'USDJPY=X':
+            price, currency, exchange = symbol_price(symbol, 140, 160), 'JPY', 'CCY'
+        elif symbol.endswith('.T'):
+            price, currency, exchange = symbol_price(symbol, 500, 12000), 'JPY', 'JPX'
+        else:
+            price, currency, exchange = symbol_price(symbol, 10, 900), 'USD', 'NMS'
+        return render(self._templates['yahoo'], symbol=symbol, price=json.dumps(price), currency=currency,
+                      exchange=exchange, name=f'{symbol} Holdings Co., Ltd.')
+
+    def _send(self, handler, status, content_type, body):
+        data = body.encode('utf-8')
+        etag = f'"{hashlib.md5(data).hexdigest()}"' if self.etag and status == 200 else None
+        if etag and handler.headers.get('If-None-Match') == etag:
+            with self._lock:
+                self.not_modified += 1
+            handler.send_response(304)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        if etag:
+            handler.send_header('ETag', etag)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='価格取得先のローカルスタブを起動する')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--page-kb', type=int, default=0, help='HTMLページを水増しするサイズ')
+    parser.add_argument('--etag', action='store_true', help='ETag を付けて条件付きリクエストに 304 を返す')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='遅延させるリクエストの割合')
+    parser.add_argument('--slow-ms', type=float, default=0.0, help='遅延させるリクエストに加える遅延')
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                            error_rate=args.error_rate, page_kb=args.page_kb, etag=args.etag,
+                            slow_rate=args.slow_rate, slow_ms=args.slow_ms)
+    for key, value in upstream.env().items():
+        print(f'export {key}={value}')
+    try:
+        upstream.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
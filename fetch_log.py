@@ -0,0 +1,124 @@
+"""
+銘柄ごとの取得ログ
+
+スクレイパー1回の呼び出しごとに、銘柄・取得元・HTTPステータス・バイト数・
+レイテンシ・一致したパース手法・結果を1行として記録する。記録はキューに積むだけで、
+DBへの書き込みはバックグラウンドのスレッドがまとめて行う。
+"""
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def begin(scraper, symbol):
+    """スクレイパー呼び出しの開始(同じスレッドの note_* がこのエントリに書き込む)"""
+    _local.entry = {
+        'fetched_at': _now(),
+        'scraper': scraper,
+        'symbol': symbol,
+        'source': None,
+        'http_status': None,
+        'bytes': None,
+        'latency_ms': None,
+        'strategy': None,
+        'started': time.perf_counter(),
+    }
+
+
+def note_http(source, status, nbytes, latency):
+    entry = getattr(_local, 'entry', None)
+    if entry is not None:
+        entry.update(source=source, http_status=str(status), bytes=nbytes, latency_ms=round(latency * 1000, 2))
+
+
+def note_strategy(strategy):
+    """価格を見つけたパース手法を記録"""
+    entry = getattr(_local, 'entry', None)
+    if entry is not None:
+        entry['strategy'] = strategy
+
+
+def end(price):
+    """スクレイパー呼び出しの終了。エントリを書き込みキューに渡す"""
+    entry = getattr(_local, 'entry', None)
+    _local.entry = None
+    if entry is None or writer is None:
+        return
+    if entry['latency_ms'] is None:
+        entry['latency_ms'] = round((time.perf_counter() - entry['started']) * 1000, 2)
+    entry['price'] = price if price else None
+    writer.put(entry)
+
+
+class FetchLogWriter:
+    """キューに溜まったログを、一定件数に達するか一定時間ごとにまとめて書き込む"""
+
+    def __init__(self, write_batch, batch_size=200, flush_interval=5.0, max_queue=10000):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, entry):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            # 取得処理を止めないため、溢れた分は捨てる
+            self.dropped += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='fetch-log-writer', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """キューに溜まっている分をすべて書き込む"""
+        with self._write_lock:
+            batch = []
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} fetch log entries: {e}")
+
+
+# app 側で write_batch を渡して設定する(未設定なら記録しない)
+writer = None
+
+
+def configure(write_batch, **kwargs):
+    global writer
+    writer = FetchLogWriter(write_batch, **kwargs)
+    return writer
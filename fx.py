@@ -0,0 +1,77 @@
+"""
+為替レート表
+
+通貨ペアごとにレートを TTL の間キャッシュし、評価に必要な通貨をまとめて引く。
+取得に失敗したときは前回のレート、それもなければ FALLBACK_RATES から求めた暫定レートを
+使う(いずれも警告を記録する)。画面の表示を止めないよう、レートが求められなくても例外は
+投げず、警告を記録して0を返す。
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 取得できなかったときの暫定レート(1単位あたりの円)。任意の通貨ペアはこの比で求める
+FALLBACK_RATES = {'JPY': 1.0, 'USD': 150.0}
+
+
+def fallback_rate(currency, base):
+    """FALLBACK_RATES から求めた currency → base の暫定レート(求められなければ None)"""
+    if currency not in FALLBACK_RATES or base not in FALLBACK_RATES:
+        return None
+    return FALLBACK_RATES[currency] / FALLBACK_RATES[base]
+
+
+class FxRates:
+    """fetch(currency, base) でレートを取得し、TTL の間は再利用する"""
+
+    def __init__(self, fetch, ttl=300):
+        self.fetch = fetch
+        self.ttl = ttl
+        self._rates = {}
+        self._lock = threading.Lock()
+        self._pair_locks = {}
+
+    def _pair_lock(self, pair):
+        with self._lock:
+            return self._pair_locks.setdefault(pair, threading.Lock())
+
+    def rate(self, currency, base='JPY'):
+        if currency == base:
+            return 1.0
+        pair = (currency, base)
+        cached = self._rates.get(pair)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+
+        # 同じ通貨ペアを複数スレッドが同時に取りに行かないようにする
+        with self._pair_lock(pair):
+            cached = self._rates.get(pair)
+            if cached is not None and time.monotonic() - cached[1] < self.ttl:
+                return cached[0]
+            rate = None
+            try:
+                rate = self.fetch(currency, base)
+            except Exception as e:
+                logger.error(f"Error fetching {currency}/{base} rate: {e}")
+            if rate:
+                self._rates[pair] = (rate, time.monotonic())
+                return rate
+        if cached is not None:
+            logger.warning(f"Using stale {currency}/{base} rate {cached[0]}")
+            return cached[0]
+        fallback = fallback_rate(currency, base)
+        if fallback is None:
+            logger.error(f"No {currency}/{base} rate available, valuing {currency} holdings at 0")
+            return 0.0
+        logger.warning(f"Using fallback {currency}/{base} rate {fallback}")
+        return fallback
+
+    def rates_for(self, currencies, base='JPY'):
+        """{通貨: 基準通貨へのレート}"""
+        return {currency: self.rate(currency, base) for currency in currencies}
+
+    def clear(self):
+        with self._lock:
+            self._rates.clear()
@@ -0,0 +1,63 @@
+"""
+ヘッジリクエスト
+
+同じ内容を返すホスト(Yahoo の query1 / query2 など)があるとき、最初のホストが
+観測済みレイテンシの p95 を過ぎても応答しなければ次のホストにも同じリクエストを送り、
+先に返った有効な応答を使う。遅い1件に引きずられる p99 を抑えるためのもの。
+
+追加で送るリクエストはホストごとのトークンバケットの範囲に限る(取得先への負荷を
+増やしすぎない)。
+"""
+import collections
+import threading
+import time
+
+
+class LatencyTracker:
+    """取得元ごとに直近のレイテンシを保持し、ヘッジを送るまでの待ち時間(分位点)を返す"""
+
+    def __init__(self, window=200, quantile=0.95, min_samples=20, default_delay=1.0, min_delay=0.05):
+        self.window = window
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, source, seconds):
+        with self._lock:
+            samples = self._samples.get(source)
+            if samples is None:
+                samples = self._samples[source] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def delay(self, source):
+        """サンプルが少ないうちは default_delay"""
+        with self._lock:
+            samples = sorted(self._samples.get(source, ()))
+        if len(samples) < self.min_samples:
+            return self.default_delay
+        index = min(len(samples) - 1, int(len(samples) * self.quantile))
+        return max(self.min_delay, samples[index])
+
+
+class HostBudget:
+    """ホストごとのトークンバケット(ヘッジとして送ってよい回数)"""
+
+    def __init__(self, rate_per_second=1.0, burst=5):
+        self.rate = rate_per_second
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, host):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[host] = (tokens, now)
+                return False
+            self._buckets[host] = (tokens - 1, now)
+            return True
@@ -0,0 +1,198 @@
+"""
+保有資産のモデルと評価
+
+Holding は assets の1行を __slots__ で保持する軽量オブジェクト(テンプレートや
+既存コードの a['quantity'] 形式のアクセスにも対応)。Portfolio は保有資産を
+列ごとの array に持ち、資産タイプ別の評価額・取得額を NumPy でまとめて計算する
+(array はコピーせずにそのまま NumPy の配列として読む)。numpy は計算する関数の中で import する。
+
+評価額は 数量 × 価格 × 単位倍率 を保有の通貨で求め、為替レート表(通貨 → 基準通貨)で
+換算する。基準通貨は既定で円(BASE_CURRENCY)だが、totals(rates, base=...) で任意の通貨にできる。
+資産タイプごとの通貨・倍率は ASSET_CLASSES にまとめてある。
+"""
+from array import array
+from collections import namedtuple
+
+BASE_CURRENCY = 'JPY'
+
+# currency: 価格の通貨 / multiplier: 単位倍率
+# uses_quantity / uses_price: 評価額に数量・価格を掛けるか
+AssetClass = namedtuple('AssetClass', ['currency', 'multiplier', 'uses_quantity', 'uses_price'])
+
+# 投資信託は1万口あたりの基準価額、保険は価格欄に評価額、現金は数量欄に金額を入れている
+ASSET_CLASSES = {
+    'jp_stock': AssetClass('JPY', 1, True, True),
+    'us_stock': AssetClass('USD', 1, True, True),
+    'cash': AssetClass('JPY', 1, True, False),
+    'gold': AssetClass('JPY', 1, True, True),
+    'crypto': AssetClass('JPY', 1, True, True),
+    'investment_trust': AssetClass('JPY', 1 / 10000, True, True),
+    'insurance': AssetClass('JPY', 1, False, True),
+}
+
+ASSET_TYPES = tuple(ASSET_CLASSES)
+TYPE_CODES = {asset_type: code for code, asset_type in enumerate(ASSET_TYPES)}
+_CLASSES = [ASSET_CLASSES[asset_type] for asset_type in ASSET_TYPES]
+
+
+def valuation(asset_type, quantity, price, multiplier=None):
+    """1件の評価額(保有の通貨建て)"""
+    asset_class = ASSET_CLASSES[asset_type]
+    value = asset_class.multiplier if multiplier is None else multiplier
+    if asset_class.uses_quantity:
+        value *= quantity
+    if asset_class.uses_price:
+        value *= price
+    return value
+
+
+def grouped_valuation(asset_type, sum_quantity, sum_price, sum_product):
+    """SUM(quantity), SUM(price), SUM(quantity * price) の集計値から評価額を求める(通貨建て)"""
+    asset_class = ASSET_CLASSES[asset_type]
+    if asset_class.uses_quantity and asset_class.uses_price:
+        total = sum_product
+    elif asset_class.uses_quantity:
+        total = sum_quantity
+    else:
+        total = sum_price
+    return (total or 0) * asset_class.multiplier
+
+
+def currencies_of(asset_types, base=BASE_CURRENCY):
+    """資産タイプの通貨(基準通貨以外)"""
+    return {ASSET_CLASSES[t].currency for t in asset_types if t in ASSET_CLASSES} - {base}
+
+
+class Holding:
+    """assets テーブルの1行"""
+
+    __slots__ = ('id', 'user_id', 'asset_type', 'symbol', 'name', 'quantity', 'price', 'avg_cost',
+                 'currency', 'multiplier')
+
+    def __init__(self, id, user_id, asset_type, symbol, name, quantity, price, avg_cost,
+                 currency=None, multiplier=None):
+        asset_class = ASSET_CLASSES.get(asset_type)
+        self.id = id
+        self.user_id = user_id
+        self.asset_type = asset_type
+        self.symbol = symbol
+        self.name = name
+        self.quantity = quantity
+        self.price = price
+        self.avg_cost = avg_cost
+        self.currency = currency or (asset_class.currency if asset_class else BASE_CURRENCY)
+        self.multiplier = multiplier if multiplier is not None else (asset_class.multiplier if asset_class else 1)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['user_id'], row['asset_type'], row['symbol'], row['name'],
+                   row['quantity'] or 0, row['price'] or 0, row['avg_cost'] or 0)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    @property
+    def value(self):
+        """評価額(保有の通貨建て)"""
+        return valuation(self.asset_type, self.quantity, self.price, self.multiplier)
+
+    @property
+    def cost(self):
+        """取得額(保有の通貨建て)。現金は取得額を持たないので評価額と同じ(損益0)として扱う"""
+        if self.asset_type == 'cash':
+            return self.value
+        return valuation(self.asset_type, self.quantity, self.avg_cost, self.multiplier)
+
+    def __repr__(self):
+        return f'Holding({self.asset_type}:{self.symbol} x{self.quantity} @{self.price} {self.currency})'
+
+
+class Portfolio:
+    """保有資産を列ごとに持つコンテナ"""
+
+    __slots__ = ('user_ids', 'type_codes', 'currency_codes', 'quantities', 'prices', 'avg_costs',
+                 'multipliers', 'currency_list')
+
+    def __init__(self):
+        self.user_ids = array('q')
+        self.type_codes = array('B')
+        self.currency_codes = array('B')
+        self.quantities = array('d')
+        self.prices = array('d')
+        self.avg_costs = array('d')
+        self.multipliers = array('d')
+        self.currency_list = []
+
+    def __len__(self):
+        return len(self.type_codes)
+
+    def _currency_code(self, currency):
+        try:
+            return self.currency_list.index(currency)
+        except ValueError:
+            self.currency_list.append(currency)
+            return len(self.currency_list) - 1
+
+    def append(self, user_id, asset_type, quantity, price, avg_cost, currency=None, multiplier=None):
+        code = TYPE_CODES.get(asset_type)
+        if code is None:
+            return
+        asset_class = _CLASSES[code]
+        self.user_ids.append(user_id or 0)
+        self.type_codes.append(code)
+        self.currency_codes.append(self._currency_code(currency or asset_class.currency))
+        self.quantities.append(quantity or 0)
+        self.prices.append(price or 0)
+        self.avg_costs.append(avg_cost or 0)
+        self.multipliers.append(asset_class.multiplier if multiplier is None else multiplier)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """user_id, asset_type, quantity, price, avg_cost を持つ行(Holding も可)から作る"""
+        portfolio = cls()
+        for row in rows:
+            if isinstance(row, Holding):
+                portfolio.append(row.user_id, row.asset_type, row.quantity, row.price, row.avg_cost,
+                                 row.currency, row.multiplier)
+            else:
+                portfolio.append(row['user_id'], row['asset_type'], row['quantity'], row['price'], row['avg_cost'])
+        return portfolio
+
+    def currencies(self, base=BASE_CURRENCY):
+        """換算が必要な通貨(基準通貨以外)"""
+        return set(self.currency_list) - {base}
+
+    def totals(self, rates=None, base=BASE_CURRENCY):
+        """{asset_type: (評価額, 取得額)}。rates(通貨 → base のレート)を渡すと base 建て"""
+        import numpy as np
+
+        if not len(self):
+            return {asset_type: (0.0, 0.0) for asset_type in ASSET_TYPES}
+        if rates is None:
+            currency_rates = np.ones(len(self.currency_list))
+        else:
+            currency_rates = np.array([1.0 if c == base else rates[c] for c in self.currency_list])
+        codes = np.frombuffer(self.type_codes, dtype=np.uint8)
+        uses_quantity = np.array([c.uses_quantity for c in _CLASSES])[codes]
+        uses_price = np.array([c.uses_price for c in _CLASSES])[codes]
+
+        # 価格1あたりの base 建ての評価額(倍率 × 為替 × 数量)
+        row_rates = currency_rates[np.frombuffer(self.currency_codes, dtype=np.uint8)]
+        unit_value = np.frombuffer(self.multipliers) * row_rates
+        unit_value = np.where(uses_quantity, unit_value * np.frombuffer(self.quantities), unit_value)
+        value = np.where(uses_price, unit_value * np.frombuffer(self.prices), unit_value)
+        # 現金は取得額を持たないので評価額と同じ(損益0)として扱う
+        cost = np.where(uses_price & (codes != TYPE_CODES['cash']), unit_value * np.frombuffer(self.avg_costs), value)
+
+        values = np.bincount(codes, weights=value, minlength=len(ASSET_TYPES))
+        costs = np.bincount(codes, weights=cost, minlength=len(ASSET_TYPES))
+        return {asset_type: (float(values[code]), float(costs[code])) for code, asset_type in enumerate(ASSET_TYPES)}
@@ -0,0 +1,88 @@
+"""
+スクレイピング対象ページのHTTPキャッシュ
+
+URLごとに ETag / Last-Modified・本文のハッシュ・パース結果を保持し、次回は
+条件付きリクエストを送る。304 が返るか本文のハッシュが前回と同じなら、
+前回のパース結果をそのまま使う。文字コードは、価格を取れた 200 応答で使ったものを
+ホストごとに固定し、以後の判定を省く。
+"""
+import codecs
+import hashlib
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+CacheEntry = namedtuple('CacheEntry', ['etag', 'last_modified', 'body_hash', 'result'])
+
+
+_HEADER_CHARSET = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+_META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def body_hash(content):
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def declared_encoding(content_type, content):
+    """Content-Type ヘッダー、なければ本文先頭の meta タグで宣言された文字コード(なければ None)"""
+    for m in (_HEADER_CHARSET.search(content_type or ''), _META_CHARSET.search(content[:4096])):
+        if m is None:
+            continue
+        name = m.group(1)
+        name = name.decode('ascii', 'ignore') if isinstance(name, bytes) else name
+        try:
+            return codecs.lookup(name).name
+        except LookupError:
+            continue
+    return None
+
+
+class PageCache:
+    """URL → CacheEntry(古いものから捨てる)と、ホスト → 文字コード"""
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._encodings = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, url):
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def conditional_headers(self, url):
+        """前回の検証子から If-None-Match / If-Modified-Since を作る"""
+        entry = self.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def encoding_for(self, host):
+        return self._encodings.get(host)
+
+    def pin_encoding(self, host, encoding):
+        with self._lock:
+            return self._encodings.setdefault(host, encoding)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._encodings.clear()
@@ -0,0 +1,144 @@
+"""
+スケジューラーのリーダー選出
+
+複数ワーカー(gunicorn / hypercorn)で起動しても、定期ジョブを実行するのは
+ロックを取得した1プロセスだけにする。PostgreSQLではセッション単位の
+アドバイザリーロック、SQLiteではロックファイルの flock を使う。どちらも
+プロセスが落ちれば自動的に解放されるため、他のワーカーが次の試行で引き継ぐ。
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock に渡すキー(アプリ内で一意であればよい)
+SCHEDULER_LOCK_KEY = 725358
+
+
+class PostgresLeaderLock:
+    """PostgreSQLのアドバイザリーロックによるリーダーロック"""
+
+    def __init__(self, dsn, key=SCHEDULER_LOCK_KEY):
+        self.dsn = dsn
+        self.key = key
+        self._conn = None
+
+    def try_acquire(self):
+        import psycopg2
+        try:
+            if self._conn is None or self._conn.closed:
+                self._conn = psycopg2.connect(self.dsn)
+                self._conn.autocommit = True
+            c = self._conn.cursor()
+            c.execute('SELECT pg_try_advisory_lock(%s)', (self.key,))
+            return bool(c.fetchone()[0])
+        except Exception as e:
+            logger.error(f"Failed to acquire advisory lock: {e}")
+            self._close()
+            return False
+
+    def is_held(self):
+        """接続が生きていればロックも保持されている"""
+        if self._conn is None or self._conn.closed:
+            return False
+        try:
+            c = self._conn.cursor()
+            c.execute('SELECT 1')
+            return True
+        except Exception as e:
+            logger.error(f"Lost advisory lock connection: {e}")
+            self._close()
+            return False
+
+    def release(self):
+        if self._conn is not None and not self._conn.closed:
+            try:
+                c = self._conn.cursor()
+                c.execute('SELECT pg_advisory_unlock(%s)', (self.key,))
+            except Exception:
+                pass
+        self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+
+class FileLeaderLock:
+    """ロックファイルの排他 flock によるリーダーロック(SQLite用)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fh = None
+
+    def try_acquire(self):
+        import fcntl
+        fh = open(self.path, 'a+')
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return False
+        fh.seek(0)
+        fh.truncate()
+        fh.write(str(os.getpid()))
+        fh.flush()
+        self._fh = fh
+        return True
+
+    def is_held(self):
+        return self._fh is not None
+
+    def release(self):
+        if self._fh is not None:
+            import fcntl
+            try:
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._fh.close()
+                self._fh = None
+
+
+class LeaderElection:
+    """ロックの取得を定期的に試み、リーダーになったら on_elected を呼ぶ"""
+
+    def __init__(self, lock, on_elected, on_demoted=None, interval=30):
+        self.lock = lock
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.interval = interval
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._check()
+        self._thread = threading.Thread(target=self._run, name='leader-election', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.is_leader:
+            self.is_leader = False
+            self.lock.release()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._check()
+
+    def _check(self):
+        if self.is_leader:
+            if not self.lock.is_held():
+                self.is_leader = False
+                logger.warning(f"Process {os.getpid()} lost scheduler leadership")
+                if self.on_demoted:
+                    self.on_demoted()
+        elif self.lock.try_acquire():
+            self.is_leader = True
+            logger.info(f"Process {os.getpid()} elected as scheduler leader")
+            self.on_elected()
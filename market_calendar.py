@@ -0,0 +1,63 @@
+"""
+資産クラスごとの取引時間・更新間隔
+
+価格が動く(または公表される)時間帯を資産クラス単位で定義し、前回の取得以降に
+市場が一度も開いていなければ再取得を省略できるようにする。祝日は考慮しない
+(祝日は価格が変わらないだけなので、取得が1回余分に走るだけで済む)。
+"""
+from collections import namedtuple
+from datetime import datetime, time as dtime, timedelta, timezone
+
+import pytz
+
+# tz: 市場のタイムゾーン
+# sessions: (開始, 終了) の時刻リスト。None なら24時間365日
+# weekdays: 取引のある曜日(0=月曜)
+# cadence_minutes: 定期更新の間隔
+MarketSchedule = namedtuple('MarketSchedule', ['tz', 'sessions', 'weekdays', 'cadence_minutes'])
+
+WEEKDAYS = (0, 1, 2, 3, 4)
+
+MARKET_SCHEDULES = {
+    # 暗号資産は常時取引
+    'crypto': MarketSchedule('Asia/Tokyo', None, None, 30),
+    # 東証: 前場・後場(大引け15:30)
+    'jp_stock': MarketSchedule('Asia/Tokyo', [(dtime(9, 0), dtime(11, 30)), (dtime(12, 30), dtime(15, 30))],
+                               WEEKDAYS, 30),
+    # 米国市場: 現地時間で判定するので夏時間も自動で反映される
+    'us_stock': MarketSchedule('America/New_York', [(dtime(9, 30), dtime(16, 0))], WEEKDAYS, 30),
+    # 田中貴金属の店頭価格は平日の日中に公表・改定される
+    'gold': MarketSchedule('Asia/Tokyo', [(dtime(9, 0), dtime(14, 30))], WEEKDAYS, 60),
+    # 投資信託の基準価額は1日1回、夜に公表される
+    'investment_trust': MarketSchedule('Asia/Tokyo', [(dtime(18, 0), dtime(23, 30))], WEEKDAYS, 60),
+}
+
+
+def market_open_between(asset_type, start, end):
+    """start から end までの間に市場が開いていた時間があるか(いずれも aware datetime)"""
+    schedule = MARKET_SCHEDULES.get(asset_type)
+    if schedule is None or schedule.sessions is None:
+        return True
+
+    tz = pytz.timezone(schedule.tz)
+    local_start = start.astimezone(tz)
+    local_end = end.astimezone(tz)
+
+    day = local_start.date()
+    while day <= local_end.date():
+        if day.weekday() in schedule.weekdays:
+            for open_time, close_time in schedule.sessions:
+                session_open = tz.localize(datetime.combine(day, open_time))
+                session_close = tz.localize(datetime.combine(day, close_time))
+                if session_open <= local_end and session_close >= local_start:
+                    return True
+        day += timedelta(days=1)
+    return False
+
+
+def is_refresh_due(asset_type, last_fetched, now=None):
+    """前回取得以降に市場が開いていれば再取得が必要"""
+    if last_fetched is None:
+        return True
+    now = now or datetime.now(timezone.utc)
+    return market_open_between(asset_type, last_fetched, now)
@@ -0,0 +1,80 @@
+"""
+価格更新の配信(Server-Sent Events)
+
+更新処理が銘柄ごとの新しい価格を publish() すると、購読中の全セッションの
+キューに同じ更新がまとめて入る。1回の取得結果を全購読者で共有するので、
+購読者が増えても取得元への問い合わせは増えない。購読者ごとのキューが溢れた場合は
+古い更新を捨て、次の受信時に全件を読み直すよう resync を伝える。
+"""
+import json
+import queue
+import threading
+
+
+def format_event(event, data):
+    """SSE の1イベント分のテキスト"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class Subscription:
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.overflowed = False
+        # 複数の更新処理が同時に publish しても、捨ててから入れ直すまでを割り込ませない
+        self._lock = threading.Lock()
+
+    def offer(self, updates):
+        """更新を入れる。溢れていれば溜まった分を捨て、次の受信で読み直させる"""
+        with self._lock:
+            try:
+                self.queue.put_nowait(updates)
+            except queue.Full:
+                # 読み出しの遅い購読者は溜まった分を捨てて読み直させる
+                self.overflowed = True
+                try:
+                    while True:
+                        self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self.queue.put_nowait(updates)
+
+    def get(self, timeout):
+        """次の更新(asset_type, symbol, price のリスト)。溢れていた場合は None"""
+        updates = self.queue.get(timeout=timeout)
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return updates
+
+
+class PriceBroker:
+    """プロセス内の購読者へ価格更新を配る(他のワーカープロセスの購読者には届かない)"""
+
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = Subscription(self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, updates):
+        """updates: (asset_type, symbol, price) のリスト"""
+        if not updates or not self._subscribers:
+            return
+        updates = list(updates)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.offer(updates)
@@ -0,0 +1,166 @@
+"""
+リクエスト単位のプロファイリング(オプトイン)
+
+PROFILE_SAMPLE_RATE の割合のリクエスト、または PROFILE_SLOW_MS を超えた
+リクエストについて、DB・HTTP(ホスト別)・パース・レンダリングの内訳を記録する。
+遅いリクエストは所要時間の長い順に PROFILE_KEEP 件、サンプルしたリクエストは直近の
+PROFILE_KEEP 件を別々に保持するので、速いリクエストのサンプルが遅いリクエストを
+押し出すことはない。どちらも未設定なら何もしない。
+"""
+import collections
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+KEEP = int(os.environ.get('PROFILE_KEEP', '50'))
+
+ENABLED = SAMPLE_RATE > 0 or SLOW_MS > 0
+
+_local = threading.local()
+
+
+class Trace:
+    """1リクエスト分のスパン集計"""
+
+    def __init__(self, method, path, endpoint, sampled):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds):
+        with self._lock:
+            total, count = self.spans.get(kind, (0.0, 0))
+            self.spans[kind] = (total + seconds, count + 1)
+
+    def to_dict(self):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'endpoint': self.endpoint,
+            'sampled': self.sampled,
+            'started_at': self.started_at,
+            'duration_ms': round(self.duration * 1000, 2),
+            'spans': {
+                kind: {'total_ms': round(total * 1000, 2), 'count': count}
+                for kind, (total, count) in sorted(self.spans.items(), key=lambda kv: -kv[1][0])
+            },
+        }
+
+
+class RecentTraces:
+    """直近N件のトレースを保持するリングバッファ(サンプルしたリクエスト用)"""
+
+    def __init__(self, size):
+        self._traces = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def snapshot(self):
+        """新しい順"""
+        with self._lock:
+            traces = list(self._traces)
+        return [trace.to_dict() for trace in reversed(traces)]
+
+
+class SlowestTraces:
+    """所要時間の長いN件のトレースを保持する(より速いものから押し出される)"""
+
+    def __init__(self, size):
+        self.size = size
+        self._heap = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, trace):
+        entry = (trace.duration, next(self._order), trace)
+        with self._lock:
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, entry)
+            elif entry[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def snapshot(self):
+        """遅い順"""
+        with self._lock:
+            entries = sorted(self._heap, reverse=True)
+        return [trace.to_dict() for _, _, trace in entries]
+
+
+slowest_traces = SlowestTraces(KEEP)
+recent_traces = RecentTraces(KEEP)
+
+
+def snapshot():
+    """遅いリクエスト(遅い順)とサンプルしたリクエスト(新しい順)"""
+    return {'slow': slowest_traces.snapshot(), 'sampled': recent_traces.snapshot()}
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def begin(method, path, endpoint):
+    """リクエスト開始時に呼ぶ(無効なら何もしない)"""
+    if not ENABLED:
+        return None
+    trace = Trace(method, path, endpoint, sampled=random.random() < SAMPLE_RATE)
+    _local.trace = trace
+    return trace
+
+
+def finish():
+    """リクエスト終了時に呼び、遅いリクエストかサンプル対象なら保持する"""
+    trace = current_trace()
+    if trace is None:
+        return None
+    _local.trace = None
+    trace.duration = time.perf_counter() - trace.started
+    if SLOW_MS > 0 and trace.duration * 1000 >= SLOW_MS:
+        slowest_traces.add(trace)
+    elif trace.sampled:
+        recent_traces.add(trace)
+    return trace
+
+
+@contextmanager
+def span(kind):
+    """現在のスレッドにトレースがあれば、ブロックの所要時間を kind として記録"""
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(kind, time.perf_counter() - started)
+
+
+def bind(func):
+    """スレッドプールで実行する関数に、呼び出し元スレッドのトレースを引き継ぐ"""
+    trace = current_trace()
+    if trace is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        _local.trace = trace
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.trace = None
+    return wrapper
@@ -0,0 +1,166 @@
+"""
+ワーカー間で共有する価格ストア
+
+gunicorn / hypercorn の複数ワーカーが同じ銘柄を別々に取得しないよう、
+取得した価格を WAL モードの SQLite ファイル(本体の DB とは別ファイル)に置く。
+外部サービスは要らない。
+
+- 価格は (asset_type, symbol) ごとに version を持ち、書き込みは
+  version が一致するときだけ成功する(compare-and-set)
+- 取得中の銘柄にはリース(lease_owner, lease_until)を付け、同じ銘柄を
+  取得するのは1プロセス・1スレッドだけにする(single-flight)。他は
+  version が進むのを待って結果を使い、リースが切れたら引き継ぐ
+- ストアが使えないときは呼び出し元がそのまま取得する
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS shared_quotes (
+    asset_type TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    price REAL,
+    fetched_at REAL,
+    version INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until REAL,
+    PRIMARY KEY (asset_type, symbol)
+) WITHOUT ROWID'''
+
+
+class SharedQuoteStore:
+    """価格の共有ストア。get_or_fetch() が通常の入口"""
+
+    def __init__(self, path, ttl=30, lease_seconds=15, poll_interval=0.05, on_result=None):
+        self.path = path
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        # on_result(outcome): hit / fetched / waited / bypass を通知(メトリクス用)
+        self.on_result = on_result
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute(_SCHEMA)
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _owner():
+        return f'{os.getpid()}:{threading.get_ident()}'
+
+    def _notify(self, outcome):
+        if self.on_result is not None:
+            self.on_result(outcome)
+
+    def get(self, asset_type, symbol, max_age=None):
+        """(price, version)。TTL 内の価格がなければ None"""
+        max_age = self.ttl if max_age is None else max_age
+        row = self._conn().execute(
+            'SELECT price, fetched_at, version FROM shared_quotes WHERE asset_type = ? AND symbol = ?',
+            (asset_type, symbol)).fetchone()
+        if row is None or row[0] is None or row[1] is None or time.time() - row[1] > max_age:
+            return None
+        return row[0], row[2]
+
+    def compare_and_set(self, asset_type, symbol, expected_version, price):
+        """version が expected_version のままなら価格を書き込み、リースを外す"""
+        cur = self._conn().execute(
+            '''UPDATE shared_quotes SET price = ?, fetched_at = ?, version = version + 1,
+                   lease_owner = NULL, lease_until = NULL
+               WHERE asset_type = ? AND symbol = ? AND version = ?''',
+            (price, time.time(), asset_type, symbol, expected_version))
+        return cur.rowcount == 1
+
+    def try_lease(self, asset_type, symbol):
+        """リースを取れたら現在の version、他が取得中なら None"""
+        conn = self._conn()
+        owner = self._owner()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                '''INSERT INTO shared_quotes (asset_type, symbol, version, lease_owner, lease_until)
+                   VALUES (?, ?, 0, ?, ?)
+                   ON CONFLICT (asset_type, symbol) DO UPDATE SET
+                       lease_owner = excluded.lease_owner, lease_until = excluded.lease_until
+                   WHERE shared_quotes.lease_until IS NULL OR shared_quotes.lease_until < ?''',
+                (asset_type, symbol, owner, now + self.lease_seconds, now))
+            row = conn.execute(
+                'SELECT lease_owner, version FROM shared_quotes WHERE asset_type = ? AND symbol = ?',
+                (asset_type, symbol)).fetchone()
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row[1] if row[0] == owner else None
+
+    def release(self, asset_type, symbol):
+        """取得に失敗したときにリースを返す"""
+        self._conn().execute(
+            '''UPDATE shared_quotes SET lease_owner = NULL, lease_until = NULL
+               WHERE asset_type = ? AND symbol = ? AND lease_owner = ?''',
+            (asset_type, symbol, self._owner()))
+
+    def get_or_fetch(self, asset_type, symbol, fetch):
+        """TTL 内の価格があれば返し、なければリースを取った1者だけが fetch() する"""
+        try:
+            deadline = time.monotonic() + self.lease_seconds
+            waited = False
+            while True:
+                cached = self.get(asset_type, symbol)
+                if cached is not None:
+                    self._notify('waited' if waited else 'hit')
+                    return cached[0]
+                version = self.try_lease(asset_type, symbol)
+                if version is not None:
+                    break
+                if time.monotonic() > deadline:
+                    # リースが切れる前に待ちきれなかった場合は自分で取得する
+                    self._notify('bypass')
+                    return fetch()
+                waited = True
+                time.sleep(self.poll_interval)
+        except sqlite3.Error as e:
+            logger.error(f"Shared quote store unavailable ({asset_type}:{symbol}): {e}")
+            self._notify('bypass')
+            return fetch()
+
+        try:
+            price = fetch()
+        except Exception:
+            self._release_quietly(asset_type, symbol)
+            raise
+        if price:
+            try:
+                if not self.compare_and_set(asset_type, symbol, version, price):
+                    logger.warning(f"Shared quote for {asset_type}:{symbol} changed while fetching")
+            except sqlite3.Error as e:
+                logger.error(f"Failed to store shared quote {asset_type}:{symbol}: {e}")
+        else:
+            self._release_quietly(asset_type, symbol)
+        self._notify('fetched')
+        return price
+
+    def _release_quietly(self, asset_type, symbol):
+        try:
+            self.release(asset_type, symbol)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to release quote lease {asset_type}:{symbol}: {e}")
+
+    def clear(self):
+        self._conn().execute('DELETE FROM shared_quotes')
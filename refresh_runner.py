@@ -0,0 +1,161 @@
+"""
+夜間の価格更新ランナー
+
+Webプロセスとは別に起動し、全ユーザーが保有する銘柄を重複排除したうえで
+プロセスプールに分割(シャード)して価格を取得する。取得結果はバッチ単位で
+DBに書き込み、最後に各ユーザーの資産スナップショットを記録する。
+
+実行は app の夜間ジョブ(job_runs)として記録し、書き込んだバッチごとに銘柄の
+チェックポイントを残す。途中で止まった場合、同じ日付で起動し直すと残りだけを取得する。
+
+使い方:
+    python refresh_runner.py --processes 4 --threads 8 --batch-size 200
+    python refresh_runner.py --run-date 2024-06-01   # 止まった実行の再開
+"""
+import argparse
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import app as portfolio
+import fetch_log
+
+logger = logging.getLogger('refresh_runner')
+
+
+def split_shards(keys, shard_count):
+    """銘柄リストをラウンドロビンでシャードに分割"""
+    shard_count = max(1, min(shard_count, len(keys)))
+    return [keys[i::shard_count] for i in range(shard_count)]
+
+
+def refresh_shard(args):
+    """ワーカープロセス: 1シャード分の価格をスレッドプールで取得"""
+    shard_index, keys, threads = args
+    started = time.monotonic()
+
+    def fetch(key):
+        asset_type, symbol = key
+        return asset_type, symbol, portfolio.fetch_asset_price(asset_type, symbol)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(fetch, keys))
+
+    # プール終了時は atexit が走らないため、取得ログはここで書き出す
+    if fetch_log.writer is not None:
+        fetch_log.writer.flush()
+
+    prices = [r for r in results if r[2] is not None and r[2] > 0]
+    missed = [(asset_type, symbol) for asset_type, symbol, price in results if not (price and price > 0)]
+    return shard_index, len(keys), prices, time.monotonic() - started, missed
+
+
+def record_snapshots(job_run, force=False):
+    """全ユーザーの資産スナップショットを記録(force なら記録済みでも取り直す)"""
+    if 'snapshots' in job_run['done'] and not force:
+        return
+    started = time.monotonic()
+    try:
+        count = portfolio.record_all_snapshots(job_run['run_date'])
+    except Exception as e:
+        logger.error(f"Failed to record asset snapshots: {e}")
+        portfolio.checkpoint_job(job_run, failed_keys=['snapshots'])
+        return
+    portfolio.checkpoint_job(job_run, ['snapshots'])
+    logger.info(f"Snapshots recorded for {count} users in {time.monotonic() - started:.2f}s")
+
+
+def symbol_keys(results):
+    return [portfolio.job_item_key('symbol', asset_type, symbol) for asset_type, symbol, *_ in results]
+
+
+def run(processes, threads, batch_size, shards=None, snapshots=True, run_date=None):
+    """価格更新を実行し、更新できた銘柄数を返す(完了済みの日付なら何もしない)"""
+    run_date = run_date or datetime.now(timezone(timedelta(hours=9))).date()
+    job_run = portfolio.begin_job_run(portfolio.NIGHTLY_JOB, run_date)
+    if job_run is None:
+        return 0
+    try:
+        updated = refresh(job_run, processes, threads, batch_size, shards)
+        if snapshots:
+            # 再試行で価格を更新できた場合は、記録済みのスナップショットも取り直す
+            record_snapshots(job_run, force=job_run['attempts'] > 1 and updated > 0)
+    except Exception:
+        portfolio.finish_job_run(job_run, 'failed')
+        raise
+    portfolio.finish_job_run(job_run)
+    return updated
+
+
+def refresh(job_run, processes, threads, batch_size, shards=None):
+    """チェックポイントのない銘柄の価格を取得し、更新できた銘柄数を返す"""
+    started = time.monotonic()
+    all_keys = portfolio.load_distinct_symbols()
+    portfolio.checkpoint_job(job_run, total_items=len(all_keys) + 1)
+    keys = [k for k in all_keys if portfolio.job_item_key('symbol', *k) not in job_run['done']]
+    if len(keys) < len(all_keys):
+        logger.info(f"Resuming: {len(all_keys) - len(keys)}/{len(all_keys)} symbols already done")
+    if not keys:
+        logger.info("No symbols to refresh")
+        return 0
+
+    shard_list = split_shards(keys, shards or processes * 4)
+    logger.info(f"Refreshing {len(keys)} symbols in {len(shard_list)} shards "
+                f"({processes} processes x {threads} threads)")
+
+    conn = portfolio.get_db()
+    pending = []
+    failed = []
+    done_symbols = 0
+    updated = 0
+    tasks = [(i, shard, threads) for i, shard in enumerate(shard_list)]
+
+    with multiprocessing.Pool(processes=processes) as pool:
+        for shard_index, size, prices, elapsed, missed in pool.imap_unordered(refresh_shard, tasks):
+            done_symbols += size
+            updated += len(prices)
+            pending.extend(prices)
+            failed.extend(missed)
+            logger.info(f"Shard {shard_index + 1}/{len(shard_list)}: {len(prices)}/{size} symbols in {elapsed:.2f}s "
+                        f"(progress {done_symbols}/{len(keys)})")
+            if len(pending) >= batch_size:
+                portfolio.update_prices_by_symbol(conn, pending)
+                portfolio.checkpoint_job(job_run, symbol_keys(pending), symbol_keys(failed))
+                pending = []
+                failed = []
+
+    if pending or failed:
+        portfolio.update_prices_by_symbol(conn, pending)
+        portfolio.checkpoint_job(job_run, symbol_keys(pending), symbol_keys(failed))
+    conn.close()
+
+    logger.info(f"Price refresh finished: {updated}/{len(keys)} symbols in {time.monotonic() - started:.2f}s")
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='全ユーザーの資産価格を並列に更新する')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='ワーカープロセス数')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='プロセスごとの取得スレッド数')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='シャード数(既定はプロセス数の4倍)')
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help='DBへまとめて書き込む件数')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='資産スナップショットを記録しない')
+    parser.add_argument('--run-date', type=date.fromisoformat, default=None,
+                        help='実行日(YYYY-MM-DD、既定は今日)。止まった実行を再開するときに指定')
+    args = parser.parse_args()
+
+    portfolio.ensure_db_initialized()
+    run(args.processes, args.threads, args.batch_size,
+        shards=args.shards, snapshots=not args.no_snapshot, run_date=args.run_date)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+現在の配分のモンテカルロシミュレーション
+
+asset_history から資産クラス別の日次リターンを求め、連続した BLOCK_DAYS 日ずつ
+復元抽出(ムービングブロック・ブートストラップ)して、現在の評価額(ダッシュボードの
+円グラフと同じ資産クラス別の合計)のまま保有し続けた場合の総資産の分布を求める。
+同じ期間の全資産クラスのリターンをまとめて抽出するので、資産クラス間の相関と
+ブロック内の自己相関は保たれる。ブロックの対数リターンの和は累積和の差で前もって
+求めておくので、抽出の回数は日数ではなくブロック数になる。
+
+入出金は記録していないため、前日比が FLOW_THRESHOLD を超える日のリターンは売買や
+入出金によるものとみなして0にする。
+
+パスはチャンクに分けてプロセスプールで計算する(Web ワーカーの GIL と CPU を
+占有しないよう、プールのプロセスは nice を下げて動かす)。numpy は計算する関数の中で
+import する。
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 期間 → 日数
+HORIZONS = {'1m': 30, '3m': 91, '6m': 182, '1y': 365, '3y': 1095, '5y': 1826, '10y': 3652}
+
+# 返す分位点(%)
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# 1日でこれを超える増減は相場ではなく売買・入出金とみなす
+FLOW_THRESHOLD = 0.3
+
+# 分位点を返す時点の数の目安(期間の終わりを含む)
+CHECKPOINTS = 24
+
+# ブートストラップで連続して抽出する日数
+BLOCK_DAYS = 21
+
+
+def class_returns(history):
+    """HistoryColumns から資産クラス別の日次リターン(日数-1 × 資産クラス)を求める"""
+    import numpy as np
+
+    values = history.values
+    if len(values) < 2:
+        return np.zeros((0, values.shape[1]))
+    previous = values[:-1]
+    valid = previous > 0
+    returns = np.where(valid, values[1:] / np.where(valid, previous, 1.0) - 1, 0.0)
+    returns[np.abs(returns) > FLOW_THRESHOLD] = 0.0
+    return returns
+
+
+def checkpoint_days(horizon, count=CHECKPOINTS, block=BLOCK_DAYS):
+    """分位点を返す日(1..horizon の昇順、最後は horizon)。間隔はブロックの倍数にそろえる"""
+    step = block * max(1, -(-horizon // (count * block)))
+    return list(range(step, horizon, step)) + [horizon]
+
+
+def simulate_chunk(log_growth, allocation, days, paths, seed, block=BLOCK_DAYS):
+    """paths 本の総資産を days の各日について返す(len(days) × paths)
+
+    log_growth は log(1 + 日次リターン)(日数 × 資産クラス)、allocation は開始時の評価額。
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    block = max(1, min(block, len(log_growth)))
+    prefix = np.concatenate((np.zeros((1, log_growth.shape[1])), np.cumsum(log_growth, axis=0)))
+    block_sums = {}
+
+    def blocks(length):
+        # 長さ length の連続した期間(重なりあり)ごとの対数リターンの和
+        if length not in block_sums:
+            block_sums[length] = prefix[length:] - prefix[:-length]
+        return block_sums[length]
+
+    totals = np.empty((len(days), paths))
+    cumulative = np.zeros((paths, log_growth.shape[1]))
+    previous = 0
+    for i, day in enumerate(days):
+        full, rest = divmod(day - previous, block)
+        if full:
+            table = blocks(block)
+            cumulative += table[rng.integers(0, len(table), size=(paths, full))].sum(axis=1)
+        if rest:
+            table = blocks(rest)
+            cumulative += table[rng.integers(0, len(table), size=paths)]
+        totals[i] = np.exp(cumulative) @ allocation
+        previous = day
+    return totals
+
+
+def _lower_priority():
+    """プールのプロセスは Web ワーカーより低い優先度で動かす"""
+    try:
+        os.nice(5)
+    except (AttributeError, OSError):
+        pass
+
+
+class Simulator:
+    """パスをチャンクに分けてプロセスプールで計算する。workers=0 なら呼び出し元で計算"""
+
+    def __init__(self, workers=2, chunk_paths=5000, timeout=0.8):
+        self.workers = workers
+        self.chunk_paths = chunk_paths
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                # fork だとスケジューラなどのスレッドを抱えたまま複製されるので避ける
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context, initializer=_lower_priority)
+            return self._pool
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self._reset()
+
+    def run(self, returns, allocation, horizon, paths, seed=0):
+        """総資産の分位点の推移と期間末の要約を返す"""
+        import numpy as np
+
+        allocation = np.asarray(allocation, dtype=float)
+        start_value = float(allocation.sum())
+        days = checkpoint_days(horizon)
+        result = {
+            'horizon_days': horizon,
+            'paths': paths,
+            'start_value': start_value,
+            'sample_days': len(returns),
+            'days': days,
+            'bands': {str(p): [start_value] * len(days) for p in PERCENTILES},
+            'mean': start_value,
+            'probability_of_loss': 0.0,
+            'partial': False,
+        }
+        # 評価額のない資産クラスと、ブートストラップする日がない場合は計算しない
+        held = allocation > 0
+        if not held.any() or len(returns) == 0:
+            return result
+        log_growth = np.log1p(np.asarray(returns)[:, held])
+        allocation = allocation[held]
+
+        chunks = [min(self.chunk_paths, paths - start) for start in range(0, paths, self.chunk_paths)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        if self.workers > 0 and len(chunks) > 1:
+            parts = self._run_pool(log_growth, allocation, days, chunks, seeds)
+        else:
+            parts = [simulate_chunk(log_growth, allocation, days, n, s) for n, s in zip(chunks, seeds)]
+        totals = np.concatenate(parts, axis=1)
+        # 期限までに終わらなかったチャンクがあれば、少ないパス数で求めたことを返す
+        result['paths'] = totals.shape[1]
+        result['partial'] = totals.shape[1] < paths
+
+        bands = np.percentile(totals, PERCENTILES, axis=1)
+        final = totals[-1]
+        result.update({
+            'bands': {str(p): band.tolist() for p, band in zip(PERCENTILES, bands)},
+            'mean': float(final.mean()),
+            'probability_of_loss': float((final < start_value).mean()),
+        })
+        return result
+
+    def _run_pool(self, log_growth, allocation, days, chunks, seeds):
+        try:
+            executor = self._executor()
+            futures = [executor.submit(simulate_chunk, log_growth, allocation, days, n, s)
+                       for n, s in zip(chunks, seeds)]
+            # 期限はチャンクごとではなく全体で1つ。間に合わなければ待っているチャンクは取り消し、
+            # 終わったチャンクだけで分位点を求める(計算中のチャンクは止められないので、
+            # プールで最後まで計算して捨てられる)。1つも終わっていなければ TimeoutError
+            _, not_done = concurrent.futures.wait(futures, timeout=self.timeout)
+            if not_done:
+                for f in not_done:
+                    f.cancel()
+                if len(not_done) == len(futures):
+                    raise concurrent.futures.TimeoutError(f"no chunks finished after {self.timeout}s")
+                logger.warning(f"Simulation deadline passed: using {len(futures) - len(not_done)} "
+                               f"of {len(futures)} chunks")
+            return [f.result() for f in futures if f not in not_done]
+        except concurrent.futures.BrokenExecutor as e:
+            # 壊れたプールは作り直し、今回は呼び出し元で計算する
+            logger.error(f"Simulation pool broken, running inline: {e}")
+            self._reset()
+            return [simulate_chunk(log_growth, allocation, days, n, s) for n, s in zip(chunks, seeds)]
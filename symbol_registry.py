@@ -0,0 +1,135 @@
+"""
+銘柄レジストリ
+
+暗号資産・投資信託・金・保険種類など、対応する銘柄を symbols テーブルで管理する。
+1銘柄ごとに取得元・URLテンプレート・パース方法・更新間隔を持ち、プロセス内では
+(asset_type, symbol) の辞書で引く。TTL ごと(または reload() で即時)に読み直すので、
+銘柄の追加に再デプロイは要らない。
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# url_template の {symbol} は銘柄、{minkabu} などは取得元のベースURLに置き換える
+# parser: 価格ページのパース方法(app.PAGE_PARSERS のキー)。None なら自動取得しない
+# cadence_minutes: 資産クラスの既定より長い間隔で更新したい場合に指定(None なら既定)
+Instrument = namedtuple('Instrument', ['asset_type', 'symbol', 'name', 'source', 'url_template',
+                                       'parser', 'cadence_minutes', 'enabled'])
+
+# 初期データ(init_db で未登録のものだけ投入する)
+DEFAULT_INSTRUMENTS = [
+    Instrument('crypto', 'BTC', 'BTC', 'minkabu', '{minkabu}/pair/{symbol}_JPY', 'minkabu_pair', None, True),
+    Instrument('crypto', 'ETH', 'ETH', 'minkabu', '{minkabu}/pair/{symbol}_JPY', 'minkabu_pair', None, True),
+    Instrument('crypto', 'XRP', 'XRP', 'minkabu', '{minkabu}/pair/{symbol}_JPY', 'minkabu_pair', None, True),
+    Instrument('crypto', 'DOGE', 'DOGE', 'minkabu', '{minkabu}/pair/{symbol}_JPY', 'minkabu_pair', None, True),
+    Instrument('investment_trust', 'S&P500', 'S&P500', 'rakuten', '{rakuten}?ID=JP90C000GKC6', 'rakuten_fund',
+               None, True),
+    Instrument('investment_trust', 'オルカン', 'オルカン', 'rakuten', '{rakuten}?ID=JP90C000H1T1', 'rakuten_fund',
+               None, True),
+    Instrument('investment_trust', 'FANG+', 'FANG+', 'rakuten', '{rakuten}?ID=JP90C000FZD4', 'rakuten_fund',
+               None, True),
+    Instrument('gold', '', '金 (Gold)', 'tanaka', '{tanaka}', 'tanaka_gold', None, True),
+    Instrument('insurance', '生命保険', '生命保険', None, None, None, None, True),
+    Instrument('insurance', '医療保険', '医療保険', None, None, None, None, True),
+    Instrument('insurance', '学資保険', '学資保険', None, None, None, None, True),
+    Instrument('insurance', '個人年金保険', '個人年金保険', None, None, None, None, True),
+    Instrument('insurance', 'がん保険', 'がん保険', None, None, None, None, True),
+    Instrument('insurance', 'その他', 'その他', None, None, None, None, True),
+]
+
+
+class SymbolRegistry:
+    """symbols テーブルの内容をメモリに持つ(読み直しは辞書ごと差し替える)"""
+
+    def __init__(self, loader=None, ttl=60):
+        self.loader = loader
+        self.ttl = ttl
+        self._by_key = {}
+        self._by_type = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def reload(self):
+        """ローダーから読み直す(失敗時は前回の内容を使い続ける)"""
+        try:
+            instruments = [Instrument(*row) for row in self.loader()]
+        except Exception as e:
+            logger.error(f"Failed to load symbol registry: {e}")
+            instruments = None
+        with self._lock:
+            self._loaded_at = time.monotonic()
+            if instruments is None:
+                return False
+            by_key = {}
+            by_type = {}
+            for instrument in instruments:
+                if not instrument.enabled:
+                    continue
+                by_key[(instrument.asset_type, instrument.symbol)] = instrument
+                by_type.setdefault(instrument.asset_type, []).append(instrument)
+            self._by_key = by_key
+            self._by_type = by_type
+        logger.info(f"Symbol registry loaded: {len(by_key)} instruments")
+        return True
+
+    def _stale(self):
+        loaded_at = self._loaded_at
+        return loaded_at is None or time.monotonic() - loaded_at > self.ttl
+
+    def _ensure_fresh(self):
+        if not self._stale():
+            return
+        # 読み直すのは1スレッドだけ。読み込み済みなら他のスレッドは待たずに前回の内容を使う
+        if not self._reload_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._stale():
+                self.reload()
+        finally:
+            self._reload_lock.release()
+
+    def get(self, asset_type, symbol):
+        self._ensure_fresh()
+        return self._by_key.get((asset_type, symbol))
+
+    def symbols(self, asset_type):
+        """資産タイプの銘柄一覧(登録順)"""
+        self._ensure_fresh()
+        return [instrument.symbol for instrument in self._by_type.get(asset_type, [])]
+
+    def instruments(self, asset_type=None):
+        self._ensure_fresh()
+        if asset_type is not None:
+            return list(self._by_type.get(asset_type, []))
+        return list(self._by_key.values())
+
+
+def instrument_url(instrument, bases):
+    """URLテンプレートを展開(bases は取得元名 → ベースURL)"""
+    if not instrument.url_template:
+        return None
+    return instrument.url_template.format(symbol=instrument.symbol, **bases)
+
+
+def checked_instrument_url(instrument, bases, hosts):
+    """instrument_url を展開し、http(s) で hosts のいずれか宛てであることを確かめる
+
+    source は bases のキーでなければならない。満たさなければ ValueError。
+    """
+    if instrument.source is not None and instrument.source not in bases:
+        raise ValueError(f"unknown source: {instrument.source}")
+    try:
+        url = instrument_url(instrument, bases)
+    except (AttributeError, IndexError, KeyError, ValueError) as e:
+        raise ValueError(f"invalid url_template: {e!r}")
+    if url is None:
+        return None
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or (parts.hostname or '').lower() not in hosts:
+        raise ValueError(f"url_template must be http(s) to one of: {', '.join(sorted(hosts))}")
+    return url
@@ -0,0 +1,108 @@
+"""テスト共通の設定
+
+app は import 時に環境変数を読むので、import より前に設定する。SQLite の DB
+(portfolio.db)はカレントディレクトリに作られるため、テストごとに一時ディレクトリへ移る。
+"""
+import os
+import sys
+
+import pytest
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault('DISABLE_SCHEDULER', '1')
+os.environ.setdefault('FETCH_LOG', '0')
+os.environ.setdefault('SHARED_QUOTES', '0')
+os.environ.setdefault('PREFETCH_ON_LOGIN', '0')
+for name in ('DATABASE_URL', 'DATABASE_READ_URL', 'ADMIN_TOKEN', 'METRICS_TOKEN'):
+    os.environ.pop(name, None)
+
+# 外部への GET を止める前の requests.get(ローカルのスタブに送るテスト用)
+REAL_GET = requests.get
+
+# init_db が作る demo ユーザー
+DEMO_USER_ID = 1
+
+
+class UnexpectedRequest(AssertionError):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    """テストから外部へ GET しない(必要なテストは requests.get を差し替える)"""
+    def refuse(url, *args, **kwargs):
+        raise UnexpectedRequest(f'unexpected GET {url}')
+
+    monkeypatch.setattr(requests, 'get', refuse)
+
+
+@pytest.fixture
+def portfolio(tmp_path, monkeypatch):
+    """一時ディレクトリの SQLite で初期化した app モジュール(プロセス内のキャッシュも空にする)"""
+    monkeypatch.chdir(tmp_path)
+    import app
+    app.init_db()
+    app.invalidate_user_cache()
+    app.analytics_cache.invalidate()
+    app.page_cache.clear()
+    app.fx_rates.clear()
+    app.instrument_registry.reload()
+    app.stock_index.reload()
+    with app._last_fetched_lock:
+        app._last_fetched.clear()
+    yield app
+    app.invalidate_user_cache()
+
+
+@pytest.fixture
+def client(portfolio):
+    portfolio.app.config['TESTING'] = True
+    return portfolio.app.test_client()
+
+
+def login(client, user_id=1):
+    """セッションに user_id を入れてログイン済みにする"""
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+
+def make_response(url, content=b'', status=200, headers=None):
+    """requests.get の戻り値の代わりに使う Response"""
+    response = requests.models.Response()
+    response.url = url
+    response.status_code = status
+    response._content = content if isinstance(content, bytes) else content.encode('utf-8')
+    response.headers.update(headers or {})
+    return response
+
+
+def add_asset(portfolio, user_id, asset_type, symbol, quantity, price=0, avg_cost=0, name=None):
+    """assets に1行追加(価格を取りに行かない)"""
+    conn = portfolio.get_db()
+    conn.execute('''INSERT INTO assets (user_id, asset_type, symbol, name, quantity, price, avg_cost)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''', (user_id, asset_type, symbol, name, quantity, price, avg_cost))
+    conn.commit()
+    conn.close()
+
+
+def quote_prices(portfolio):
+    """quotes の {(asset_type, symbol): price}"""
+    conn = portfolio.get_db()
+    rows = conn.execute('SELECT asset_type, symbol, price FROM quotes').fetchall()
+    conn.close()
+    return {(row['asset_type'], row['symbol']): row['price'] for row in rows}
+
+
+def add_user(portfolio, username):
+    """users に1行追加して id を返す"""
+    conn = portfolio.get_db()
+    c = conn.cursor()
+    c.execute("INSERT INTO users (username, password_hash) VALUES (?, 'x')", (username,))
+    conn.commit()
+    user_id = c.lastrowid
+    conn.close()
+    return user_id
@@ -0,0 +1,120 @@
+from datetime import date, timedelta
+
+import pytest
+
+import analytics
+from conftest import DEMO_USER_ID, login
+
+# (record_date, jp_stock, us_stock, cash, gold, crypto, investment_trust, insurance, total)
+ROWS = [
+    ('2024-01-01', 50, 0, 50, 0, 0, 0, 0, 100),
+    ('2024-01-02', 70, 0, 50, 0, 0, 0, 0, 120),
+    ('2024-01-03', 40, 0, 50, None, 0, 0, 0, 90),
+]
+
+
+def test_metrics_of_a_known_series():
+    result = analytics.compute_metrics(analytics.HistoryColumns.from_rows(ROWS))
+    assert (result['points'], result['start'], result['end']) == (3, '2024-01-01', '2024-01-03')
+    assert result['time_weighted_return'] == pytest.approx(-0.1)
+    assert result['annualized_return'] == pytest.approx(0.9 ** (365 / 2) - 1)
+    assert result['volatility'] == pytest.approx(0.45 / 2 ** 0.5 * 365 ** 0.5)
+    assert result['max_drawdown'] == pytest.approx(-0.25)
+    assert (result['max_drawdown_peak'], result['max_drawdown_trough']) == ('2024-01-02', '2024-01-03')
+    assert result['current_drawdown'] == pytest.approx(-0.25)
+    assert result['series']['cumulative_return'] == pytest.approx([0.0, 0.2, -0.1])
+    assert result['series']['drawdown'] == pytest.approx([0.0, 0.0, -0.25])
+    # 寄与の合計は時間加重リターンに一致する
+    assert result['contribution']['jp_stock'] == pytest.approx(-0.1)
+    assert sum(result['contribution'].values()) == pytest.approx(result['time_weighted_return'])
+
+
+def test_metrics_of_short_series():
+    empty = analytics.compute_metrics(analytics.HistoryColumns.from_rows([]))
+    assert (empty['points'], empty['start'], empty['time_weighted_return']) == (0, None, 0.0)
+    single = analytics.compute_metrics(analytics.HistoryColumns.from_rows(ROWS[:1]))
+    assert (single['points'], single['end_value'], single['volatility']) == (1, 100.0, None)
+
+
+def test_zero_total_days_do_not_divide_by_zero():
+    rows = [('2024-01-01', 0, 0, 0, 0, 0, 0, 0, 0), ('2024-01-02', 0, 0, 100, 0, 0, 0, 0, 100),
+            ('2024-01-03', 0, 0, 110, 0, 0, 0, 0, 110)]
+    result = analytics.compute_metrics(analytics.HistoryColumns.from_rows(rows))
+    assert result['time_weighted_return'] == pytest.approx(0.1)
+    assert result['contribution']['cash'] == pytest.approx(0.1)
+
+
+def test_cache_expires_and_evicts(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(analytics.time, 'monotonic', lambda: now[0])
+    cache = analytics.AnalyticsCache(max_entries=2, ttl=60)
+    cache.put((1, '1y'), 'a', version=1)
+    cache.put((2, '1y'), 'b', version=1)
+    assert cache.get((1, '1y'), version=1) == 'a'
+    assert cache.get((1, '1y'), version=2) is None
+    assert cache.get((1, '1y'), version=1) is None
+
+    cache.put((1, '1y'), 'a', version=1)
+    cache.put((3, '1y'), 'c', version=1)
+    assert cache.get((2, '1y'), version=1) is None
+    now[0] = 61
+    assert cache.get((3, '1y'), version=1) is None
+
+    cache.put((1, '1m'), 'x')
+    cache.put((4, '1m'), 'y')
+    cache.invalidate(1)
+    assert (cache.get((1, '1m')), cache.get((4, '1m'))) == (None, 'y')
+
+
+def insert_history(portfolio, days_ago, total):
+    record_date = date.today() - timedelta(days=days_ago)
+    conn = portfolio.get_db()
+    conn.execute('''INSERT INTO asset_history (user_id, record_date, cash_value, total_value) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (user_id, record_date) DO UPDATE SET
+                        cash_value = excluded.cash_value, total_value = excluded.total_value''',
+                 (DEMO_USER_ID, record_date, total, total))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def computed(portfolio, monkeypatch):
+    calls = []
+    compute = analytics.compute_metrics
+
+    def counting(history):
+        calls.append(len(history))
+        return compute(history)
+    monkeypatch.setattr(analytics, 'compute_metrics', counting)
+    return calls
+
+
+def test_cached_until_history_changes(portfolio, computed):
+    insert_history(portfolio, 2, 100)
+    insert_history(portfolio, 1, 110)
+    first = portfolio.portfolio_analytics(DEMO_USER_ID, 'all')
+    assert portfolio.portfolio_analytics(DEMO_USER_ID, 'all') is first
+    assert computed == [2]
+
+    # 他のワーカーの書き込み(このプロセスの invalidate を通らない)でも version が変わる
+    insert_history(portfolio, 0, 121)
+    assert portfolio.portfolio_analytics(DEMO_USER_ID, 'all')['time_weighted_return'] == pytest.approx(0.21)
+    # 同じ日の上書きは行数も記録日も変えない
+    insert_history(portfolio, 0, 99)
+    assert portfolio.portfolio_analytics(DEMO_USER_ID, 'all')['end_value'] == 99
+    assert computed == [2, 3, 3]
+
+
+def test_api_analytics(client, portfolio, computed):
+    assert client.get('/api/analytics').status_code == 401
+    login(client)
+    assert client.get('/api/analytics?range=2w').status_code == 400
+
+    insert_history(portfolio, 40, 100)
+    insert_history(portfolio, 1, 150)
+    insert_history(portfolio, 0, 120)
+    data = client.get('/api/analytics?range=1m').get_json()
+    assert (data['range'], data['points'], data['start_value']) == ('1m', 2, 150)
+    assert client.get('/api/analytics?range=1m').get_json() == data
+    assert client.get('/api/analytics?range=all').get_json()['points'] == 3
+    assert computed == [2, 3]
@@ -0,0 +1,51 @@
+import subprocess
+import sys
+
+from conftest import ROOT
+
+HEAVY_MODULES = ('requests', 'bs4', 'apscheduler', 'psycopg2', 'numpy')
+
+
+def test_import_does_not_load_heavy_dependencies(tmp_path):
+    code = ('import sys, app; '
+            f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True, text=True,
+                            env={'PYTHONPATH': ROOT, 'PATH': ''}, check=True)
+    assert result.stdout.strip() == ''
+    # import だけではDBを作らない
+    assert not (tmp_path / 'portfolio.db').exists()
+
+
+def test_ensure_db_initialized_only_runs_for_old_schema(portfolio):
+    assert portfolio.get_schema_version() == portfolio.SCHEMA_VERSION
+    assert portfolio.ensure_db_initialized() is False
+
+    conn = portfolio.get_db()
+    conn.execute('UPDATE schema_version SET version = 1')
+    conn.commit()
+    conn.close()
+    assert portfolio.ensure_db_initialized() is True
+    assert portfolio.get_schema_version() == portfolio.SCHEMA_VERSION
+
+
+def test_create_app_runs_side_effects_once(portfolio, monkeypatch):
+    calls = []
+    monkeypatch.setattr(portfolio, '_app_initialized', False)
+    monkeypatch.setattr(portfolio, 'SCHEDULER_DISABLED', False)
+    monkeypatch.setattr(portfolio, 'ensure_db_initialized', lambda: calls.append('schema'))
+    monkeypatch.setattr(portfolio, 'start_leader_election', lambda: calls.append('leader'))
+    monkeypatch.setattr(portfolio.atexit, 'register', lambda func: calls.append(func.__name__))
+
+    assert portfolio.create_app() is portfolio.app
+    assert portfolio.create_app() is portfolio.app
+    assert calls == ['schema', 'leader', 'shutdown_scheduler']
+
+
+def test_create_app_without_scheduler(portfolio, monkeypatch):
+    calls = []
+    monkeypatch.setattr(portfolio, '_app_initialized', False)
+    monkeypatch.setattr(portfolio, 'SCHEDULER_DISABLED', True)
+    monkeypatch.setattr(portfolio, 'start_leader_election', lambda: calls.append('leader'))
+
+    portfolio.create_app()
+    assert calls == []
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+import pytest
+import requests
+
+from conftest import REAL_GET, ROOT
+
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import bench_refresh  # noqa: E402
+from fake_upstream import FakeUpstream, symbol_price  # noqa: E402
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert bench_refresh.percentile(values, 50) == 50
+    assert bench_refresh.percentile(values, 95) == 95
+    assert bench_refresh.percentile(values, 100) == 100
+    assert bench_refresh.percentile([7.0], 99) == 7.0
+    assert bench_refresh.percentile([], 50) == 0.0
+
+
+def test_compare_reports_p95_regressions(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'results': [
+        {'name': 'dashboard', 'p95': 10.0}, {'name': 'record_all_snapshots', 'p95': 100.0}]}))
+    results = [{'name': 'dashboard', 'p95': 12.5}, {'name': 'record_all_snapshots', 'p95': 115.0},
+               {'name': 'new_benchmark', 'p95': 1000.0}]
+    assert bench_refresh.compare(results, str(baseline), 0.2) == [('dashboard', 10.0, 12.5)]
+
+
+@pytest.fixture
+def upstream(portfolio, monkeypatch):
+    """app の取得先を fake_upstream に向ける"""
+    server = FakeUpstream().start()
+    env = server.env()
+    monkeypatch.setattr(requests, 'get', REAL_GET)
+    monkeypatch.setattr(portfolio, 'YAHOO_CHART_URL', env['YAHOO_CHART_URL'])
+    monkeypatch.setattr(portfolio, 'YAHOO_CHART_MIRRORS', [])
+    for source, name in (('minkabu', 'MINKABU_URL'), ('tanaka', 'TANAKA_GOLD_URL'), ('rakuten', 'RAKUTEN_FUND_URL')):
+        monkeypatch.setitem(portfolio.SOURCE_BASE_URLS, source, env[name])
+    monkeypatch.setattr(portfolio, 'SYMBOL_URL_HOSTS', frozenset(['127.0.0.1']))
+    yield server
+    server.stop()
+
+
+def test_fixtures_are_parsed_by_the_real_scrapers(portfolio, upstream):
+    """ベンチマークが取得失敗ばかりを計測しないよう、スタブの応答が価格として読めること"""
+    assert portfolio.fetch_upstream_price('jp_stock', '7203') == symbol_price('7203.T', 500, 12000)
+    assert portfolio.fetch_upstream_price('us_stock', 'AAPL') == symbol_price('AAPL', 10, 900)
+    assert portfolio.fetch_upstream_price('crypto', 'BTC') == pytest.approx(symbol_price('BTC', 10, 15000000))
+    assert portfolio.fetch_upstream_price('gold', '') == int(symbol_price('GOLD', 15000, 25000))
+    assert portfolio.fetch_upstream_price('investment_trust', 'S&P500') == int(
+        symbol_price('JP90C000GKC6', 10000, 40000))
+    assert upstream.errors == 0
+
+
+def test_fake_upstream_injects_errors_and_not_modified(upstream):
+    url = upstream.env()['YAHOO_CHART_URL'] + '/AAPL'
+    upstream.etag = True
+    first = REAL_GET(url)
+    assert first.status_code == 200
+    second = REAL_GET(url, headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 304
+    assert upstream.not_modified == 1
+
+    upstream.error_rate = 1.0
+    assert REAL_GET(url).status_code == 500
+    assert upstream.errors == 1
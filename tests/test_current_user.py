@@ -0,0 +1,65 @@
+from conftest import DEMO_USER_ID
+
+
+def counting_get_db(portfolio, monkeypatch):
+    calls = []
+    get_db = portfolio.get_db
+
+    def counted(readonly=False):
+        calls.append(readonly)
+        return get_db(readonly)
+
+    monkeypatch.setattr(portfolio, 'get_db', counted)
+    return calls
+
+
+def test_load_user_is_cached_without_password_hash(portfolio, monkeypatch):
+    calls = counting_get_db(portfolio, monkeypatch)
+
+    user = portfolio.load_user(DEMO_USER_ID)
+    assert user['username'] == 'demo'
+    assert 'password_hash' not in user
+    assert portfolio.load_user(DEMO_USER_ID) is user
+    assert calls == [True]
+
+    portfolio.invalidate_user_cache(DEMO_USER_ID)
+    portfolio.load_user(DEMO_USER_ID)
+    assert calls == [True, True]
+
+
+def test_expired_user_is_reloaded(portfolio, monkeypatch):
+    calls = counting_get_db(portfolio, monkeypatch)
+    monkeypatch.setattr(portfolio, 'USER_CACHE_TTL', -1)
+    portfolio.load_user(DEMO_USER_ID)
+    portfolio.load_user(DEMO_USER_ID)
+    assert len(calls) == 2
+
+
+def test_unknown_user_is_not_cached(portfolio):
+    assert portfolio.load_user(999) is None
+    assert 999 not in portfolio._user_cache
+
+
+def test_current_user_is_loaded_once_per_request(portfolio, monkeypatch):
+    loads = []
+    load_user = portfolio.load_user
+    monkeypatch.setattr(portfolio, 'load_user', lambda user_id: loads.append(user_id) or load_user(user_id))
+
+    with portfolio.app.test_request_context():
+        assert portfolio.get_current_user() is None
+        portfolio.session['user_id'] = DEMO_USER_ID
+        first = portfolio.get_current_user()
+        assert portfolio.get_current_user() is first
+    assert loads == [DEMO_USER_ID]
+
+
+def test_login_caches_user(client, portfolio, monkeypatch):
+    response = client.post('/login', data={'username': 'demo', 'password': 'demo123'})
+    assert response.status_code == 302
+    assert DEMO_USER_ID in portfolio._user_cache
+
+    calls = counting_get_db(portfolio, monkeypatch)
+    with client:
+        client.get('/')
+        assert portfolio.g.current_user['username'] == 'demo'
+    assert calls == []
@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+import requests
+
+import fetch_log
+from conftest import make_response
+
+GOLD_PAGE = '<table><tr><td>GOLD</td><td>15,230 yen</td></tr></table>'
+
+
+@pytest.fixture
+def writer(portfolio, monkeypatch):
+    """DBに書き込む取得ログ(バックグラウンドの書き込みは待たずに flush で書く)"""
+    log_writer = fetch_log.FetchLogWriter(portfolio.write_fetch_log, flush_interval=3600)
+    monkeypatch.setattr(fetch_log, 'writer', log_writer)
+    return log_writer
+
+
+def test_writer_batches_and_drops_when_full():
+    batches = []
+    log_writer = fetch_log.FetchLogWriter(batches.append, batch_size=100, flush_interval=3600, max_queue=3)
+    for i in range(5):
+        log_writer.put({'i': i})
+    assert log_writer.dropped == 2
+
+    log_writer.flush()
+    log_writer.flush()
+    assert batches == [[{'i': 0}, {'i': 1}, {'i': 2}]]
+
+
+def test_writer_wakes_up_when_batch_is_full():
+    written = threading.Event()
+    log_writer = fetch_log.FetchLogWriter(lambda batch: written.set(), batch_size=2, flush_interval=3600)
+    log_writer.put({})
+    log_writer.put({})
+    assert written.wait(5)
+
+
+def test_write_failure_is_logged_not_raised(caplog):
+    def broken(batch):
+        raise RuntimeError('db down')
+
+    log_writer = fetch_log.FetchLogWriter(broken, flush_interval=3600)
+    log_writer.put({})
+    log_writer.flush()
+    assert 'Failed to write 1 fetch log entries' in caplog.text
+
+
+def test_entries_without_writer_are_discarded(monkeypatch):
+    monkeypatch.setattr(fetch_log, 'writer', None)
+    fetch_log.begin('scraper', 'X')
+    fetch_log.end(1.0)
+
+
+def test_scraper_call_is_logged_with_http_and_strategy(portfolio, writer, monkeypatch):
+    monkeypatch.setattr(requests, 'get', lambda url, **kwargs: make_response(
+        url, GOLD_PAGE, headers={'Content-Type': 'text/html; charset=utf-8'}))
+    assert portfolio.get_gold_price() == 15230
+
+    monkeypatch.setattr(requests, 'get', lambda url, **kwargs: make_response(url, 'busy', status=503))
+    portfolio.page_cache.clear()
+    assert portfolio.get_gold_price() == 0
+    writer.flush()
+
+    conn = portfolio.get_db()
+    rows = [dict(row) for row in conn.execute('SELECT * FROM fetch_log ORDER BY id')]
+    conn.close()
+    assert [(r['scraper'], r['source'], r['http_status'], r['strategy'], r['price']) for r in rows] == [
+        ('get_gold_price', 'tanaka', '200', 'gold_row', 15230),
+        ('get_gold_price', 'tanaka', '503', None, None),
+    ]
+    assert rows[0]['bytes'] == len(GOLD_PAGE)
+    assert rows[0]['latency_ms'] >= 0
+
+
+def test_admin_fetch_log_summarizes_failures(client, portfolio, writer, monkeypatch):
+    for price in (100, None, None):
+        fetch_log.begin('get_crypto_price', 'BTC')
+        fetch_log.note_http('minkabu', 200, 1000, 0.25)
+        fetch_log.end(price)
+    fetch_log.begin('get_crypto_price', 'ETH')
+    fetch_log.note_http('minkabu', 200, 1000, 0.01)
+    fetch_log.end(5)
+    writer.flush()
+
+    assert client.get('/admin/fetch_log').status_code == 404
+    monkeypatch.setenv('ADMIN_TOKEN', 'admin')
+    assert client.get('/admin/fetch_log', headers={'Authorization': 'Bearer nope'}).status_code == 401
+
+    response = client.get('/admin/fetch_log?failing=1', headers={'Authorization': 'Bearer admin'})
+    assert response.status_code == 200
+    symbols = response.get_json()['symbols']
+    assert [(s['symbol'], s['fetches'], s['failures'], s['avg_latency_ms']) for s in symbols] == [
+        ('BTC', 3, 2, 250.0)]
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+import fx
+from conftest import DEMO_USER_ID, add_asset, login
+from holdings import Portfolio
+
+
+class Fetcher:
+    def __init__(self, *rates):
+        self.rates = list(rates)
+        self.calls = []
+
+    def __call__(self, currency, base):
+        self.calls.append((currency, base))
+        rate = self.rates.pop(0)
+        if isinstance(rate, Exception):
+            raise rate
+        return rate
+
+
+def test_rates_are_cached_for_ttl():
+    fetch = Fetcher(150.0, 151.0)
+    rates = fx.FxRates(fetch, ttl=3600)
+    assert rates.rate('USD') == 150.0
+    assert rates.rate('USD') == 150.0
+    assert rates.rate('JPY') == 1.0
+    assert fetch.calls == [('USD', 'JPY')]
+
+    rates.clear()
+    assert rates.rate('USD') == 151.0
+
+
+def test_failed_fetch_uses_stale_then_fallback_rate(caplog):
+    rates = fx.FxRates(Fetcher(RuntimeError('timeout'), 152.0, None), ttl=0)
+    assert rates.rate('USD') == 150.0
+    assert 'Using fallback USD/JPY rate 150.0' in caplog.text
+    assert rates.rate('USD') == 152.0
+    assert rates.rate('USD') == 152.0
+    assert 'Using stale USD/JPY rate 152.0' in caplog.text
+
+
+def test_unknown_currency_is_valued_at_zero():
+    rates = fx.FxRates(Fetcher(None), ttl=0)
+    assert rates.rate('EUR') == 0.0
+    assert fx.fallback_rate('JPY', 'USD') == pytest.approx(1 / 150)
+    assert fx.fallback_rate('EUR', 'JPY') is None
+
+
+def test_concurrent_lookups_fetch_once():
+    calls = []
+
+    def slow_fetch(currency, base):
+        calls.append(currency)
+        time.sleep(0.05)
+        return 150.0
+
+    rates = fx.FxRates(slow_fetch, ttl=3600)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(rates.rate('USD'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ['USD']
+    assert results == [150.0] * 8
+
+
+def test_totals_in_another_base_currency():
+    portfolio = Portfolio()
+    portfolio.append(1, 'jp_stock', 100, 3000.0, 2000.0)
+    portfolio.append(1, 'us_stock', 10, 200.0, 100.0)
+    portfolio.append(1, 'crypto', 1, 150000.0, 150000.0, currency='USD')
+
+    assert portfolio.currencies() == {'USD'}
+    assert portfolio.currencies(base='USD') == {'JPY'}
+    totals = portfolio.totals({'JPY': 1 / 150}, base='USD')
+    assert totals['jp_stock'] == (pytest.approx(2000.0), pytest.approx(2000 / 1.5))
+    assert totals['us_stock'] == (2000.0, 1000.0)
+    assert totals['crypto'] == (150000.0, 150000.0)
+    assert portfolio.totals({'USD': 150.0})['us_stock'] == (300000.0, 150000.0)
+
+
+def test_dashboard_renders_with_fallback_rate(client, portfolio):
+    add_asset(portfolio, DEMO_USER_ID, 'us_stock', 'AAPL', 10, price=200.0, avg_cost=100.0)
+    login(client)
+    response = client.get('/dashboard')
+    assert response.status_code == 200
+    # Yahoo に繋がらないので暫定レート(150円)で換算する
+    assert '300,000' in response.get_data(as_text=True)
@@ -0,0 +1,146 @@
+import threading
+
+import pytest
+import requests
+
+import hedging
+from conftest import make_response
+
+PRIMARY = 'https://query1.example.com/v8/finance/chart/AAPL'
+MIRROR = 'https://query2.example.com/v8/finance/chart/AAPL'
+
+
+def test_delay_uses_default_until_enough_samples():
+    tracker = hedging.LatencyTracker(window=100, quantile=0.9, min_samples=10, default_delay=1.0, min_delay=0.05)
+    for i in range(9):
+        tracker.observe('yahoo', 0.1)
+    assert tracker.delay('yahoo') == 1.0
+    assert tracker.delay('minkabu') == 1.0
+
+    for i in range(91):
+        tracker.observe('yahoo', (i + 10) / 100)
+    assert tracker.delay('yahoo') == pytest.approx(0.91)
+
+
+def test_delay_has_a_floor_and_a_window():
+    tracker = hedging.LatencyTracker(window=5, min_samples=5, min_delay=0.05)
+    for _ in range(5):
+        tracker.observe('yahoo', 3.0)
+    for _ in range(5):
+        tracker.observe('yahoo', 0.001)
+    assert tracker.delay('yahoo') == 0.05
+
+
+def test_host_budget_refills_over_time(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(hedging.time, 'monotonic', lambda: now[0])
+    budget = hedging.HostBudget(rate_per_second=0.5, burst=2)
+    assert [budget.try_acquire('a') for _ in range(3)] == [True, True, False]
+    assert budget.try_acquire('b')
+
+    now[0] += 1
+    assert not budget.try_acquire('a')
+    now[0] += 1
+    assert budget.try_acquire('a')
+    assert not budget.try_acquire('a')
+
+
+class Hosts:
+    """URL ごとの応答ステータスと遅延を決めた requests.get の代わり"""
+
+    def __init__(self, statuses, slow=()):
+        self.statuses = statuses
+        self.slow = set(slow)
+        self.released = threading.Event()
+        self.requested = []
+
+    def __call__(self, url, headers=None, timeout=None):
+        self.requested.append(url)
+        if url in self.slow:
+            self.released.wait(5)
+        status = self.statuses[url]
+        if isinstance(status, Exception):
+            raise status
+        return make_response(url, f'{{"from": "{url}"}}', status)
+
+
+@pytest.fixture
+def hedged(portfolio, monkeypatch):
+    monkeypatch.setattr(portfolio, 'HEDGE_ENABLED', True)
+    monkeypatch.setattr(portfolio, 'hedge_latency', hedging.LatencyTracker(default_delay=0.05))
+    monkeypatch.setattr(portfolio, 'hedge_budget', hedging.HostBudget(rate_per_second=0, burst=1))
+    return portfolio
+
+
+def install(monkeypatch, hosts):
+    monkeypatch.setattr(requests, 'get', hosts)
+    return hosts
+
+
+def outcome(portfolio, name):
+    return portfolio.HEDGE_RESULTS._values.get(('yahoo', name), 0)
+
+
+def test_slow_primary_is_hedged_and_mirror_wins(hedged, monkeypatch):
+    hosts = install(monkeypatch, Hosts({PRIMARY: 200, MIRROR: 200}, slow=[PRIMARY]))
+    won = outcome(hedged, 'mirror_won')
+
+    response = hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR])
+    hosts.released.set()
+    assert response.url == MIRROR
+    assert hosts.requested[:2] == [PRIMARY, MIRROR]
+    assert outcome(hedged, 'mirror_won') == won + 1
+
+
+def test_fast_primary_is_not_hedged(hedged, monkeypatch):
+    hosts = install(monkeypatch, Hosts({PRIMARY: 200, MIRROR: 200}))
+    assert hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR]).url == PRIMARY
+    assert hosts.requested == [PRIMARY]
+
+
+def test_exhausted_budget_waits_for_the_primary(hedged, monkeypatch):
+    monkeypatch.setattr(hedged, 'hedge_budget', hedging.HostBudget(rate_per_second=0, burst=0))
+    hosts = install(monkeypatch, Hosts({PRIMARY: 200, MIRROR: 200}, slow=[PRIMARY]))
+    exhausted = outcome(hedged, 'budget_exhausted')
+    threading.Timer(0.2, hosts.released.set).start()
+
+    assert hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR]).url == PRIMARY
+    assert hosts.requested == [PRIMARY]
+    assert outcome(hedged, 'budget_exhausted') == exhausted + 1
+
+
+def test_server_error_is_retried_on_the_mirror(hedged, monkeypatch):
+    hosts = install(monkeypatch, Hosts({PRIMARY: 503, MIRROR: 200}))
+    assert hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR]).url == MIRROR
+    assert hosts.requested == [PRIMARY, MIRROR]
+
+
+def test_client_errors_are_returned_as_is(hedged, monkeypatch):
+    hosts = install(monkeypatch, Hosts({PRIMARY: 404, MIRROR: 200}))
+    assert hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR]).status_code == 404
+    assert hosts.requested == [PRIMARY]
+
+
+def test_all_failed_returns_first_error_response(hedged, monkeypatch):
+    install(monkeypatch, Hosts({PRIMARY: 503, MIRROR: 429}))
+    response = hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR])
+    assert (response.url, response.status_code) == (PRIMARY, 503)
+
+
+def test_all_unreachable_raises(hedged, monkeypatch):
+    install(monkeypatch, Hosts({PRIMARY: requests.ConnectionError('down'), MIRROR: requests.Timeout('slow')}))
+    with pytest.raises(requests.RequestException):
+        hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR])
+
+
+def test_disabled_hedging_sends_one_request(hedged, monkeypatch):
+    monkeypatch.setattr(hedged, 'HEDGE_ENABLED', False)
+    hosts = install(monkeypatch, Hosts({PRIMARY: 503, MIRROR: 200}))
+    assert hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR]).status_code == 503
+    assert hosts.requested == [PRIMARY]
+
+
+def test_successful_latency_is_observed(hedged, monkeypatch):
+    install(monkeypatch, Hosts({PRIMARY: 200, MIRROR: 503}))
+    hedged.http_get_hedged('yahoo', [PRIMARY, MIRROR])
+    assert len(hedged.hedge_latency._samples['yahoo']) == 1
@@ -0,0 +1,124 @@
+import random
+
+import pytest
+
+from conftest import DEMO_USER_ID, add_asset
+from holdings import ASSET_TYPES, Holding, Portfolio, currencies_of, grouped_valuation, valuation
+
+USD_JPY = 151.25
+
+
+def legacy_totals(rows, usd_jpy):
+    """資産タイプごとの (評価額, 取得額) を、以前のダッシュボードの1行ずつの計算で求める"""
+    totals = {}
+    for asset_type in ASSET_TYPES:
+        items = [r for r in rows if r['asset_type'] == asset_type]
+        if asset_type == 'us_stock':
+            value = sum(i['quantity'] * i['price'] for i in items) * usd_jpy
+            cost = sum(i['quantity'] * i['avg_cost'] for i in items) * usd_jpy
+        elif asset_type == 'investment_trust':
+            value = sum(i['quantity'] * i['price'] / 10000 for i in items)
+            cost = sum(i['quantity'] * i['avg_cost'] / 10000 for i in items)
+        elif asset_type == 'insurance':
+            value = sum(i['price'] for i in items)
+            cost = sum(i['avg_cost'] for i in items)
+        elif asset_type == 'cash':
+            value = cost = sum(i['quantity'] for i in items)
+        else:
+            value = sum(i['quantity'] * i['price'] for i in items)
+            cost = sum(i['quantity'] * i['avg_cost'] for i in items)
+        totals[asset_type] = (value, cost)
+    return totals
+
+
+def random_rows(rng, count):
+    rows = []
+    for i in range(count):
+        asset_type = rng.choice(ASSET_TYPES)
+        rows.append({'id': i, 'user_id': 1, 'asset_type': asset_type, 'symbol': f'S{i}', 'name': None,
+                     'quantity': round(rng.uniform(0, 5000), 4), 'price': round(rng.uniform(0, 40000), 2),
+                     'avg_cost': round(rng.uniform(0, 40000), 2)})
+    return rows
+
+
+def assert_totals_equal(actual, expected):
+    assert set(actual) == set(expected)
+    for asset_type, (value, cost) in expected.items():
+        assert actual[asset_type] == (pytest.approx(value, rel=1e-12, abs=1e-6),
+                                      pytest.approx(cost, rel=1e-12, abs=1e-6)), asset_type
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_totals_match_the_old_per_row_math(seed):
+    rows = random_rows(random.Random(seed), 200)
+    portfolio = Portfolio.from_rows(rows)
+    assert_totals_equal(portfolio.totals({'USD': USD_JPY}), legacy_totals(rows, USD_JPY))
+
+    # Holding からでも同じ
+    holdings = [Holding.from_row(row) for row in rows]
+    assert_totals_equal(Portfolio.from_rows(holdings).totals({'USD': USD_JPY}), legacy_totals(rows, USD_JPY))
+    for holding, row in zip(holdings, rows):
+        legacy = legacy_totals([row], 1.0)[row['asset_type']]
+        assert (holding.value, holding.cost) == (pytest.approx(legacy[0]), pytest.approx(legacy[1]))
+
+
+def test_empty_portfolio_totals_are_zero():
+    assert Portfolio().totals() == {asset_type: (0.0, 0.0) for asset_type in ASSET_TYPES}
+
+
+def test_unknown_asset_types_are_ignored():
+    portfolio = Portfolio.from_rows([{'user_id': 1, 'asset_type': 'bond', 'quantity': 1, 'price': 1,
+                                     'avg_cost': 1}])
+    assert len(portfolio) == 0
+
+
+def test_null_columns_count_as_zero():
+    row = {'id': 1, 'user_id': 1, 'asset_type': 'jp_stock', 'symbol': '7203', 'name': None,
+           'quantity': 100, 'price': None, 'avg_cost': None}
+    holding = Holding.from_row(row)
+    assert (holding.value, holding.cost) == (0, 0)
+    assert Portfolio.from_rows([row]).totals()['jp_stock'] == (0.0, 0.0)
+
+
+def test_holding_supports_row_style_access():
+    holding = Holding(1, 2, 'us_stock', 'AAPL', 'Apple', 10, 190.0, 150.0)
+    assert holding['symbol'] == 'AAPL'
+    assert holding.get('currency') == 'USD'
+    assert holding.get('missing', 'x') == 'x'
+    assert dict((key, holding[key]) for key in holding.keys())['quantity'] == 10
+    with pytest.raises(KeyError):
+        holding['missing']
+
+
+def test_grouped_valuation_matches_per_row_valuation():
+    rows = random_rows(random.Random(7), 100)
+    for asset_type in ASSET_TYPES:
+        items = [r for r in rows if r['asset_type'] == asset_type]
+        expected = sum(valuation(asset_type, r['quantity'], r['price']) for r in items)
+        grouped = grouped_valuation(asset_type, sum(r['quantity'] for r in items), sum(r['price'] for r in items),
+                                    sum(r['quantity'] * r['price'] for r in items))
+        assert grouped == pytest.approx(expected)
+
+
+def test_currencies_of():
+    assert currencies_of(['jp_stock', 'us_stock', 'cash']) == {'USD'}
+    assert currencies_of(['jp_stock', 'us_stock'], base='USD') == {'JPY'}
+    assert currencies_of(['unknown']) == set()
+
+
+def test_load_holdings_joins_quotes(portfolio):
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '7203', 100, price=1, avg_cost=2000)
+    add_asset(portfolio, DEMO_USER_ID, 'gold', '金地金', 10, avg_cost=9000)
+    add_asset(portfolio, DEMO_USER_ID, 'cash', '普通預金', 500000)
+    conn = portfolio.get_db()
+    portfolio.write_quotes(conn.cursor(), [('jp_stock', '7203', 2500.0, 'トヨタ自動車'), ('gold', '', 12000.0)])
+    conn.commit()
+    conn.close()
+
+    holdings = portfolio.load_holdings(DEMO_USER_ID)
+    assert [(h.asset_type, h.name, h.price) for h in holdings] == [
+        ('jp_stock', 'トヨタ自動車', 2500.0), ('gold', None, 12000.0), ('cash', None, 0)]
+    totals = Portfolio.from_rows(holdings).totals()
+    assert totals['jp_stock'] == (250000.0, 200000.0)
+    assert totals['gold'] == (120000.0, 90000.0)
+    assert totals['cash'] == (500000.0, 500000.0)
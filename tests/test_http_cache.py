@@ -0,0 +1,120 @@
+import pytest
+import requests
+
+import http_cache
+from conftest import make_response
+
+URL = 'https://fund.example.jp/detail?ID=1'
+PAGE = '<html><head><meta charset="shift_jis"></head><body>基準価額 12,345円</body></html>'
+
+
+class Upstream:
+    """順に応答を返し、送られたヘッダーを記録する requests.get の代わり"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def __call__(self, url, headers=None, timeout=None):
+        self.sent.append(dict(headers or {}))
+        status, content, response_headers = self.responses.pop(0)
+        return make_response(url, content, status, response_headers)
+
+
+@pytest.fixture
+def parse_calls():
+    return []
+
+
+@pytest.fixture
+def parse(parse_calls):
+    def parse_page(text):
+        parse_calls.append(text)
+        return 12345.0 if '基準価額 12,345円' in text else 0.0
+    return parse_page
+
+
+def fetch(portfolio, parse):
+    return portfolio.fetch_page('rakuten', URL, {'User-Agent': 'test'}, parse)
+
+
+def test_declared_encoding():
+    assert http_cache.declared_encoding('text/html; charset=Shift_JIS', b'') == 'shift_jis'
+    assert http_cache.declared_encoding('text/html', b'<meta charset="EUC-JP">') == 'euc_jp'
+    assert http_cache.declared_encoding(None, b'<meta http-equiv="Content-Type" '
+                                              b'content="text/html; charset=utf-8">') == 'utf-8'
+    assert http_cache.declared_encoding('text/html; charset=bogus', b'<meta charset="cp932">') == 'cp932'
+    assert http_cache.declared_encoding('text/html', b'<html>') is None
+
+
+def test_page_cache_evicts_least_recently_used():
+    cache = http_cache.PageCache(max_entries=2)
+    for url in ('a', 'b'):
+        cache.put(url, http_cache.CacheEntry(None, None, url, url))
+    cache.get('a')
+    cache.put('c', http_cache.CacheEntry(None, None, 'c', 'c'))
+    assert cache.get('b') is None
+    assert cache.get('a').result == 'a'
+
+
+def test_not_modified_returns_cached_result(portfolio, parse, parse_calls, monkeypatch):
+    upstream = Upstream(
+        (200, PAGE.encode('shift_jis'), {'ETag': '"v1"', 'Last-Modified': 'Mon, 03 Jun 2024 09:00:00 GMT'}),
+        (304, b'', {'ETag': '"v1"'}))
+    monkeypatch.setattr(requests, 'get', upstream)
+
+    assert fetch(portfolio, parse) == 12345.0
+    assert fetch(portfolio, parse) == 12345.0
+    assert len(parse_calls) == 1
+    assert 'If-None-Match' not in upstream.sent[0]
+    assert upstream.sent[1] == {'User-Agent': 'test', 'If-None-Match': '"v1"',
+                                'If-Modified-Since': 'Mon, 03 Jun 2024 09:00:00 GMT'}
+
+
+def test_unchanged_body_skips_parsing(portfolio, parse, parse_calls, monkeypatch):
+    body = PAGE.encode('shift_jis')
+    monkeypatch.setattr(requests, 'get', Upstream((200, body, {}), (200, body, {}), (200, body + b' ', {})))
+
+    assert [fetch(portfolio, parse) for _ in range(3)] == [12345.0] * 3
+    assert len(parse_calls) == 2
+
+
+def test_failed_parse_is_not_cached(portfolio, parse, parse_calls, monkeypatch):
+    upstream = Upstream((200, b'<html>maintenance</html>', {'ETag': '"m"'}),
+                        (200, PAGE.encode('shift_jis'), {'ETag': '"v1"'}))
+    monkeypatch.setattr(requests, 'get', upstream)
+
+    assert fetch(portfolio, parse) == 0.0
+    assert portfolio.page_cache.get(URL) is None
+    assert fetch(portfolio, parse) == 12345.0
+    assert 'If-None-Match' not in upstream.sent[1]
+
+
+def test_encoding_is_pinned_only_after_a_priced_200(portfolio, parse, parse_calls, monkeypatch):
+    host = 'fund.example.jp'
+    # エラーページ(UTF-8 と宣言)の文字コードは固定しない
+    monkeypatch.setattr(requests, 'get', Upstream(
+        (503, '<meta charset="utf-8">混雑しています'.encode('utf-8'), {})))
+    assert fetch(portfolio, parse) == 0.0
+    assert portfolio.page_cache.encoding_for(host) is None
+
+    monkeypatch.setattr(requests, 'get', Upstream((200, PAGE.encode('shift_jis'), {})))
+    assert fetch(portfolio, parse) == 12345.0
+    assert portfolio.page_cache.encoding_for(host) == 'shift_jis'
+
+    # 固定後は宣言がなくても同じ文字コードで読む
+    portfolio.page_cache.discard(URL)
+    monkeypatch.setattr(requests, 'get', Upstream((200, '<body>基準価額 12,345円</body>'.encode('shift_jis'), {})))
+    assert fetch(portfolio, parse) == 12345.0
+
+
+def test_cache_can_be_disabled(portfolio, parse, parse_calls, monkeypatch):
+    monkeypatch.setattr(portfolio, 'HTTP_CACHE_ENABLED', False)
+    body = PAGE.encode('shift_jis')
+    upstream = Upstream((200, body, {'ETag': '"v1"'}), (200, body, {'ETag': '"v1"'}))
+    monkeypatch.setattr(requests, 'get', upstream)
+
+    fetch(portfolio, parse)
+    fetch(portfolio, parse)
+    assert len(parse_calls) == 2
+    assert 'If-None-Match' not in upstream.sent[1]
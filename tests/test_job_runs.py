@@ -0,0 +1,163 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+from conftest import DEMO_USER_ID, add_user
+
+RUN_DATE = date(2024, 6, 3)
+JOB = 'test_job'
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.jobs = []
+
+    def add_job(self, **kwargs):
+        self.jobs.append(kwargs)
+
+
+@pytest.fixture
+def scheduler(portfolio, monkeypatch):
+    fake = FakeScheduler()
+    monkeypatch.setattr(portfolio, 'scheduler', fake)
+    return fake
+
+
+def set_heartbeat(portfolio, run_date, heartbeat):
+    conn = portfolio.get_db()
+    c = conn.cursor()
+    c.execute('UPDATE job_runs SET last_heartbeat = ? WHERE run_date = ?', (heartbeat, run_date))
+    conn.commit()
+    conn.close()
+
+
+def test_checkpoints_and_status(portfolio):
+    run = portfolio.begin_job_run(JOB, RUN_DATE)
+    assert (run['attempts'], run['done']) == (1, set())
+    portfolio.checkpoint_job(run, ['a', 'b'], ['c'], total_items=3)
+    assert portfolio.finish_job_run(run) == 'partial'
+    unfinished = portfolio.find_unfinished_runs(JOB, RUN_DATE)
+    assert [(r['run_date'], r['status'], r['attempts']) for r in unfinished] == [(RUN_DATE, 'partial', 1)]
+
+    conn = portfolio.get_db()
+    row = conn.execute('SELECT total_items, done_items, error_count FROM job_runs WHERE id = ?',
+                       (run['id'],)).fetchone()
+    conn.close()
+    assert tuple(row) == (3, 2, 1)
+
+    # 再開すると済んだ項目を引き継ぎ、失敗した項目をやり直せる
+    resumed = portfolio.begin_job_run(JOB, RUN_DATE)
+    assert (resumed['id'], resumed['attempts'], resumed['done']) == (run['id'], 2, {'a', 'b'})
+    portfolio.checkpoint_job(resumed, ['c'])
+    assert portfolio.finish_job_run(resumed) == 'completed'
+    assert portfolio.find_unfinished_runs(JOB, RUN_DATE) == []
+    assert portfolio.begin_job_run(JOB, RUN_DATE) is None
+
+
+def test_failed_snapshots_fail_the_run(portfolio):
+    run = portfolio.begin_job_run(JOB, RUN_DATE)
+    portfolio.checkpoint_job(run, ['a'], ['snapshots'])
+    assert portfolio.finish_job_run(run) == 'failed'
+
+
+def test_running_run_is_claimed_only_when_stale(portfolio):
+    assert portfolio.begin_job_run(JOB, RUN_DATE) is not None
+    assert portfolio.begin_job_run(JOB, RUN_DATE) is None
+
+    stale = portfolio._utcnow() - timedelta(seconds=portfolio.JOB_STALE_SECONDS + 1)
+    set_heartbeat(portfolio, RUN_DATE, stale)
+    run = portfolio.begin_job_run(JOB, RUN_DATE)
+    assert run is not None and run['attempts'] == 2
+
+
+def test_retry_is_scheduled_until_max_attempts(portfolio, scheduler):
+    job = portfolio.NIGHTLY_JOB
+    run = portfolio.begin_job_run(job, RUN_DATE)
+    portfolio.finish_job_run(run, 'partial')
+    before = datetime.now(timezone.utc)
+    portfolio.retry_unfinished_run(RUN_DATE)
+    [scheduled] = scheduler.jobs
+    assert (scheduled['func'], scheduled['args']) == (portfolio.resume_job_run, [RUN_DATE])
+    delay = (scheduled['run_date'] - before).total_seconds()
+    assert portfolio.JOB_RETRY_SECONDS - 1 <= delay <= portfolio.JOB_RETRY_SECONDS + 5
+
+    # running のまま止まった実行はすぐに予約する(ハートビートは resume_job_run が見る)
+    portfolio.begin_job_run(job, RUN_DATE)
+    portfolio.retry_unfinished_run(RUN_DATE)
+    assert scheduler.jobs[-1]['run_date'] is None
+
+    run = portfolio.begin_job_run(job, RUN_DATE + timedelta(days=1))
+    for attempt in range(portfolio.JOB_MAX_ATTEMPTS - 1):
+        portfolio.finish_job_run(run, 'failed')
+        run = portfolio.begin_job_run(job, RUN_DATE + timedelta(days=1))
+    portfolio.finish_job_run(run, 'failed')
+    count = len(scheduler.jobs)
+    portfolio.retry_unfinished_run(RUN_DATE + timedelta(days=1))
+    assert len(scheduler.jobs) == count
+
+
+def test_resume_waits_for_a_fresh_heartbeat(portfolio, scheduler, monkeypatch):
+    calls = []
+    monkeypatch.setattr(portfolio, 'daily_price_update', calls.append)
+    portfolio.begin_job_run(portfolio.NIGHTLY_JOB, RUN_DATE)
+
+    portfolio.resume_job_run(RUN_DATE)
+    assert calls == []
+    [scheduled] = scheduler.jobs
+    expected = datetime.now(timezone.utc) + timedelta(seconds=portfolio.JOB_STALE_SECONDS + 5)
+    assert abs((scheduled['run_date'] - expected).total_seconds()) < 5
+
+    stale = portfolio._utcnow() - timedelta(seconds=portfolio.JOB_STALE_SECONDS + 1)
+    set_heartbeat(portfolio, RUN_DATE, stale)
+    portfolio.resume_job_run(RUN_DATE)
+    assert calls == [RUN_DATE]
+
+
+def test_scheduled_update_resumes_where_it_stopped(portfolio, monkeypatch):
+    other = add_user(portfolio, 'alice')
+    monkeypatch.setattr(portfolio, 'TIERED_REFRESH', False)
+    monkeypatch.setattr(portfolio.time, 'sleep', lambda seconds: None)
+    updated = []
+    monkeypatch.setattr(portfolio, 'update_user_prices', lambda user_id: updated.append(user_id) or 1)
+    snapshots = []
+
+    def record_all_snapshots(record_date):
+        snapshots.append(record_date)
+        if len(snapshots) == 1:
+            raise RuntimeError('disk full')
+    monkeypatch.setattr(portfolio, 'record_all_snapshots', record_all_snapshots)
+
+    portfolio.scheduled_update_all_prices(RUN_DATE)
+    assert sorted(updated) == [DEMO_USER_ID, other]
+    runs = portfolio.find_unfinished_runs(portfolio.NIGHTLY_JOB, RUN_DATE)
+    assert [(r['status'], r['attempts']) for r in runs] == [('failed', 1)]
+
+    updated.clear()
+    portfolio.scheduled_update_all_prices(RUN_DATE)
+    assert updated == []
+    assert snapshots == [RUN_DATE, RUN_DATE]
+    assert portfolio.find_unfinished_runs(portfolio.NIGHTLY_JOB, RUN_DATE) == []
+
+
+def test_runner_failure_schedules_a_retry(portfolio, scheduler, monkeypatch):
+    import subprocess
+
+    commands = []
+
+    class Runner:
+        def __init__(self, command):
+            commands.append(command)
+            # ランナーが途中で落ちた状態を再現する
+            run = portfolio.begin_job_run(portfolio.NIGHTLY_JOB, RUN_DATE)
+            portfolio.finish_job_run(run, 'partial')
+
+        def wait(self):
+            return 1
+
+    monkeypatch.setattr(subprocess, 'Popen', Runner)
+    monkeypatch.setattr(portfolio, 'REFRESH_PROCESSES', 2)
+    portfolio.daily_price_update(RUN_DATE)
+
+    [command] = commands
+    assert command[-4:] == ['--processes', '2', '--run-date', '2024-06-03']
+    assert [job['args'] for job in scheduler.jobs] == [[RUN_DATE]]
@@ -0,0 +1,72 @@
+from leader import FileLeaderLock, LeaderElection
+
+
+class FakeLock:
+    def __init__(self, available=True):
+        self.available = available
+        self.held = False
+
+    def try_acquire(self):
+        self.held = self.available
+        return self.held
+
+    def is_held(self):
+        return self.held
+
+    def release(self):
+        self.held = False
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / 'scheduler.lock')
+    first = FileLeaderLock(path)
+    second = FileLeaderLock(path)
+
+    assert first.try_acquire()
+    assert first.is_held()
+    assert not second.try_acquire()
+    assert not second.is_held()
+
+    first.release()
+    assert not first.is_held()
+    assert second.try_acquire()
+    second.release()
+
+
+def test_only_one_election_becomes_leader(tmp_path):
+    path = str(tmp_path / 'scheduler.lock')
+    events = []
+    first = LeaderElection(FileLeaderLock(path), lambda: events.append('first'), interval=3600)
+    second = LeaderElection(FileLeaderLock(path), lambda: events.append('second'), interval=3600)
+
+    first._check()
+    second._check()
+    assert (first.is_leader, second.is_leader) == (True, False)
+
+    # リーダーが止まると、次の確認で他のプロセスが引き継ぐ
+    first.stop()
+    second._check()
+    assert second.is_leader
+    assert events == ['first', 'second']
+    second.stop()
+
+
+def test_election_calls_on_demoted_once_when_lock_is_lost():
+    lock = FakeLock()
+    events = []
+    election = LeaderElection(lock, lambda: events.append('elected'), lambda: events.append('demoted'))
+
+    election._check()
+    election._check()
+    assert events == ['elected']
+
+    lock.held = False
+    lock.available = False
+    election._check()
+    election._check()
+    assert events == ['elected', 'demoted']
+    assert not election.is_leader
+
+    lock.available = True
+    election._check()
+    assert events == ['elected', 'demoted', 'elected']
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import DEMO_USER_ID, add_asset
+from market_calendar import is_refresh_due, market_open_between
+
+UTC = timezone.utc
+JST = timezone(timedelta(hours=9))
+
+
+def jst(*args):
+    return datetime(*args, tzinfo=JST)
+
+
+@pytest.mark.parametrize('asset_type, start, end, expected', [
+    # 金曜の大引け後から月曜の寄り付き前までは東証は開かない
+    ('jp_stock', jst(2024, 6, 7, 15, 31), jst(2024, 6, 10, 8, 59), False),
+    ('jp_stock', jst(2024, 6, 7, 15, 31), jst(2024, 6, 10, 9, 0), True),
+    # 昼休み
+    ('jp_stock', jst(2024, 6, 10, 11, 31), jst(2024, 6, 10, 12, 29), False),
+    # 米国市場は現地時間で判定する(夏時間: 9:30 EDT = 22:30 JST、冬時間: 9:30 EST = 23:30 JST)
+    ('us_stock', jst(2024, 6, 10, 22, 0), jst(2024, 6, 10, 22, 29), False),
+    ('us_stock', jst(2024, 6, 10, 22, 0), jst(2024, 6, 10, 22, 31), True),
+    ('us_stock', jst(2024, 12, 9, 22, 0), jst(2024, 12, 9, 23, 29), False),
+    ('us_stock', jst(2024, 12, 9, 22, 0), jst(2024, 12, 9, 23, 31), True),
+    ('crypto', jst(2024, 6, 8, 0, 0), jst(2024, 6, 8, 0, 1), True),
+    ('investment_trust', jst(2024, 6, 10, 9, 0), jst(2024, 6, 10, 17, 59), False),
+])
+def test_market_open_between(asset_type, start, end, expected):
+    assert market_open_between(asset_type, start, end) is expected
+
+
+def test_never_fetched_is_due():
+    assert is_refresh_due('jp_stock', None, jst(2024, 6, 8, 12, 0))
+
+
+class FrozenDatetime(datetime):
+    frozen = jst(2024, 6, 8, 12, 0)
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls.frozen.astimezone(tz) if tz else cls.frozen.replace(tzinfo=None)
+
+
+def test_refresh_asset_class_skips_symbols_while_market_is_closed(portfolio, monkeypatch):
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '7203', 100)
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '6758', 10)
+    fetched = []
+    monkeypatch.setattr(portfolio, 'datetime', FrozenDatetime)
+    monkeypatch.setattr(portfolio, 'fetch_asset_price',
+                        lambda asset_type, symbol: fetched.append(symbol) or 1000.0)
+
+    # 土曜日: 7203 は金曜の大引け後に取得済みなので飛ばし、未取得の 6758 だけを取る
+    portfolio._last_fetched[('jp_stock', '7203')] = jst(2024, 6, 7, 16, 0).astimezone(UTC)
+    assert portfolio.refresh_asset_class('jp_stock') == 1
+    assert fetched == ['6758']
+
+    assert portfolio.refresh_asset_class('jp_stock') == 0
+    assert fetched == ['6758']
+
+    assert portfolio.refresh_asset_class('jp_stock', force=True) == 2
+    assert sorted(fetched) == ['6758', '6758', '7203']
+
+
+def test_registry_cadence_delays_refresh(portfolio, monkeypatch):
+    conn = portfolio.get_db()
+    conn.execute("UPDATE symbols SET cadence_minutes = 240 WHERE asset_type = 'crypto' AND symbol = 'BTC'")
+    conn.commit()
+    conn.close()
+    portfolio.instrument_registry.reload()
+
+    now = jst(2024, 6, 8, 12, 0)
+    assert not portfolio.is_symbol_due('crypto', 'BTC', now - timedelta(hours=3), now)
+    assert portfolio.is_symbol_due('crypto', 'BTC', now - timedelta(hours=4), now)
+    assert portfolio.is_symbol_due('crypto', 'ETH', now - timedelta(minutes=1), now)
+    # レジストリにない銘柄は取得しない
+    assert not portfolio.is_symbol_due('crypto', 'NOPE', None, now)
@@ -0,0 +1,79 @@
+import metrics
+
+
+def test_counter_and_gauge_render_prometheus_text():
+    registry = metrics.Registry()
+    requests_total = registry.register(metrics.Counter('requests_total', 'Requests', ['status']))
+    depth = registry.register(metrics.Gauge('queue_depth', 'Queue depth'))
+    requests_total.inc(status=200)
+    requests_total.inc(2, status=200)
+    requests_total.inc(status='a"b\n')
+    depth.inc(5)
+    depth.dec(2)
+
+    assert registry.render().splitlines() == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{status="200"} 3',
+        'requests_total{status="a\\"b\\n"} 1',
+        '# HELP queue_depth Queue depth',
+        '# TYPE queue_depth gauge',
+        'queue_depth 3',
+    ]
+
+
+def test_register_returns_the_existing_metric():
+    registry = metrics.Registry()
+    first = registry.register(metrics.Counter('hits_total', 'Hits'))
+    assert registry.register(metrics.Counter('hits_total', 'Hits')) is first
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram('fetch_seconds', 'Fetch', ['source'], buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, source='yahoo')
+
+    assert histogram.render()[2:] == [
+        'fetch_seconds_bucket{source="yahoo",le="0.1"} 2',
+        'fetch_seconds_bucket{source="yahoo",le="1.0"} 3',
+        'fetch_seconds_bucket{source="yahoo",le="+Inf"} 4',
+        'fetch_seconds_sum{source="yahoo"} 3.65',
+        'fetch_seconds_count{source="yahoo"} 4',
+    ]
+
+
+def test_histogram_time_observes_on_error():
+    histogram = metrics.Histogram('job_seconds', 'Job')
+    try:
+        with histogram.time():
+            raise ValueError
+    except ValueError:
+        pass
+    assert histogram.render()[-1] == 'job_seconds_count 1'
+
+
+def test_statement_label(portfolio):
+    assert portfolio.statement_label('SELECT * FROM assets WHERE id = ?') == 'SELECT assets'
+    assert portfolio.statement_label('INSERT OR REPLACE INTO quotes VALUES (?)') == 'INSERT quotes'
+    assert portfolio.statement_label('CREATE TABLE IF NOT EXISTS job_runs (id)') == 'CREATE job_runs'
+    assert portfolio.statement_label('COMMIT') == 'COMMIT'
+
+
+def test_metrics_endpoint_requires_token(client, monkeypatch):
+    assert client.get('/metrics').status_code == 404
+
+    monkeypatch.setenv('METRICS_TOKEN', 's3cret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert '# TYPE portfolio_request_seconds histogram' in response.get_data(as_text=True)
+
+
+def test_requests_and_queries_are_measured(client, portfolio, monkeypatch):
+    monkeypatch.setenv('METRICS_TOKEN', 's3cret')
+    client.post('/login', data={'username': 'demo', 'password': 'wrong'})
+    text = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'}).get_data(as_text=True)
+    assert 'endpoint="login",method="POST"' in text
+    assert 'portfolio_db_query_seconds_count{statement="SELECT users"}' in text
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta, timezone
+
+from conftest import DEMO_USER_ID, add_asset, quote_prices
+
+UTC = timezone.utc
+# 土曜日の正午(日本時間)
+NOW = datetime(2024, 6, 8, 3, 0, tzinfo=UTC)
+
+
+def write_quote(portfolio, asset_type, symbol, price, as_of):
+    conn = portfolio.get_db()
+    conn.execute('INSERT INTO quotes (asset_type, symbol, price, as_of) VALUES (?, ?, ?, ?)',
+                 (asset_type, symbol, price, as_of.astimezone(UTC).replace(tzinfo=None)))
+    conn.commit()
+    conn.close()
+
+
+def test_only_old_quotes_of_open_markets_are_stale(portfolio):
+    for asset_type, symbol in [('crypto', 'BTC'), ('crypto', 'ETH'), ('crypto', 'XRP'), ('jp_stock', '7203'),
+                               ('gold', '金地金'), ('cash', '普通預金')]:
+        add_asset(portfolio, DEMO_USER_ID, asset_type, symbol, 1)
+    write_quote(portfolio, 'crypto', 'BTC', 9000000.0, NOW - timedelta(seconds=30))
+    write_quote(portfolio, 'crypto', 'ETH', 500000.0, NOW - timedelta(hours=1))
+    # 金曜の大引け後に取得した株価は、土曜日には古くない
+    write_quote(portfolio, 'jp_stock', '7203', 2500.0, NOW - timedelta(hours=20))
+
+    assert sorted(portfolio.stale_user_quotes(DEMO_USER_ID, NOW)) == [
+        ('crypto', 'ETH'), ('crypto', 'XRP'), ('gold', '')]
+
+
+def test_prefetch_writes_quotes_and_warms_fx(portfolio, monkeypatch):
+    add_asset(portfolio, DEMO_USER_ID, 'us_stock', 'AAPL', 10)
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'BTC', 1)
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'ETH', 1)
+    fx_calls = []
+    monkeypatch.setattr(portfolio.fx_rates, 'fetch', lambda currency, base: fx_calls.append(currency) or 150.0)
+    monkeypatch.setattr(portfolio, 'fetch_asset_price',
+                        lambda asset_type, symbol: {'AAPL': 190.0, 'BTC': 9000000.0}.get(symbol, 0))
+
+    assert portfolio.prefetch_user_quotes(DEMO_USER_ID) == 2
+    assert quote_prices(portfolio) == {('us_stock', 'AAPL'): 190.0, ('crypto', 'BTC'): 9000000.0}
+    assert fx_calls == ['USD']
+    assert ('crypto', 'BTC') in portfolio._last_fetched
+    assert portfolio._prefetch_pending == set()
+
+    # 取得したばかりの銘柄は取り直さない
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', lambda asset_type, symbol: 1.0)
+    assert portfolio.prefetch_user_quotes(DEMO_USER_ID) == 1
+    assert quote_prices(portfolio)[('crypto', 'ETH')] == 1.0
+
+
+def test_symbols_being_prefetched_are_skipped(portfolio, monkeypatch):
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'BTC', 1)
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'ETH', 1)
+    monkeypatch.setattr(portfolio, '_prefetch_pending', {('crypto', 'BTC')})
+    fetched = []
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', lambda asset_type, symbol: fetched.append(symbol) or 1.0)
+    assert portfolio.prefetch_user_quotes(DEMO_USER_ID) == 1
+    assert fetched == ['ETH']
+    # 他の先読みが登録した銘柄は消さない
+    assert portfolio._prefetch_pending == {('crypto', 'BTC')}
+
+
+def test_login_schedules_prefetch(client, portfolio, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(portfolio, 'PREFETCH_ON_LOGIN', True)
+    monkeypatch.setattr(portfolio._prefetch_executor, 'submit', lambda func, *args: scheduled.append((func, args)))
+
+    client.post('/login', data={'username': 'demo', 'password': 'wrong'})
+    assert scheduled == []
+    client.post('/login', data={'username': 'demo', 'password': 'demo123'})
+    assert scheduled == [(portfolio.prefetch_user_quotes, (DEMO_USER_ID,))]
+
+    monkeypatch.setattr(portfolio, 'PREFETCH_ON_LOGIN', False)
+    client.post('/login', data={'username': 'demo', 'password': 'demo123'})
+    assert len(scheduled) == 1
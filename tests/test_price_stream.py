@@ -0,0 +1,142 @@
+import json
+import queue
+import threading
+
+import pytest
+
+import price_stream
+from conftest import DEMO_USER_ID, add_asset, login
+
+
+def test_publish_reaches_every_subscriber():
+    broker = price_stream.PriceBroker()
+    first, second = broker.subscribe(), broker.subscribe()
+    broker.publish([('jp_stock', '7203', 2500.0)])
+    assert first.get(timeout=1) == second.get(timeout=1) == [('jp_stock', '7203', 2500.0)]
+
+    broker.unsubscribe(second)
+    broker.publish([('jp_stock', '7203', 2510.0)])
+    assert first.get(timeout=1) == [('jp_stock', '7203', 2510.0)]
+    with pytest.raises(queue.Empty):
+        second.get(timeout=0)
+    assert broker.subscriber_count == 1
+
+
+def test_empty_updates_are_not_published():
+    broker = price_stream.PriceBroker()
+    subscription = broker.subscribe()
+    broker.publish([])
+    with pytest.raises(queue.Empty):
+        subscription.get(timeout=0)
+
+
+def test_overflow_asks_for_resync():
+    broker = price_stream.PriceBroker(max_queue=2)
+    subscription = broker.subscribe()
+    for price in (1.0, 2.0, 3.0):
+        broker.publish([('crypto', 'BTC', price)])
+
+    assert subscription.get(timeout=1) is None
+    with pytest.raises(queue.Empty):
+        subscription.get(timeout=0)
+    broker.publish([('crypto', 'BTC', 4.0)])
+    assert subscription.get(timeout=1) == [('crypto', 'BTC', 4.0)]
+
+
+def test_concurrent_publishers_never_fail():
+    broker = price_stream.PriceBroker(max_queue=2)
+    subscription = broker.subscribe()
+    errors = []
+
+    def publish(worker):
+        try:
+            for i in range(500):
+                broker.publish([('crypto', f'C{worker}', float(i))])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=publish, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert subscription.queue.qsize() <= 2
+
+
+def test_format_event():
+    assert price_stream.format_event('totals', {'total': 1, 'name': '金'}) == \
+        'event: totals\ndata: {"total": 1, "name": "金"}\n\n'
+
+
+def parse_event(chunk):
+    event, data = chunk.strip().split('\n')
+    return event.split(': ', 1)[1], json.loads(data.split(': ', 1)[1])
+
+
+@pytest.fixture
+def stream_settings(portfolio, monkeypatch):
+    monkeypatch.setattr(portfolio, 'SSE_HEARTBEAT_SECONDS', 0.05)
+    monkeypatch.setattr(portfolio, 'price_broker', price_stream.PriceBroker())
+    monkeypatch.setattr(portfolio, '_stream_slots', threading.BoundedSemaphore(1))
+    monkeypatch.setattr(portfolio.fx_rates, 'fetch', lambda currency, base: 150.0)
+
+
+def test_stream_requires_login(client):
+    assert client.get('/stream/prices').status_code == 401
+
+
+def test_stream_sends_totals_then_price_deltas(client, portfolio, stream_settings):
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '7203', 100, price=2500.0, avg_cost=2000.0)
+    add_asset(portfolio, DEMO_USER_ID, 'gold', '金地金', 10, price=12000.0, avg_cost=12000.0)
+    login(client)
+
+    response = client.get('/stream/prices', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    chunks = (chunk.decode('utf-8') for chunk in response.response)
+    assert next(chunks) == 'retry: 5000\n\n'
+    event, totals = parse_event(next(chunks))
+    assert event == 'totals'
+    assert totals['total'] == 100 * 2500.0 + 10 * 12000.0
+    assert totals['profit'] == 100 * 500.0
+
+    assert next(chunks) == ': keepalive\n\n'
+    portfolio.price_broker.publish([('jp_stock', '7203', 2600.0), ('jp_stock', '6758', 13000.0), ('gold', '', 12500.0)])
+    event, data = parse_event(next(chunks))
+    assert event == 'prices'
+    assert [(d['symbol'], d['old_price'], d['price']) for d in data['deltas']] == [
+        ('7203', 2500.0, 2600.0), ('金地金', 12000.0, 12500.0)]
+    assert data['totals']['total'] == 100 * 2600.0 + 10 * 12500.0
+
+    response.close()
+    assert portfolio.price_broker.subscriber_count == 0
+
+
+def test_stream_resyncs_after_overflow(client, portfolio, stream_settings, monkeypatch):
+    monkeypatch.setattr(portfolio, 'price_broker', price_stream.PriceBroker(max_queue=1))
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '7203', 100, price=2500.0)
+    login(client)
+
+    response = client.get('/stream/prices', buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    next(chunks)
+    portfolio.price_broker.publish([('jp_stock', '7203', 2600.0)])
+    portfolio.price_broker.publish([('jp_stock', '7203', 2700.0)])
+    # 溢れたら DB から読み直した合計を送る
+    event, totals = parse_event(next(chunks).decode('utf-8'))
+    assert event == 'totals'
+    assert totals['total'] == 100 * 2500.0
+    response.close()
+
+
+def test_streams_are_capped_per_process(client, portfolio, stream_settings):
+    login(client)
+    first = client.get('/stream/prices', buffered=False)
+    assert first.status_code == 200
+    assert client.get('/stream/prices').status_code == 204
+
+    first.close()
+    second = client.get('/stream/prices', buffered=False)
+    assert second.status_code == 200
+    second.close()
@@ -0,0 +1,99 @@
+import concurrent.futures
+import time
+
+import pytest
+
+import profiling
+
+
+def make_trace(duration, path='/dashboard'):
+    trace = profiling.Trace('GET', path, 'dashboard', sampled=False)
+    trace.duration = duration
+    return trace
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    """サンプルなし・100ms 以上を遅いリクエストとして、空のバッファで有効にする"""
+    monkeypatch.setattr(profiling, 'ENABLED', True)
+    monkeypatch.setattr(profiling, 'SLOW_MS', 100.0)
+    monkeypatch.setattr(profiling, 'SAMPLE_RATE', 0.0)
+    monkeypatch.setattr(profiling, 'slowest_traces', profiling.SlowestTraces(2))
+    monkeypatch.setattr(profiling, 'recent_traces', profiling.RecentTraces(2))
+    return profiling
+
+
+def test_slowest_traces_keeps_the_slowest_in_order():
+    slowest = profiling.SlowestTraces(3)
+    for i, duration in enumerate([0.5, 0.1, 2.0, 0.3, 1.0, 0.2]):
+        slowest.add(make_trace(duration, f'/r{i}'))
+    assert [t['duration_ms'] for t in slowest.snapshot()] == [2000.0, 1000.0, 500.0]
+
+
+def test_recent_traces_are_newest_first():
+    recent = profiling.RecentTraces(2)
+    for path in ('/a', '/b', '/c'):
+        recent.add(make_trace(0.01, path))
+    assert [t['path'] for t in recent.snapshot()] == ['/c', '/b']
+
+
+def test_finish_keeps_slow_and_sampled_requests_apart(profiler, monkeypatch):
+    profiler.begin('GET', '/slow', 'slow').started -= 0.5
+    profiler.finish()
+
+    # 速いリクエストのサンプルが遅いリクエストを押し出さない
+    monkeypatch.setattr(profiler, 'SAMPLE_RATE', 1.0)
+    for _ in range(5):
+        profiler.begin('GET', '/fast', 'fast')
+        profiler.finish()
+
+    snapshot = profiler.snapshot()
+    assert [t['path'] for t in snapshot['slow']] == ['/slow']
+    assert [t['path'] for t in snapshot['sampled']] == ['/fast', '/fast']
+    assert profiler.current_trace() is None
+
+
+def test_unsampled_fast_requests_are_dropped(profiler):
+    profiler.begin('GET', '/fast', 'fast')
+    assert profiler.finish() is not None
+    assert profiler.snapshot() == {'slow': [], 'sampled': []}
+
+
+def test_disabled_profiler_records_nothing(monkeypatch):
+    monkeypatch.setattr(profiling, 'ENABLED', False)
+    assert profiling.begin('GET', '/', 'index') is None
+    with profiling.span('db'):
+        pass
+    assert profiling.finish() is None
+
+
+def test_spans_are_aggregated_across_bound_threads(profiler):
+    trace = profiler.begin('GET', '/update_prices', 'update_prices')
+    with profiler.span('db'):
+        pass
+    with profiler.span('db'):
+        time.sleep(0.01)
+
+    def fetch():
+        with profiler.span('http:example.com'):
+            return profiler.current_trace()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        seen = list(executor.map(lambda f: f(), [profiler.bind(fetch), profiler.bind(fetch)]))
+    profiler.finish()
+
+    assert seen == [trace, trace]
+    spans = trace.to_dict()['spans']
+    assert spans['db']['count'] == 2
+    assert spans['db']['total_ms'] >= 10
+    assert spans['http:example.com']['count'] == 2
+
+
+def test_admin_profiles_requires_token(client, profiler, monkeypatch):
+    assert client.get('/admin/profiles').status_code == 404
+
+    monkeypatch.setenv('ADMIN_TOKEN', 'admin')
+    assert client.get('/admin/profiles').status_code == 401
+    response = client.get('/admin/profiles', headers={'Authorization': 'Bearer admin'})
+    assert response.status_code == 200
+    assert response.get_json() == {'slow': [], 'sampled': []}
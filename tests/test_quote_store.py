@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+from quote_store import SharedQuoteStore
+
+
+@pytest.fixture
+def outcomes():
+    return []
+
+
+@pytest.fixture
+def store(tmp_path, outcomes):
+    return SharedQuoteStore(str(tmp_path / 'quotes.db'), ttl=30, lease_seconds=2, poll_interval=0.01,
+                            on_result=outcomes.append)
+
+
+def test_fetched_price_is_reused_within_ttl(store, outcomes):
+    assert store.get_or_fetch('crypto', 'BTC', lambda: 9000000.0) == 9000000.0
+    assert store.get_or_fetch('crypto', 'BTC', lambda: pytest.fail('fetched twice')) == 9000000.0
+    assert outcomes == ['fetched', 'hit']
+    assert store.get('crypto', 'BTC', max_age=0) is None
+
+
+def test_concurrent_callers_share_one_fetch(store, outcomes):
+    calls = []
+
+    def slow_fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return 2500.0
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_or_fetch('jp_stock', '7203', slow_fetch)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [2500.0] * 8
+    assert sorted(outcomes) == ['fetched'] + ['waited'] * 7
+
+
+def fetch_in_process(path, log_path):
+    store = SharedQuoteStore(path, lease_seconds=5, poll_interval=0.01)
+
+    def fetch():
+        with open(log_path, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+        time.sleep(0.2)
+        return 190.0
+
+    assert store.get_or_fetch('us_stock', 'AAPL', fetch) == 190.0
+
+
+def test_processes_share_one_fetch(tmp_path):
+    path = str(tmp_path / 'quotes.db')
+    log_path = str(tmp_path / 'fetches.log')
+    SharedQuoteStore(path).clear()
+    processes = [multiprocessing.Process(target=fetch_in_process, args=(path, log_path)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(10)
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    with open(log_path) as f:
+        assert len(f.read().split()) == 1
+
+
+def test_compare_and_set_rejects_stale_version(store):
+    version = store.try_lease('crypto', 'ETH')
+    assert version == 0
+    assert store.compare_and_set('crypto', 'ETH', version, 500000.0)
+    assert not store.compare_and_set('crypto', 'ETH', version, 400000.0)
+    assert store.get('crypto', 'ETH') == (500000.0, 1)
+
+
+def test_lease_is_exclusive_until_released_or_expired(store):
+    assert store.try_lease('crypto', 'XRP') == 0
+    other = []
+    thread = threading.Thread(target=lambda: other.append(store.try_lease('crypto', 'XRP')))
+    thread.start()
+    thread.join()
+    assert other == [None]
+
+    store.release('crypto', 'XRP')
+    thread = threading.Thread(target=lambda: other.append(store.try_lease('crypto', 'XRP')))
+    thread.start()
+    thread.join()
+    assert other == [None, 0]
+
+
+def test_expired_lease_is_taken_over(store, outcomes):
+    thread = threading.Thread(target=store.try_lease, args=('crypto', 'DOGE'))
+    thread.start()
+    thread.join()
+    store._conn().execute("UPDATE shared_quotes SET lease_until = ? WHERE symbol = 'DOGE'", (time.time() - 1,))
+    # リースを取ったまま落ちたスレッドの代わりに取得する
+    assert store.get_or_fetch('crypto', 'DOGE', lambda: 20.0) == 20.0
+    assert outcomes == ['fetched']
+
+
+def test_failed_fetch_releases_the_lease(store, outcomes):
+    assert store.get_or_fetch('crypto', 'BTC', lambda: 0) == 0
+
+    def broken():
+        raise RuntimeError('upstream down')
+
+    with pytest.raises(RuntimeError):
+        store.get_or_fetch('crypto', 'BTC', broken)
+    started = time.monotonic()
+    assert store.get_or_fetch('crypto', 'BTC', lambda: 9000000.0) == 9000000.0
+    assert time.monotonic() - started < 1
+    assert outcomes == ['fetched', 'fetched']
+
+
+def test_unavailable_store_is_bypassed(tmp_path, outcomes):
+    store = SharedQuoteStore(str(tmp_path / 'missing' / 'quotes.db'), on_result=outcomes.append)
+    assert store.get_or_fetch('crypto', 'BTC', lambda: 1.0) == 1.0
+    assert outcomes == ['bypass']
+
+
+def test_fetch_asset_price_goes_through_the_store(portfolio, store, monkeypatch):
+    monkeypatch.setattr(portfolio, 'SHARED_QUOTES_ENABLED', True)
+    monkeypatch.setattr(portfolio, 'shared_quotes', store)
+    fetched = []
+    monkeypatch.setattr(portfolio, 'fetch_upstream_price',
+                        lambda asset_type, symbol: fetched.append((asset_type, symbol)) or 12000.0)
+
+    assert portfolio.fetch_asset_price('gold', '金地金') == 12000.0
+    assert portfolio.fetch_asset_price('gold', '金貨') == 12000.0
+    assert fetched == [('gold', '')]
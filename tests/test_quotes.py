@@ -0,0 +1,77 @@
+from conftest import DEMO_USER_ID, add_asset, add_user, quote_prices
+
+
+def quote_rows(portfolio, table='quotes'):
+    conn = portfolio.get_db()
+    rows = [dict(row) for row in conn.execute(f'SELECT * FROM {table} ORDER BY asset_type, symbol')]
+    conn.close()
+    return rows
+
+
+def write(portfolio, prices):
+    conn = portfolio.get_db()
+    portfolio.write_quotes(conn.cursor(), prices)
+    conn.commit()
+    conn.close()
+
+
+def test_write_quotes_upserts_one_row_per_instrument(portfolio):
+    write(portfolio, [('crypto', 'BTC', 9000000.0), ('gold', '金地金', 12000.0), ('gold', '金貨', 12100.0)])
+    write(portfolio, [('crypto', 'BTC', 9100000.0, 'Bitcoin')])
+    write(portfolio, [('crypto', 'BTC', 9200000.0)])
+
+    rows = quote_rows(portfolio)
+    assert [(r['asset_type'], r['symbol'], r['price'], r['name'], r['source']) for r in rows] == [
+        ('crypto', 'BTC', 9200000.0, 'Bitcoin', 'minkabu'),
+        ('gold', '', 12100.0, None, 'tanaka'),
+    ]
+    history = quote_rows(portfolio, 'quote_history')
+    assert [(r['symbol'], r['price']) for r in history] == [('BTC', 9200000.0), ('', 12100.0)]
+
+
+def test_stock_names_come_from_the_ticker_index(portfolio):
+    portfolio.remember_ticker('jp_stock', '7203', 'トヨタ自動車', 'TSE')
+    write(portfolio, [('jp_stock', '7203', 2500.0), ('us_stock', 'AAPL', 190.0)])
+    assert [(r['symbol'], r['name'], r['source']) for r in quote_rows(portfolio)] == [
+        ('7203', 'トヨタ自動車', 'yahoo'), ('AAPL', None, 'yahoo')]
+
+
+def test_load_distinct_symbols_dedupes_across_users(portfolio):
+    other = add_user(portfolio, 'other')
+    for user_id in (DEMO_USER_ID, other):
+        add_asset(portfolio, user_id, 'jp_stock', '7203', 100)
+        add_asset(portfolio, user_id, 'gold', f'金{user_id}', 1)
+        add_asset(portfolio, user_id, 'cash', '普通預金', 1000)
+    assert portfolio.load_distinct_symbols() == [('gold', ''), ('jp_stock', '7203')]
+    assert portfolio.load_distinct_symbols(['gold']) == [('gold', '')]
+
+
+def test_update_user_prices_fetches_each_instrument_once(portfolio, monkeypatch):
+    other = add_user(portfolio, 'other')
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '7203', 100, price=1.0)
+    add_asset(portfolio, DEMO_USER_ID, 'jp_stock', '7203', 50, price=1.0)
+    add_asset(portfolio, DEMO_USER_ID, 'gold', '金地金', 1)
+    add_asset(portfolio, DEMO_USER_ID, 'gold', '金貨', 1)
+    add_asset(portfolio, other, 'jp_stock', '7203', 10)
+    fetched = []
+    monkeypatch.setattr(portfolio, 'fetch_asset_price',
+                        lambda asset_type, symbol: fetched.append((asset_type, symbol)) or 2500.0)
+
+    assert portfolio.update_user_prices(DEMO_USER_ID) == 2
+    assert sorted(fetched) == [('gold', ''), ('jp_stock', '7203')]
+    assert quote_prices(portfolio) == {('gold', ''): 2500.0, ('jp_stock', '7203'): 2500.0}
+
+    # 他のユーザーの同じ銘柄にも反映され、assets.price は書き換えない
+    assert [h.price for h in portfolio.load_holdings(other)] == [2500.0]
+    conn = portfolio.get_db()
+    assert {row['price'] for row in conn.execute("SELECT price FROM assets WHERE asset_type = 'jp_stock'")} == {
+        0.0, 1.0}
+    conn.close()
+
+
+def test_failed_fetch_keeps_the_previous_quote(portfolio, monkeypatch):
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'BTC', 1)
+    write(portfolio, [('crypto', 'BTC', 9000000.0)])
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', lambda asset_type, symbol: 0)
+    assert portfolio.update_user_prices(DEMO_USER_ID) == 0
+    assert quote_prices(portfolio) == {('crypto', 'BTC'): 9000000.0}
@@ -0,0 +1,102 @@
+import logging
+import sys
+import time
+import types
+
+import pytest
+
+from conftest import login
+
+PRIMARY = 'postgresql://primary/portfolio'
+REPLICA = 'postgresql://replica/portfolio'
+
+
+class FakePsycopg2(types.ModuleType):
+    """接続先を記録するだけの psycopg2(down にした DSN には OperationalError)"""
+
+    class OperationalError(Exception):
+        pass
+
+    def __init__(self):
+        super().__init__('psycopg2')
+        self.connected = []
+        self.down = set()
+
+    def connect(self, dsn, **kwargs):
+        self.connected.append(dsn)
+        if dsn in self.down:
+            raise self.OperationalError(f'could not connect to {dsn}')
+        return types.SimpleNamespace(dsn=dsn)
+
+
+@pytest.fixture
+def psycopg2(portfolio, monkeypatch):
+    fake = FakePsycopg2()
+    monkeypatch.setitem(sys.modules, 'psycopg2', fake)
+    monkeypatch.setattr(portfolio, 'pg_cursor_factory', lambda: None)
+    monkeypatch.setattr(portfolio, 'USE_POSTGRES', True)
+    monkeypatch.setattr(portfolio, 'USE_READ_REPLICA', True)
+    monkeypatch.setattr(portfolio, 'DATABASE_URL', PRIMARY)
+    monkeypatch.setattr(portfolio, 'DATABASE_READ_URL', REPLICA)
+    monkeypatch.setattr(portfolio, '_replica_down_until', 0.0)
+    return fake
+
+
+def test_reads_go_to_the_replica(portfolio, psycopg2):
+    assert portfolio.get_db(readonly=True).dsn == REPLICA
+    assert portfolio.get_db().dsn == PRIMARY
+
+    portfolio.USE_READ_REPLICA = False
+    assert portfolio.get_db(readonly=True).dsn == PRIMARY
+
+
+def test_replica_outage_falls_back_and_backs_off(portfolio, psycopg2, caplog):
+    psycopg2.down.add(REPLICA)
+    with caplog.at_level(logging.WARNING):
+        assert portfolio.get_db(readonly=True).dsn == PRIMARY
+        assert portfolio.get_db(readonly=True).dsn == PRIMARY
+    assert psycopg2.connected == [REPLICA, PRIMARY, PRIMARY]
+    assert not portfolio.replica_available()
+    assert len([r for r in caplog.records if 'Read replica unavailable' in r.getMessage()]) == 1
+
+    # REPLICA_RETRY_SECONDS が過ぎたら、また試す
+    portfolio._replica_down_until = time.monotonic() - 1
+    psycopg2.down.clear()
+    psycopg2.connected.clear()
+    assert portfolio.get_db(readonly=True).dsn == REPLICA
+    assert psycopg2.connected == [REPLICA]
+
+
+def test_writes_pin_the_session_to_the_primary(portfolio, psycopg2):
+    with portfolio.app.test_request_context():
+        assert portfolio.get_db(readonly=True).dsn == REPLICA
+        portfolio.writes_user_data(lambda: None)()
+        assert portfolio.get_db(readonly=True).dsn == PRIMARY
+        pinned_until = portfolio.session['db_primary_until']
+    assert pinned_until == pytest.approx(time.time() + portfolio.READ_AFTER_WRITE_SECONDS, abs=5)
+
+    with portfolio.app.test_request_context():
+        portfolio.session['db_primary_until'] = time.time() + 5
+        assert portfolio.get_db(readonly=True).dsn == PRIMARY
+        portfolio.session['db_primary_until'] = time.time() - 1
+        assert portfolio.get_db(readonly=True).dsn == REPLICA
+
+
+def test_only_user_writes_set_the_cookie(client, portfolio, monkeypatch):
+    # 接続は SQLite のまま、レプリカを使う設定のときのセッションだけを見る
+    monkeypatch.setattr(portfolio, 'USE_READ_REPLICA', True)
+    login(client)
+    assert client.get('/dashboard').status_code == 200
+    with client.session_transaction() as session:
+        assert 'db_primary_until' not in session
+
+    client.post('/update_all_prices')
+    with client.session_transaction() as session:
+        assert session['db_primary_until'] > time.time()
+
+
+def test_no_cookie_without_a_replica(client, portfolio):
+    login(client)
+    client.post('/update_all_prices')
+    with client.session_transaction() as session:
+        assert 'db_primary_until' not in session
@@ -0,0 +1,101 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from conftest import DEMO_USER_ID, add_asset, login, quote_prices
+
+
+class SlowUpstream:
+    """slow に入れた銘柄だけ release() まで応答しない fetch_asset_price"""
+
+    def __init__(self, prices, slow=()):
+        self.prices = prices
+        self.slow = set(slow)
+        self.released = threading.Event()
+        self.fetched = []
+
+    def __call__(self, asset_type, symbol):
+        self.fetched.append(symbol)
+        if symbol in self.slow:
+            self.released.wait(10)
+        return self.prices.get(symbol, 0)
+
+    def release(self):
+        self.released.set()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            pytest.fail('timed out')
+        time.sleep(0.01)
+
+
+def queue_depth(portfolio):
+    return portfolio.FETCH_QUEUE_DEPTH._values.get((), 0)
+
+
+def test_without_budget_waits_for_every_quote(portfolio, monkeypatch):
+    upstream = SlowUpstream({'BTC': 9000000.0, 'ETH': 500000.0}, slow=['ETH'])
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', upstream)
+    threading.Timer(0.1, upstream.release).start()
+
+    prices, stale = portfolio.refresh_quotes([('crypto', 'BTC'), ('crypto', 'ETH')])
+    assert sorted(prices) == [('crypto', 'BTC', 9000000.0), ('crypto', 'ETH', 500000.0)]
+    assert stale == []
+
+
+def test_late_quote_is_stored_after_the_deadline(portfolio, monkeypatch):
+    upstream = SlowUpstream({'BTC': 9000000.0, 'ETH': 500000.0, 'XRP': 0}, slow=['ETH'])
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', upstream)
+    depth = queue_depth(portfolio)
+
+    started = time.monotonic()
+    prices, stale = portfolio.refresh_quotes([('crypto', 'BTC'), ('crypto', 'ETH'), ('crypto', 'XRP')], budget=0.2)
+    assert time.monotonic() - started < 2
+    assert prices == [('crypto', 'BTC', 9000000.0)]
+    assert sorted(stale) == [('crypto', 'ETH'), ('crypto', 'XRP')]
+    assert quote_prices(portfolio) == {('crypto', 'BTC'): 9000000.0}
+
+    # 期限後に届いた相場も quotes に反映される
+    upstream.release()
+    wait_for(lambda: ('crypto', 'ETH') in quote_prices(portfolio))
+    assert quote_prices(portfolio)[('crypto', 'ETH')] == 500000.0
+    assert queue_depth(portfolio) == depth
+
+
+def test_unstarted_fetches_are_cancelled(portfolio, monkeypatch):
+    upstream = SlowUpstream({'BTC': 9000000.0, 'ETH': 500000.0}, slow=['BTC'])
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', upstream)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(portfolio, '_refresh_executor', executor)
+    depth = queue_depth(portfolio)
+
+    prices, stale = portfolio.refresh_quotes([('crypto', 'BTC'), ('crypto', 'ETH')], budget=0.1)
+    assert prices == []
+    assert sorted(stale) == [('crypto', 'BTC'), ('crypto', 'ETH')]
+
+    upstream.release()
+    executor.shutdown(wait=True)
+    wait_for(lambda: ('crypto', 'BTC') in quote_prices(portfolio))
+    assert upstream.fetched == ['BTC']
+    assert ('crypto', 'ETH') not in quote_prices(portfolio)
+    assert queue_depth(portfolio) == depth
+
+
+def test_update_prices_reports_stale_symbols(client, portfolio, monkeypatch):
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'BTC', 1)
+    add_asset(portfolio, DEMO_USER_ID, 'crypto', 'ETH', 1)
+    upstream = SlowUpstream({'BTC': 9000000.0, 'ETH': 500000.0}, slow=['ETH'])
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', upstream)
+    monkeypatch.setattr(portfolio, 'REFRESH_BUDGET_SECONDS', 0.2)
+    login(client)
+
+    response = client.post('/update_prices', data={'asset_type': 'crypto'})
+    upstream.release()
+    assert response.get_json() == {'updated': ['BTC'], 'stale': ['ETH']}
+    with client.session_transaction() as session:
+        assert 'ETH' in session['_flashes'][0][1]
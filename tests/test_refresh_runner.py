@@ -0,0 +1,95 @@
+import os
+from datetime import date
+
+import pytest
+
+from conftest import DEMO_USER_ID, add_asset, quote_prices
+
+RUN_DATE = date(2024, 6, 3)
+
+
+@pytest.fixture
+def runner(portfolio):
+    import refresh_runner
+    return refresh_runner
+
+
+def fetch_recording(prices):
+    """取得した銘柄を fetched.log に追記する fetch_asset_price(ワーカープロセスからも見える)"""
+    def fetch(asset_type, symbol):
+        with open('fetched.log', 'a') as f:
+            f.write(f'{asset_type}:{symbol}\n')
+        return prices.get((asset_type, symbol), 0)
+    return fetch
+
+
+def fetched():
+    if not os.path.exists('fetched.log'):
+        return []
+    with open('fetched.log') as f:
+        return sorted(f.read().split())
+
+
+def test_split_shards_is_round_robin(runner):
+    keys = list(range(10))
+    shards = runner.split_shards(keys, 3)
+    assert shards == [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]]
+    assert runner.split_shards(keys[:2], 8) == [[0], [1]]
+    assert runner.split_shards([], 4) == [[]]
+
+
+def test_run_dedupes_symbols_and_resumes_failed_ones(portfolio, runner, monkeypatch):
+    user_id = DEMO_USER_ID
+    add_asset(portfolio, user_id, 'jp_stock', '7203', 100)
+    add_asset(portfolio, user_id, 'jp_stock', '7203', 50)
+    add_asset(portfolio, user_id, 'us_stock', 'AAPL', 10)
+    add_asset(portfolio, user_id, 'crypto', 'BTC', 0.5)
+
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', fetch_recording({
+        ('jp_stock', '7203'): 2500.0, ('us_stock', 'AAPL'): 190.0}))
+    monkeypatch.setattr(portfolio.fx_rates, 'rate', lambda currency, base='JPY': 150.0)
+
+    assert runner.run(processes=2, threads=2, batch_size=1, run_date=RUN_DATE) == 2
+    assert fetched() == ['crypto:BTC', 'jp_stock:7203', 'us_stock:AAPL']
+    assert quote_prices(portfolio) == {('jp_stock', '7203'): 2500.0, ('us_stock', 'AAPL'): 190.0}
+    runs = portfolio.find_unfinished_runs(portfolio.NIGHTLY_JOB, RUN_DATE)
+    assert [(r['status'], r['attempts']) for r in runs] == [('partial', 1)]
+
+    # 同じ日付で起動し直すと、失敗した銘柄だけを取り直してスナップショットも取り直す
+    os.remove('fetched.log')
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', fetch_recording({('crypto', 'BTC'): 9000000.0}))
+    assert runner.run(processes=2, threads=2, batch_size=1, run_date=RUN_DATE) == 1
+    assert fetched() == ['crypto:BTC']
+    assert portfolio.find_unfinished_runs(portfolio.NIGHTLY_JOB, RUN_DATE) == []
+
+    conn = portfolio.get_db()
+    row = conn.execute('SELECT * FROM asset_history WHERE user_id = ?', (user_id,)).fetchone()
+    conn.close()
+    assert row['jp_stock_value'] == 150 * 2500.0
+    assert row['us_stock_value'] == 10 * 190.0 * 150.0
+    assert row['crypto_value'] == 0.5 * 9000000.0
+
+    # 完了した日付は何もしない
+    assert runner.run(processes=2, threads=2, batch_size=1, run_date=RUN_DATE) == 0
+
+
+def test_record_snapshots_skips_done_unless_forced(portfolio, runner, monkeypatch):
+    calls = []
+    monkeypatch.setattr(portfolio, 'record_all_snapshots', lambda run_date: calls.append(run_date) or 1)
+    job_run = portfolio.begin_job_run(portfolio.NIGHTLY_JOB, RUN_DATE)
+
+    runner.record_snapshots(job_run)
+    runner.record_snapshots(job_run)
+    assert calls == [RUN_DATE]
+    runner.record_snapshots(job_run, force=True)
+    assert calls == [RUN_DATE, RUN_DATE]
+
+
+def test_record_snapshots_failure_fails_the_run(portfolio, runner, monkeypatch):
+    def broken(run_date):
+        raise RuntimeError('disk full')
+
+    monkeypatch.setattr(portfolio, 'record_all_snapshots', broken)
+    job_run = portfolio.begin_job_run(portfolio.NIGHTLY_JOB, RUN_DATE)
+    runner.record_snapshots(job_run)
+    assert portfolio.finish_job_run(job_run) == 'failed'
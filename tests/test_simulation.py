@@ -0,0 +1,135 @@
+import concurrent.futures
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import simulation
+from conftest import DEMO_USER_ID, add_asset, login
+
+
+def test_checkpoint_days():
+    for horizon in simulation.HORIZONS.values():
+        days = simulation.checkpoint_days(horizon)
+        assert days[-1] == horizon
+        assert days == sorted(set(days))
+        assert len(days) <= simulation.CHECKPOINTS + 1
+        assert all(day % simulation.BLOCK_DAYS == 0 for day in days[:-1])
+    assert simulation.checkpoint_days(10) == [10]
+
+
+def test_flows_are_not_counted_as_returns():
+    values = np.array([[100, 0], [110, 50], [200, 55], [210, 0]], dtype=float)
+    history = type('History', (), {'values': values})()
+    returns = simulation.class_returns(history)
+    assert returns[:, 0] == pytest.approx([0.1, 0.0, 0.05])
+    assert returns[:, 1] == pytest.approx([0.0, 0.1, 0.0])
+
+
+def returns_sample(days=120):
+    rng = np.random.default_rng(1)
+    return rng.normal(0.001, 0.01, size=(days, 2))
+
+
+def test_run_is_deterministic_and_chunked():
+    simulator = simulation.Simulator(workers=0, chunk_paths=300)
+    first = simulator.run(returns_sample(), [600000, 400000], 365, 1000, seed=7)
+    assert first == simulator.run(returns_sample(), [600000, 400000], 365, 1000, seed=7)
+    assert first != simulator.run(returns_sample(), [600000, 400000], 365, 1000, seed=8)
+    assert (first['paths'], first['partial'], first['start_value']) == (1000, False, 1000000.0)
+    bands = [first['bands'][str(p)][-1] for p in simulation.PERCENTILES]
+    assert bands == sorted(bands)
+    assert 0 < first['probability_of_loss'] < 1
+
+
+def test_flat_returns_keep_the_start_value():
+    simulator = simulation.Simulator(workers=0)
+    result = simulator.run(np.zeros((30, 2)), [100, 0], 91, 50)
+    assert result['bands']['5'] == pytest.approx([100] * len(result['days']))
+    empty = simulator.run(np.zeros((0, 2)), [100, 0], 91, 50)
+    assert (empty['mean'], empty['partial']) == (100.0, False)
+
+
+class ThreadSimulator(simulation.Simulator):
+    """プロセスの代わりにスレッドでチャンクを計算する(遅いチャンクを差し込めるように)"""
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        return self._pool
+
+
+@pytest.fixture
+def slow_chunks(monkeypatch):
+    chunk = simulation.simulate_chunk
+    slow = set()
+
+    def simulate_chunk(log_growth, allocation, days, paths, seed):
+        if paths in slow:
+            time.sleep(0.5)
+        return chunk(log_growth, allocation, days, paths, seed)
+    monkeypatch.setattr(simulation, 'simulate_chunk', simulate_chunk)
+    return slow
+
+
+def test_deadline_returns_finished_chunks(slow_chunks):
+    slow_chunks.add(50)
+    simulator = ThreadSimulator(workers=2, chunk_paths=100, timeout=0.3)
+    result = simulator.run(returns_sample(), [1.0, 1.0], 365, 250)
+    assert (result['paths'], result['partial']) == (200, True)
+    simulator.shutdown()
+
+
+def test_deadline_without_any_chunk_raises(slow_chunks):
+    slow_chunks.update({100, 50})
+    simulator = ThreadSimulator(workers=2, chunk_paths=100, timeout=0.1)
+    with pytest.raises(concurrent.futures.TimeoutError):
+        simulator.run(returns_sample(), [1.0, 1.0], 365, 250)
+    simulator.shutdown()
+
+
+@pytest.fixture
+def holdings(portfolio, monkeypatch):
+    monkeypatch.setattr(portfolio, 'simulator', simulation.Simulator(workers=0))
+    add_asset(portfolio, DEMO_USER_ID, 'cash', '普通預金', 1000000)
+    conn = portfolio.get_db()
+    for i, total in enumerate([980000, 990000, 1000000]):
+        conn.execute('INSERT INTO asset_history (user_id, record_date, cash_value, total_value) VALUES (?, ?, ?, ?)',
+                     (DEMO_USER_ID, date.today() - timedelta(days=2 - i), total, total))
+    conn.commit()
+    conn.close()
+    return portfolio
+
+
+def test_api_simulation(client, holdings):
+    assert client.get('/api/simulation').status_code == 401
+    login(client)
+    assert client.get('/api/simulation?horizon=2y').status_code == 400
+    assert client.get('/api/simulation?paths=0').status_code == 400
+    assert client.get(f'/api/simulation?paths={holdings.SIMULATION_MAX_PATHS + 1}').status_code == 400
+
+    data = client.get('/api/simulation?horizon=3m&paths=6000').get_json()
+    assert (data['horizon'], data['paths'], data['partial']) == ('3m', 20000, False)
+    assert data['start_value'] == 1000000
+    assert data['allocation']['cash'] == 1000000
+    assert data['bands']['50'][-1] > 1000000
+
+
+def test_partial_results_are_not_cached(holdings, monkeypatch):
+    calls = []
+
+    class Partial:
+        def run(self, returns, weights, horizon, paths, seed=0):
+            calls.append(paths)
+            return {'start_value': 1.0, 'mean': 1.0, 'bands': {'50': [1.0]}, 'paths': paths // 2, 'partial': True}
+    monkeypatch.setattr(holdings, 'simulator', Partial())
+    holdings.portfolio_simulation(DEMO_USER_ID, '1y', 5000)
+    holdings.portfolio_simulation(DEMO_USER_ID, '1y', 5000)
+    assert calls == [5000, 5000]
+
+    monkeypatch.setattr(holdings, 'simulator', simulation.Simulator(workers=0))
+    first = holdings.portfolio_simulation(DEMO_USER_ID, '1y', 5000)
+    monkeypatch.setattr(holdings, 'simulator', Partial())
+    assert holdings.portfolio_simulation(DEMO_USER_ID, '1y', 5000) == first
+    assert calls == [5000, 5000]
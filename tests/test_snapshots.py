@@ -0,0 +1,83 @@
+import random
+from datetime import date
+
+import pytest
+
+from conftest import DEMO_USER_ID, add_asset, add_user
+from holdings import ASSET_TYPES
+
+COLUMNS = [f'{asset_type}_value' for asset_type in ASSET_TYPES] + ['total_value']
+
+
+@pytest.fixture
+def fixed_fx(portfolio, monkeypatch):
+    monkeypatch.setattr(portfolio.fx_rates, 'fetch', lambda currency, base: 151.25)
+
+
+def history(portfolio):
+    conn = portfolio.get_db()
+    rows = conn.execute(f'SELECT user_id, record_date, {", ".join(COLUMNS)} FROM asset_history '
+                        'ORDER BY user_id').fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def populate(portfolio, rng):
+    user_ids = [DEMO_USER_ID] + [add_user(portfolio, f'user{i}') for i in range(5)]
+    universe = [('jp_stock', '7203'), ('jp_stock', '6758'), ('us_stock', 'AAPL'), ('crypto', 'BTC'),
+                ('gold', '金地金'), ('gold', '金貨'), ('investment_trust', 'オルカン'), ('cash', '普通預金'),
+                ('insurance', '生命保険')]
+    # 最後のユーザーは資産なし
+    for user_id in user_ids[:-1]:
+        for asset_type, symbol in rng.sample(universe, 6):
+            add_asset(portfolio, user_id, asset_type, symbol, round(rng.uniform(1, 1000), 3),
+                      price=rng.randint(10000, 2000000) if asset_type == 'insurance' else 0)
+    conn = portfolio.get_db()
+    portfolio.write_quotes(conn.cursor(), [
+        ('jp_stock', '7203', 2500.5), ('jp_stock', '6758', 13000.0), ('us_stock', 'AAPL', 190.25),
+        ('crypto', 'BTC', 9500000.0), ('gold', '', 12000.0), ('investment_trust', 'オルカン', 23456.0)])
+    conn.commit()
+    conn.close()
+    return user_ids
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_all_users_pass_matches_per_user_snapshots(portfolio, fixed_fx, seed):
+    user_ids = populate(portfolio, random.Random(seed))
+
+    for user_id in user_ids:
+        portfolio.record_asset_snapshot(user_id)
+    per_user = history(portfolio)
+
+    conn = portfolio.get_db()
+    conn.execute('DELETE FROM asset_history')
+    conn.commit()
+    conn.close()
+    assert portfolio.record_all_snapshots() == len(user_ids)
+    batched = history(portfolio)
+
+    assert len(batched) == len(per_user) == len(user_ids)
+    for expected, actual in zip(per_user, batched):
+        assert actual['user_id'] == expected['user_id']
+        assert actual['record_date'] == expected['record_date']
+        for column in COLUMNS:
+            assert actual[column] == pytest.approx(expected[column], rel=1e-12), column
+    assert batched[-1]['total_value'] == 0
+
+
+def test_record_all_snapshots_upserts_the_given_date(portfolio, fixed_fx):
+    add_asset(portfolio, DEMO_USER_ID, 'cash', '普通預金', 1000)
+    portfolio.record_all_snapshots(date(2024, 6, 3))
+    conn = portfolio.get_db()
+    conn.execute("UPDATE assets SET quantity = 2500 WHERE asset_type = 'cash'")
+    conn.commit()
+    conn.close()
+    portfolio.record_all_snapshots(date(2024, 6, 3))
+
+    assert [(row['record_date'], row['cash_value']) for row in history(portfolio)] == [('2024-06-03', 2500.0)]
+
+
+def test_record_all_snapshots_invalidates_analytics_cache(portfolio, fixed_fx):
+    portfolio.analytics_cache.put((DEMO_USER_ID, '1y'), {'cached': True})
+    portfolio.record_all_snapshots()
+    assert portfolio.analytics_cache.get((DEMO_USER_ID, '1y')) is None
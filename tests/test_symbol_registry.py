@@ -0,0 +1,123 @@
+import threading
+import time
+
+import pytest
+
+import symbol_registry
+from symbol_registry import Instrument, SymbolRegistry
+
+BASES = {'minkabu': 'https://cc.minkabu.jp', 'rakuten': 'https://www.rakuten-sec.co.jp/web/fund/detail/'}
+HOSTS = frozenset(['cc.minkabu.jp', 'www.rakuten-sec.co.jp'])
+ADMIN = {'Authorization': 'Bearer admin'}
+
+
+def crypto(symbol, enabled=True, url_template='{minkabu}/pair/{symbol}_JPY', source='minkabu'):
+    return Instrument('crypto', symbol, symbol, source, url_template, 'minkabu_pair', None, enabled)
+
+
+def test_registry_skips_disabled_instruments():
+    registry = SymbolRegistry(lambda: [crypto('BTC'), crypto('ETH'), crypto('OLD', enabled=False)])
+    assert registry.symbols('crypto') == ['BTC', 'ETH']
+    assert registry.get('crypto', 'OLD') is None
+    assert registry.get('crypto', 'BTC').parser == 'minkabu_pair'
+
+
+def test_failed_reload_keeps_previous_instruments():
+    rows = [[crypto('BTC')]]
+
+    def loader():
+        if not rows:
+            raise RuntimeError('db down')
+        return rows.pop()
+
+    registry = SymbolRegistry(loader, ttl=0)
+    assert registry.symbols('crypto') == ['BTC']
+    assert registry.reload() is False
+    assert registry.symbols('crypto') == ['BTC']
+
+
+def test_stale_registry_is_reloaded_by_one_thread():
+    loads = []
+
+    def slow_loader():
+        loads.append(1)
+        time.sleep(0.05)
+        return [crypto('BTC')]
+
+    registry = SymbolRegistry(slow_loader, ttl=3600)
+    registry.reload()
+    registry._loaded_at -= 7200
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get('crypto', 'BTC'))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(loads) == 2
+    # 読み直しの間も他のスレッドは前回の内容で答える
+    assert all(result is not None for result in results)
+
+
+@pytest.mark.parametrize('instrument', [
+    crypto('BTC', url_template='http://169.254.169.254/latest/meta-data/'),
+    crypto('BTC', url_template='file:///etc/passwd'),
+    crypto('BTC', url_template='{minkabu}@evil.example.com/x'),
+    crypto('BTC', url_template='{nope}/x'),
+    crypto('BTC', url_template='{minkabu}/{0}'),
+    crypto('BTC', source='evil'),
+])
+def test_checked_instrument_url_rejects_other_hosts(instrument):
+    with pytest.raises(ValueError):
+        symbol_registry.checked_instrument_url(instrument, BASES, HOSTS)
+
+
+def test_checked_instrument_url_expands_template():
+    assert symbol_registry.checked_instrument_url(crypto('BTC'), BASES, HOSTS) == 'https://cc.minkabu.jp/pair/BTC_JPY'
+    insurance = Instrument('insurance', '生命保険', '生命保険', None, None, None, None, True)
+    assert symbol_registry.checked_instrument_url(insurance, BASES, HOSTS) is None
+
+
+def test_default_instruments_are_seeded(portfolio):
+    assert portfolio.instrument_registry.symbols('crypto') == ['BTC', 'DOGE', 'ETH', 'XRP']
+    assert portfolio.instrument_registry.get('gold', '').source == 'tanaka'
+    for instrument in symbol_registry.DEFAULT_INSTRUMENTS:
+        assert symbol_registry.checked_instrument_url(
+            instrument, portfolio.SOURCE_BASE_URLS, portfolio.SYMBOL_URL_HOSTS) or instrument.url_template is None
+
+
+def test_admin_symbols_adds_an_instrument(client, portfolio, monkeypatch):
+    monkeypatch.setenv('ADMIN_TOKEN', 'admin')
+    response = client.post('/admin/symbols', headers=ADMIN, json={
+        'asset_type': 'crypto', 'symbol': 'SOL', 'source': 'minkabu',
+        'url_template': '{minkabu}/pair/{symbol}_JPY', 'parser': 'minkabu_pair', 'cadence_minutes': 60})
+    assert response.status_code == 200
+    assert portfolio.instrument_registry.get('crypto', 'SOL').cadence_minutes == 60
+    assert 'SOL' in [row['symbol'] for row in client.get('/admin/symbols', headers=ADMIN).get_json()]
+
+
+@pytest.mark.parametrize('payload', [
+    {'asset_type': 'crypto'},
+    {'asset_type': 'crypto', 'symbol': 'SOL', 'parser': 'eval'},
+    {'asset_type': 'crypto', 'symbol': 'SOL', 'cadence_minutes': 0},
+    {'asset_type': 'crypto', 'symbol': 'SOL', 'cadence_minutes': True},
+    {'asset_type': 'crypto', 'symbol': 'SOL', 'source': 'minkabu', 'url_template': 'http://10.0.0.1/'},
+])
+def test_admin_symbols_rejects_invalid_instruments(client, portfolio, monkeypatch, payload):
+    monkeypatch.setenv('ADMIN_TOKEN', 'admin')
+    assert client.post('/admin/symbols', headers=ADMIN, json=payload).status_code == 400
+    assert portfolio.instrument_registry.get('crypto', 'SOL') is None
+
+
+def test_admin_symbols_requires_token(client, monkeypatch):
+    assert client.get('/admin/symbols').status_code == 404
+    assert client.post('/admin/symbols/reload').status_code == 404
+    monkeypatch.setenv('ADMIN_TOKEN', 'admin')
+    assert client.post('/admin/symbols', json={'asset_type': 'crypto', 'symbol': 'SOL'}).status_code == 401
+    assert client.post('/admin/symbols/reload', headers=ADMIN).get_json() == {'instruments': 14}
+
+
+def test_fetch_instrument_page_refuses_unchecked_urls(portfolio, caplog):
+    instrument = crypto('BTC', url_template='http://169.254.169.254/')
+    assert portfolio.fetch_instrument_page(instrument) == 0
+    assert 'Refusing to fetch crypto:BTC' in caplog.text
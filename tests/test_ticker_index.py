@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import login
+from ticker_index import Ticker, TickerIndex, normalize_company_name, search_key
+
+TICKERS = [
+    ('jp_stock', '7203', 'トヨタ自動車', 'TSE'),
+    ('jp_stock', '7201', '日産自動車', 'TSE'),
+    ('jp_stock', '6758', 'ソニーグループ', 'TSE'),
+    ('us_stock', 'AAPL', 'Apple', 'NMS'),
+    ('us_stock', 'AMZN', 'Amazon.com', 'NMS'),
+    ('us_stock', 'TM', 'Toyota Motor', 'NYQ'),
+]
+
+
+@pytest.fixture
+def index():
+    return TickerIndex(lambda: TICKERS)
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('トヨタ自動車株式会社', 'トヨタ自動車'),
+    ('(株)ソニーグループ', 'ソニーグループ'),
+    ('Apple Inc.', 'Apple'),
+    ('Toyota Motor Corp', 'Toyota Motor'),
+    ('SONY GROUP CO., LTD.', 'SONY GROUP'),
+    ('', ''),
+])
+def test_normalize_company_name(name, expected):
+    assert normalize_company_name(name) == expected
+
+
+def test_search_key_ignores_width_case_and_spaces():
+    assert search_key('AAPL') == search_key('aapl') == 'aapl'
+    assert search_key('トヨタ 自動車') == 'トヨタ自動車'
+
+
+def symbols(tickers):
+    return [t.symbol for t in tickers]
+
+
+def test_prefix_matches_codes_and_names(index):
+    assert symbols(index.search('72')) == ['7201', '7203']
+    assert symbols(index.search('トヨタ')) == ['7203']
+    # 前方一致が先、部分一致(Toyota Motor)が後
+    assert symbols(index.search('a', asset_type='us_stock')) == ['AAPL', 'AMZN', 'TM']
+    assert symbols(index.search('a', limit=1)) == ['AAPL']
+    assert index.search('  ') == []
+
+
+def test_substring_and_fuzzy_matches_fill_the_rest(index):
+    assert sorted(symbols(index.search('自動車'))) == ['7201', '7203']
+    assert symbols(index.search('amazn')) == ['AMZN']
+
+
+def test_added_tickers_are_searchable(index):
+    assert index.add(Ticker('us_stock', 'NVDA', 'NVIDIA', 'NMS'))
+    assert not index.add(Ticker('us_stock', 'NVDA', 'NVIDIA', 'NMS'))
+    assert symbols(index.search('nvi')) == ['NVDA']
+
+
+def test_remember_ticker_persists(portfolio):
+    portfolio.remember_ticker('jp_stock', '7203', 'トヨタ自動車', 'TSE')
+    portfolio.remember_ticker('jp_stock', '9999', None)
+    portfolio.stock_index.reload()
+    assert portfolio.stock_index.get('jp_stock', '7203').name == 'トヨタ自動車'
+    assert portfolio.stock_index.get('jp_stock', '9999') is None
+
+
+def write_quote(portfolio, asset_type, symbol, price, age):
+    conn = portfolio.get_db()
+    as_of = datetime.now(timezone.utc).replace(tzinfo=None) - age
+    conn.execute('INSERT INTO quotes (asset_type, symbol, price, as_of) VALUES (?, ?, ?, ?)',
+                 (asset_type, symbol, price, as_of))
+    conn.commit()
+    conn.close()
+
+
+def test_lookup_uses_index_name_and_fresh_quote(portfolio, monkeypatch):
+    portfolio.remember_ticker('jp_stock', '7203', 'トヨタ自動車', 'TSE')
+    portfolio.remember_ticker('us_stock', 'AAPL', 'Apple', 'NMS')
+    write_quote(portfolio, 'jp_stock', '7203', 2500.0, timedelta(seconds=10))
+    write_quote(portfolio, 'us_stock', 'AAPL', 180.0, timedelta(hours=2))
+    fetched = []
+    monkeypatch.setattr(portfolio, 'fetch_asset_price', lambda t, s: fetched.append(s) or 190.0)
+    monkeypatch.setattr(portfolio, 'get_jp_stock_info', lambda code: {'name': 'scraped', 'price': 1.0})
+
+    assert portfolio.lookup_stock_info('jp_stock', '7203') == {'name': 'トヨタ自動車', 'price': 2500.0}
+    assert portfolio.lookup_stock_info('us_stock', 'AAPL') == {'name': 'Apple', 'price': 190.0}
+    assert fetched == ['AAPL']
+    # 索引にない銘柄はページから名前も取る
+    assert portfolio.lookup_stock_info('jp_stock', '6758') == {'name': 'scraped', 'price': 1.0}
+
+
+def test_search_api(client, portfolio):
+    assert client.get('/api/symbols/search?q=to').status_code == 401
+    login(client)
+    portfolio.remember_ticker('jp_stock', '7203', 'トヨタ自動車', 'TSE')
+
+    results = client.get('/api/symbols/search?q=トヨタ').get_json()
+    assert results == [{'asset_type': 'jp_stock', 'symbol': '7203', 'name': 'トヨタ自動車', 'exchange': 'TSE'}]
+    crypto = client.get('/api/symbols/search?q=eth&type=crypto').get_json()
+    assert [r['symbol'] for r in crypto] == ['ETH']
@@ -0,0 +1,159 @@
+"""
+日本株・米国株の銘柄索引
+
+証券コード/シンボル・正規化した銘柄名・取引所を tickers テーブルに保持し、
+プロセス内では前方一致用のソート済みリストと辞書で引く。価格取得で銘柄名が
+分かるたびに登録されるので、資産追加時に銘柄名のためだけに通信しなくて済む。
+"""
+import bisect
+import difflib
+import functools
+import itertools
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+Ticker = namedtuple('Ticker', ['asset_type', 'symbol', 'name', 'exchange'])
+
+_JP_SUFFIXES = re.compile(r'株式会社|合同会社|合名会社|合資会社|有限会社|\(株\)|(株)')
+_EN_SUFFIXES = re.compile(
+    r'(?: COMPANY,? LIMITED| CO\.,? ?LTD\.?| LTD\.?| INC\.?| CORP\.?)$', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=8192)
+def normalize_company_name(name):
+    """会社名から法人格(株式会社・CO., LTD. など)を除く"""
+    if not name:
+        return name
+    name = _JP_SUFFIXES.sub('', name)
+    name = _EN_SUFFIXES.sub('', name)
+    return name.strip()
+
+
+@functools.lru_cache(maxsize=8192)
+def search_key(text):
+    """検索用のキー(全角半角・大文字小文字・空白の違いを吸収)"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text or '')).lower()
+
+
+class TickerIndex:
+    """tickers テーブルの内容をメモリに持ち、前方一致とあいまい検索を行う"""
+
+    def __init__(self, loader=None, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self._by_key = {}
+        self._sorted = []
+        self._candidates = {}
+        self._dirty = False
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def reload(self):
+        try:
+            tickers = [Ticker(*row) for row in self.loader()]
+        except Exception as e:
+            logger.error(f"Failed to load ticker index: {e}")
+            with self._lock:
+                self._loaded_at = time.monotonic()
+            return False
+        with self._lock:
+            self._by_key = {(t.asset_type, t.symbol): t for t in tickers}
+            self._rebuild()
+            self._loaded_at = time.monotonic()
+        return True
+
+    def _rebuild(self):
+        # (検索キー, asset_type, symbol) を銘柄コードと銘柄名の両方で並べる
+        entries = []
+        for t in self._by_key.values():
+            entries.append((search_key(t.symbol), t.asset_type, t.symbol))
+            if t.name:
+                entries.append((search_key(t.name), t.asset_type, t.symbol))
+        entries.sort()
+        candidates = {}
+        for entry_key, entry_type, symbol in entries:
+            candidates.setdefault(entry_key, []).append((entry_type, symbol))
+        self._sorted = entries
+        self._candidates = candidates
+        self._dirty = False
+
+    def _stale(self):
+        loaded_at = self._loaded_at
+        return loaded_at is None or time.monotonic() - loaded_at > self.ttl
+
+    def _ensure_fresh(self):
+        if not self._stale():
+            return
+        # 読み直すのは1スレッドだけ。読み込み済みなら他のスレッドは待たずに前回の内容を使う
+        if not self._reload_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._stale():
+                self.reload()
+        finally:
+            self._reload_lock.release()
+
+    def get(self, asset_type, symbol):
+        self._ensure_fresh()
+        return self._by_key.get((asset_type, symbol))
+
+    def add(self, ticker):
+        """登録・更新があれば True(呼び出し側で永続化する)"""
+        self._ensure_fresh()
+        key = (ticker.asset_type, ticker.symbol)
+        with self._lock:
+            if self._by_key.get(key) == ticker:
+                return False
+            self._by_key[key] = ticker
+            # 検索用のリストは次の検索時に作り直す
+            self._dirty = True
+        return True
+
+    def search(self, query, asset_type=None, limit=10):
+        """前方一致を優先し、足りなければあいまい一致で補う"""
+        self._ensure_fresh()
+        key = search_key(query)
+        if not key:
+            return []
+        if self._dirty:
+            with self._lock:
+                if self._dirty:
+                    self._rebuild()
+        entries = self._sorted
+        candidates = self._candidates
+        by_key = self._by_key
+
+        results = []
+        seen = set()
+
+        def collect(ticker_key):
+            if ticker_key in seen or (asset_type and ticker_key[0] != asset_type):
+                return
+            ticker = by_key.get(ticker_key)
+            if ticker is not None:
+                seen.add(ticker_key)
+                results.append(ticker)
+
+        start = bisect.bisect_left(entries, (key,))
+        for entry_key, entry_type, symbol in itertools.islice(entries, start, None):
+            if not entry_key.startswith(key) or len(results) >= limit:
+                break
+            collect((entry_type, symbol))
+
+        if len(results) < limit:
+            # 部分一致、次に編集距離の近いもの
+            for entry_key in candidates:
+                if key in entry_key:
+                    for ticker_key in candidates[entry_key]:
+                        collect(ticker_key)
+            for entry_key in difflib.get_close_matches(key, list(candidates), n=limit, cutoff=0.6):
+                for ticker_key in candidates[entry_key]:
+                    collect(ticker_key)
+        return results[:limit]